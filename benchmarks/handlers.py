@@ -0,0 +1,318 @@
+"""Cold start and per-invocation benchmarks of the Lambda handlers
+
+Every handler is measured in fresh interpreters, so nothing is shared
+with other handlers or earlier runs:
+
+* import: time to import the handler module (the cold start part
+  which runs before the first invocation)
+* first: the first invocation, which creates AWS clients, logs in to
+  Rocket.Chat, decrypts secrets, etc.
+* warm: the following invocations of the same container
+
+AWS calls are answered by botocore Stubber, Rocket.Chat (and the
+CloudFormation response url) by a local fake server with `--latency`
+added to every response. Results are printed as JSON, `--baseline`
+compares them with an earlier run:
+
+    python benchmarks/handlers.py --output before.json
+    python benchmarks/handlers.py --baseline before.json
+
+"""
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CYNNIG = os.path.join(ROOT, 'cynnig')
+TESTS = os.path.join(ROOT, 'tests')
+
+HANDLERS = {
+    'video': 'video_handler',
+    'gifs': 'gifs_handler',
+    'resource': 'resource_handler',
+}
+
+AWS_ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+}
+
+PIPELINE_ID = '1534090839028-jh9ib4'
+GIF = b'GIF89a' + b'\0' * 256 * 1024
+
+
+class Context:
+    """Lambda context with plenty of time left"""
+
+    function_name = 'benchmark'
+    aws_request_id = 'benchmark-request'
+    log_stream_name = 'benchmark-stream'
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 60 * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('handlers', nargs='*', metavar='handler',
+                        help='{} (all by default)'.format(', '.join(HANDLERS)))
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='warm invocations per handler')
+    parser.add_argument('--imports', type=int, default=5,
+                        help='cold imports per handler')
+    parser.add_argument('--latency', type=float, default=20.0,
+                        help='milliseconds added to fake server responses')
+    parser.add_argument('--output', help='file to write results to')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--invoke', choices=list(HANDLERS),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unknown = set(args.handlers) - set(HANDLERS)
+    if unknown:
+        parser.error('unknown handlers: {}'.format(', '.join(sorted(unknown))))
+
+    if args.invoke:
+        result = invoke(args.invoke, args.iterations, args.latency / 1000.0)
+        json.dump(result, sys.stdout)
+        return
+
+    results = {
+        'commit': commit(),
+        'python': '.'.join(map(str, sys.version_info[:3])),
+        'iterations': args.iterations,
+        'latency_ms': args.latency,
+        'handlers': {}
+    }
+    for name in args.handlers or list(HANDLERS):
+        imports = [cold_import(HANDLERS[name]) for _ in range(args.imports)]
+        invocations = run_child(name, args.iterations, args.latency)
+        results['handlers'][name] = {
+            'import_ms': summary(imports),
+            'first_ms': round(invocations['first'], 3),
+            'warm_ms': summary(invocations['warm'])
+        }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+def commit() -> str:
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=ROOT, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return output.decode('ascii').strip()
+
+
+def summary(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        'min': round(ordered[0], 3),
+        'median': round(statistics.median(ordered), 3),
+        # nearest rank, the smallest sample with 90% of them at or below
+        'p90': round(ordered[math.ceil(0.9 * len(ordered)) - 1], 3),
+        'mean': round(statistics.mean(ordered), 3),
+    }
+
+
+def cold_import(module: str) -> float:
+    """Milliseconds to import a handler module in a fresh interpreter"""
+    script = ('import time; start = time.perf_counter(); import {}; '
+              'print((time.perf_counter() - start) * 1000)'.format(module))
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=CYNNIG, env=child_environment())
+    return float(output)
+
+
+def run_child(name: str, iterations: int, latency: float) -> Dict:
+    output = subprocess.check_output(
+        [sys.executable, os.path.realpath(__file__), '--invoke', name,
+         '--iterations', str(iterations), '--latency', str(latency)],
+        env=child_environment())
+    return json.loads(output.decode('utf-8'))
+
+
+def child_environment() -> Dict[str, str]:
+    environment = {name: value for name, value in os.environ.items()
+                   if not name.startswith('AWS_')}
+    environment.update(AWS_ENVIRONMENT)
+    return environment
+
+
+def compare(baseline: Dict, results: Dict) -> None:
+    """Prints the change of every median against the baseline"""
+    for name, current in sorted(results['handlers'].items()):
+        before = baseline.get('handlers', {}).get(name)
+        if not before:
+            continue
+        for metric in ('import_ms', 'first_ms', 'warm_ms'):
+            old, new = before[metric], current[metric]
+            if isinstance(old, dict):
+                old, new = old['median'], new['median']
+            change = (new - old) / old * 100 if old else 0.0
+            print('{:<9} {:<10} {:>10.3f} -> {:>10.3f} ms ({:+.1f}%)'.format(
+                name, metric, old, new, change), file=sys.stderr)
+
+
+def invoke(name: str, iterations: int, latency: float) -> Dict:
+    """Runs in a fresh interpreter: imports the handler, invokes it
+    once cold and `iterations` times warm
+
+    """
+    sys.path.insert(0, CYNNIG)
+    sys.path.insert(0, TESTS)
+    from fake_rocketchat import FakeRocketChat
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    with FakeRocketChat(latency=latency) as server:
+        setup = {
+            'video': video_benchmark,
+            'gifs': gifs_benchmark,
+            'resource': resource_benchmark,
+        }[name]
+        run = setup(server, iterations + 1)
+        timings = []
+        for i in range(iterations + 1):
+            start = time.perf_counter()
+            run(i)
+            timings.append((time.perf_counter() - start) * 1000)
+    return {'first': timings[0], 'warm': timings[1:]}
+
+
+def stub_clients(responses: Dict[str, List]) -> None:
+    """Answers AWS calls with the given (operation, response) pairs
+
+    The clients are still created by the handler on first use, only
+    their requests are stubbed.
+
+    """
+    import clients
+    from botocore.stub import Stubber
+
+    create = clients.client
+    stubbers = {}
+
+    def client(service: str):
+        instance = create(service)
+        if service not in stubbers:
+            stubber = Stubber(instance)
+            for operation, response in responses.get(service, []):
+                stubber.add_response(operation, response)
+            stubber.activate()
+            stubbers[service] = stubber
+        return instance
+
+    clients.client = client
+
+
+def video_benchmark(server, invocations: int) -> Callable[[int], None]:
+    os.environ['STACK_NAME'] = 'cynnig'
+    import video_handler
+
+    stub_clients({'elastictranscoder': [
+        ('list_pipelines', {'Pipelines': [
+            {'Name': 'cynnig motion pipeline', 'Id': PIPELINE_ID}]}),
+        *[('create_job', {'Job': {'Id': 'job-{}'.format(i)}})
+          for i in range(invocations)]
+    ]})
+
+    def run(i: int) -> None:
+        key = '01-{:014d}.mkv'.format(20180730195708 + i)
+        event = {'Records': [{'s3': {
+            'bucket': {'name': 'motion-events'},
+            'object': {'key': key, 'eTag': str(i)}
+        }}]}
+        report = video_handler.new_motion_video_handler(event, Context())
+        assert report[0]['status'] == 'SUCCEEDED', report
+
+    return run
+
+
+def gifs_benchmark(server, invocations: int) -> Callable[[int], None]:
+    from base64 import b64encode
+    from botocore.response import StreamingBody
+
+    os.environ.update({
+        'ROCKET_SERVER': server.url,
+        'ROCKET_USERNAME': 'benchmark',
+        'ROCKET_PASSWORD': b64encode(b'ciphertext').decode('ascii'),
+        'ROCKET_ROOM_ID': 'benchmark-room',
+        'PIPELINE_BUCKET': 'motion-gifs',
+    })
+    import gifs_handler
+
+    stub_clients({
+        'kms': [('decrypt', {'Plaintext': b'password'})],
+        's3': [('get_object', {'Body': StreamingBody(io.BytesIO(GIF),
+                                                     len(GIF)),
+                               'ContentLength': len(GIF)})
+               for _ in range(invocations)]
+    })
+
+    def run(i: int) -> None:
+        key = '01-{:014d}.gif'.format(20180730195708 + i)
+        message = json.dumps({'state': 'COMPLETED', 'outputs': [{'key': key}]})
+        event = {'Records': [{'Sns': {'MessageId': str(i),
+                                      'Message': message}}]}
+        report = gifs_handler.new_motion_gifs_handler(event, Context())
+        assert report[0]['status'] == 'SUCCEEDED', report
+
+    return run
+
+
+def resource_benchmark(server, invocations: int) -> Callable[[int], None]:
+    import resource_handler
+
+    @server.route('/cloudformation')
+    def cloudformation(request):
+        return 200, {}, {}
+
+    stub_clients({'elastictranscoder': [
+        ('create_pipeline', {'Pipeline': {
+            'Id': PIPELINE_ID,
+            'Arn': 'arn:aws:elastictranscoder:eu-west-1:0:pipeline/'
+                   + PIPELINE_ID}})
+        for _ in range(invocations)
+    ]})
+
+    def run(i: int) -> None:
+        event = {
+            'RequestType': 'Create',
+            'RequestId': 'request-{}'.format(i),
+            'ResponseURL': server.url + '/cloudformation',
+            'ResourceType': 'Custom::ElasticTranscoderPipeline',
+            'LogicalResourceId': 'VideoPipeline',
+            'StackId': 'arn:aws:cloudformation:eu-west-1:0:stack/cynnig/0',
+            'ResourceProperties': {
+                'DisplayName': 'cynnig motion pipeline',
+                'Role': 'arn:aws:iam::0:role/transcoder',
+                'InputBucket': 'motion-events',
+                'OutputBucket': 'motion-gifs',
+                'Notifications': 'arn:aws:sns:eu-west-1:0:notifications'
+            }
+        }
+        resource_handler.elastictranscoder_resource_handler(event, Context())
+
+    return run
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""Load generator for the motion pipeline
+
+Sends S3 events of many cameras to new_motion_video_handler at a given
+arrival rate, with up to `--concurrency` invocations running at once.
+Every job the handler creates completes on a fake Elastic Transcoder
+after `--transcode-time`, its SNS notification is then sent to
+new_motion_gifs_handler, which uploads the GIF to a local fake
+Rocket.Chat:
+
+    python benchmarks/load.py --cameras 50 --events 500 --rate 100
+
+Captured events (a JSON event per line, S3 or SNS) can be replayed
+instead with `--replay events.jsonl`. Both fakes add latency and answer
+a share of the requests with throttling or server errors. The report
+has the throughput, latency percentiles of each handler, retries and
+errors by type, `--json` prints it as JSON.
+
+"""
+import argparse
+import base64
+import collections
+import io
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'cynnig'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+GIF = b'GIF89a' + b'\0' * 64 * 1024
+
+
+class Faults:
+    """Latency and failures injected into a fake service"""
+
+    def __init__(self, latency: float, throttle_rate: float,
+                 error_rate: float) -> None:
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.counts: Dict[str, int] = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def draw(self) -> Optional[str]:
+        """Waits for the latency, returns 'throttled', 'error' or None"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            value = self._random.random()
+            if value < self.throttle_rate:
+                outcome = 'throttled'
+            elif value < self.throttle_rate + self.error_rate:
+                outcome = 'error'
+            else:
+                outcome = 'ok'
+            self.counts[outcome] += 1
+        return None if outcome == 'ok' else outcome
+
+
+class Outstanding:
+    """Counts invocations and jobs which haven't finished yet"""
+
+    def __init__(self) -> None:
+        self._count = 0
+        self._done = threading.Condition()
+
+    def add(self) -> None:
+        with self._done:
+            self._count += 1
+
+    def remove(self) -> None:
+        with self._done:
+            self._count -= 1
+            if not self._count:
+                self._done.notify_all()
+
+    def wait(self) -> None:
+        with self._done:
+            self._done.wait_for(lambda: not self._count)
+
+
+class ResourceNotFoundException(Exception):
+    pass
+
+
+class FakeElasticTranscoder:
+    """Accepts jobs and reports each of them complete after a delay"""
+
+    class exceptions:
+        ResourceNotFoundException = ResourceNotFoundException
+
+    def __init__(self, faults: Faults, transcode_time: float,
+                 completed: Callable[[Dict], None],
+                 outstanding: Outstanding) -> None:
+        self.faults = faults
+        self.transcode_time = transcode_time
+        self.completed = completed
+        self.outstanding = outstanding
+        self.jobs = 0
+        self._lock = threading.Lock()
+
+    def list_pipelines(self, **kwargs) -> Dict:
+        return {'Pipelines': [{'Name': 'cynnig motion pipeline',
+                               'Id': '1534090839028-jh9ib4'}]}
+
+    def create_job(self, PipelineId: str, Output: Dict, Input=None,
+                   Inputs=None) -> Dict:
+        from botocore.exceptions import ClientError
+
+        outcome = self.faults.draw()
+        if outcome:
+            code = 'ThrottlingException' if outcome == 'throttled' \
+                else 'InternalServiceException'
+            raise ClientError({'Error': {'Code': code, 'Message': outcome}},
+                              'CreateJob')
+        with self._lock:
+            self.jobs += 1
+            job_id = 'job-{}'.format(self.jobs)
+        notification = {'state': 'COMPLETED', 'jobId': job_id,
+                        'outputs': [{'key': Output['Key'],
+                                     'status': 'Complete'}]}
+        self.outstanding.add()
+        timer = threading.Timer(self.transcode_time, self._complete,
+                                args=[notification])
+        timer.daemon = True
+        timer.start()
+        return {'Job': {'Id': job_id}}
+
+    def _complete(self, notification: Dict) -> None:
+        try:
+            self.completed(notification)
+        finally:
+            self.outstanding.remove()
+
+
+class FakeS3:
+
+    def get_object(self, Bucket: str, Key: str) -> Dict:
+        return {'Body': io.BytesIO(GIF), 'ContentLength': len(GIF)}
+
+    def head_object(self, Bucket: str, Key: str) -> Dict:
+        return {'ContentLength': 2 * 1024 * 1024, 'Metadata': {}}
+
+    def generate_presigned_url(self, method: str, Params: Dict,
+                               ExpiresIn: int) -> str:
+        return 'https://s3.invalid/{Bucket}/{Key}'.format(**Params)
+
+
+class FakeKMS:
+
+    def decrypt(self, CiphertextBlob: bytes) -> Dict:
+        return {'Plaintext': CiphertextBlob}
+
+
+class Invocations:
+    """Latency and outcome of the invocations of one handler"""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = collections.Counter()
+        self.records = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency: float, report: Optional[List[Dict]] = None,
+            error: Optional[Exception] = None) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+            for record in report or []:
+                self.records += 1
+                if record['status'] == 'FAILED':
+                    self.errors[error_type(record.get('error', ''))] += 1
+
+    def summary(self, elapsed: float) -> Dict:
+        ordered = sorted(self.latencies)
+        return {
+            'invocations': len(ordered),
+            'records': self.records,
+            'throughput': round(len(ordered) / elapsed, 2) if elapsed else 0,
+            'p50_ms': percentile(ordered, 50),
+            'p95_ms': percentile(ordered, 95),
+            'p99_ms': percentile(ordered, 99),
+            'max_ms': round(ordered[-1], 3) if ordered else 0.0,
+            'errors': dict(self.errors),
+        }
+
+
+def error_type(message: str) -> str:
+    # 'An error occurred (ThrottlingException) when ...' -> the code,
+    # '500 Server Error: ... for url: ...' -> '500 Server Error'
+    code = re.search(r'\((\w+)\)', message)
+    if code:
+        return code.group(1)
+    return message.split(':')[0][:60] or 'unknown'
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index], 3)
+
+
+def synthesize(cameras: int, events: int,
+               clips_per_event: int) -> List[Dict]:
+    """S3 events of cameras triggering one after another"""
+    start = 20180730195708
+    result = []
+    for i in range(events):
+        camera = i % cameras + 1
+        records = []
+        for clip in range(clips_per_event):
+            key = '{:02d}-{}.mkv'.format(
+                camera, start + i // cameras * 100 + clip)
+            records.append({'s3': {
+                'bucket': {'name': 'motion-events'},
+                'object': {'key': key, 'eTag': '{}-{}'.format(i, clip)}
+            }})
+        result.append({'Records': records})
+    return result
+
+
+def replay(path: str) -> List[Dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cameras', type=int, default=50)
+    parser.add_argument('--events', type=int, default=200,
+                        help='synthesised S3 events')
+    parser.add_argument('--clips', type=int, default=1,
+                        help='recordings in each synthesised event')
+    parser.add_argument('--replay', help='JSON lines file of events')
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='events per second, 0 sends them all at once')
+    parser.add_argument('--poisson', action='store_true',
+                        help='exponential inter-arrival times')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='invocations running at once')
+    parser.add_argument('--transcode-time', type=float, default=0.5,
+                        help='seconds until a job completes')
+    parser.add_argument('--aws-latency', type=float, default=20.0,
+                        help='milliseconds added to transcoder calls')
+    parser.add_argument('--aws-throttle-rate', type=float, default=0.05)
+    parser.add_argument('--aws-error-rate', type=float, default=0.01)
+    parser.add_argument('--chat-latency', type=float, default=20.0,
+                        help='milliseconds added to Rocket.Chat responses')
+    parser.add_argument('--chat-throttle-rate', type=float, default=0.05)
+    parser.add_argument('--chat-error-rate', type=float, default=0.01)
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    events = replay(args.replay) if args.replay else \
+        synthesize(args.cameras, args.events, args.clips)
+    report = run(events, args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+
+
+def run(events: List[Dict], args) -> Dict:
+    from fake_rocketchat import FakeRocketChat
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    chat_faults = Faults(0.0, args.chat_throttle_rate, args.chat_error_rate)
+    aws_faults = Faults(args.aws_latency / 1000.0, args.aws_throttle_rate,
+                        args.aws_error_rate)
+    server = FakeRocketChat(latency=args.chat_latency / 1000.0)
+
+    @server.route(r'/api/v1/rooms\.upload/.*|/api/v1/chat\..*')
+    def chat(request):
+        if request['headers'].get('X-Auth-Token') != server.auth_token:
+            return 401, {}, {'status': 'error', 'message': 'unauthorized'}
+        outcome = chat_faults.draw()
+        if outcome == 'throttled':
+            return 429, {'Retry-After': '0.1'}, {'success': False}
+        if outcome == 'error':
+            return 500, {}, {'success': False}
+        return 200, {}, {'success': True,
+                         'message': {'_id': str(len(server.requests))}}
+
+    os.environ.update({
+        'STACK_NAME': 'cynnig',
+        'PIPELINE_BUCKET': 'motion-gifs',
+        'ROCKET_SERVER': '',
+        'ROCKET_USERNAME': 'load',
+        'ROCKET_PASSWORD': base64.b64encode(b'password').decode('ascii'),
+        'ROCKET_ROOM_ID': 'load-room',
+    })
+    import gifs_handler
+    import video_handler
+    import clients
+
+    results = {'video': Invocations(), 'gifs': Invocations()}
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    outstanding = Outstanding()
+
+    def invoke(name: str, handler: Callable, event: Dict) -> None:
+        start = time.perf_counter()
+        try:
+            report = handler(event, None)
+        except Exception as e:
+            results[name].add((time.perf_counter() - start) * 1000, error=e)
+        else:
+            results[name].add((time.perf_counter() - start) * 1000, report)
+        finally:
+            outstanding.remove()
+
+    def submit(name: str, handler: Callable, event: Dict) -> None:
+        outstanding.add()
+        executor.submit(invoke, name, handler, event)
+
+    def completed(notification: Dict) -> None:
+        event = {'Records': [{'Sns': {
+            'MessageId': notification['jobId'],
+            'Message': json.dumps(notification)
+        }}]}
+        submit('gifs', gifs_handler.new_motion_gifs_handler, event)
+
+    transcoder = FakeElasticTranscoder(aws_faults, args.transcode_time,
+                                       completed, outstanding)
+    fakes = {'elastictranscoder': transcoder, 's3': FakeS3(),
+             'kms': FakeKMS()}
+    clients.client = fakes.__getitem__
+
+    with server:
+        os.environ['ROCKET_SERVER'] = server.url
+        arrivals = random.Random(0)
+        started = time.perf_counter()
+        next_at = started
+        for event in events:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if 'Sns' in event['Records'][0]:
+                submit('gifs', gifs_handler.new_motion_gifs_handler, event)
+            else:
+                submit('video', video_handler.new_motion_video_handler, event)
+            if args.rate > 0:
+                interval = 1.0 / args.rate
+                next_at += arrivals.expovariate(args.rate) if args.poisson \
+                    else interval
+
+        # jobs keep completing after the last event was sent
+        outstanding.wait()
+        elapsed = time.perf_counter() - started
+        executor.shutdown()
+
+    return {
+        'events': len(events),
+        'elapsed_s': round(elapsed, 3),
+        'handlers': {name: invocations.summary(elapsed)
+                     for name, invocations in results.items()},
+        'transcoder': {
+            'requests': sum(aws_faults.counts.values()),
+            'jobs': transcoder.jobs,
+            # only throttled jobs are retried
+            'retries': aws_faults.counts['throttled'],
+            'responses': dict(aws_faults.counts),
+        },
+        'rocketchat': {
+            'requests': len(server.requests),
+            'retries': chat_faults.counts['throttled'] +
+            chat_faults.counts['error'],
+            'responses': dict(chat_faults.counts),
+        },
+    }
+
+
+def print_report(report: Dict) -> None:
+    print('{events} events in {elapsed_s}s'.format(**report))
+    for name, stats in sorted(report['handlers'].items()):
+        print('{:<6} {invocations:>5} invocations {throughput:>8}/s  '
+              'p50 {p50_ms:>9.1f}ms  p95 {p95_ms:>9.1f}ms  '
+              'p99 {p99_ms:>9.1f}ms  max {max_ms:>9.1f}ms'.format(
+                  name, **stats))
+        for error, count in sorted(stats['errors'].items()):
+            print('       {:>5} x {}'.format(count, error))
+    for service in ('transcoder', 'rocketchat'):
+        stats = report[service]
+        print('{:<11} {requests:>5} requests  {retries:>5} retried  '
+              'responses {responses}'.format(service, **stats))
+
+
+if __name__ == '__main__':
+    main()
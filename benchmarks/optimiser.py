@@ -0,0 +1,90 @@
+"""Throughput and memory of the GIF optimiser (GIF_OPTIMISE)
+
+The GIFs are made up like the system preset writes them: full
+480x270 frames with one palette, of a static scene with an object
+moving across it. `--noise` is the share of pixels which flicker in
+every frame, like sensor noise; at 1 every pixel changes, which is the
+slowest case and nothing is saved. Results are printed as JSON:
+
+    python benchmarks/optimiser.py --frames 300 --noise 0 0.01 1
+
+Lambda allots CPU in proportion to the function's memory, scale the
+rates by MemorySize / 1769 (one vCPU) for GIF_OPTIMISE_RATE.
+
+"""
+import argparse
+import json
+import os
+import resource
+import struct
+import sys
+import time
+import tracemalloc
+
+from typing import Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'cynnig', 'lib'))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--noise', type=float, nargs='+', default=[0, 1],
+                        help='shares of pixels changing in every frame')
+    args = parser.parse_args()
+    results = {str(noise): measure(animation(args.frames, noise))
+               for noise in args.noise}
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+def animation(count: int, noise: float, height: int = 270,
+              width: int = 480) -> bytes:
+    import gifopt
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    # a scene of flat blocks, palette indices below 100
+    scene = rng.randint(0, 100, (height // 30 + 1, width // 40 + 1))
+    scene = scene.repeat(30, axis=0).repeat(40, axis=1)[:height, :width]
+    palette = rng.randint(0, 256, (256, 3)).astype(np.uint8)
+    data = b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0)
+    data += palette.tobytes()
+    data += b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00'
+    for i in range(count):
+        frame = scene.astype(np.uint8)
+        flicker = rng.rand(height, width) < noise
+        frame[flicker] = rng.randint(100, 200, flicker.sum())
+        left = i * 3 % (width - 60)
+        frame[100:180, left:left + 60] = 200
+        data += struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0, 10, 0, 0)
+        data += struct.pack('<BHHHHB', 0x2C, 0, 0, width, height, 0)
+        data += b'\x08' + gifopt._blocks(
+            gifopt.lzw_encode(frame.tobytes(), 8))
+    return data + b'\x3B'
+
+
+def measure(data: bytes) -> Dict[str, float]:
+    import gifopt
+
+    start = time.perf_counter()
+    optimised = gifopt.optimise(data)
+    elapsed = time.perf_counter() - start
+    # traced separately, tracing slows the optimiser down
+    tracemalloc.start()
+    gifopt.optimise(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'bytes': len(data),
+        'optimised': len(optimised),
+        'seconds': round(elapsed, 3),
+        'bytes_per_second': round(len(data) / elapsed),
+        'peak_traced_mb': round(peak / 2 ** 20, 1),
+        'max_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+if __name__ == '__main__':
+    main()
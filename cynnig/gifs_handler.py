@@ -0,0 +1,513 @@
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CWD, 'lib'))
+
+from clips import is_priority, load_priorities, parse_clip_key, \
+    prioritise, thumbnail_key, thumbnail_output_key
+import clients
+import gifopt
+import idempotency as idempotency_store
+from metrics import Metrics
+import rocketchat
+from secretstore import SecretStore
+
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from lambda_types import LambdaContext, S3UpdateEvent, TranscoderJobStatus, \
+    SNSEvent, SQSEvent, SQSBatchResponse, JobState, DeliveryReport
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+metrics = Metrics(os.environ.get('METRICS_NAMESPACE'))
+secrets = SecretStore(lambda name: metrics.instrument(clients.client(name)),
+                      ttl=float(os.environ.get('SECRETS_TTL', 900)))
+
+idempotency = idempotency_store.from_url(
+    os.environ.get('IDEMPOTENCY_STORE', 'memory'),
+    lambda name: metrics.instrument(clients.client(name)),
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+    lease=float(os.environ.get('IDEMPOTENCY_LEASE', 900)))
+
+# seconds kept in reserve at the end of an invocation
+DEADLINE_MARGIN = 1.0
+
+# variables which hold KMS ciphertext without the kms: prefix
+ENCRYPTED_VARIABLES = ('ROCKET_PASSWORD',)
+
+# how outputs are sent to a chat room, see delivery_mode
+DELIVERY_MODES = ('upload', 'link')
+
+# value of a thumbnail's record while it's posted, the id of its
+# message replaces it
+THUMBNAIL_POSTING = 'posting'
+
+# camera id -> high|normal, see clips.prioritise
+camera_priorities = load_priorities(os.environ.get('CAMERA_PRIORITY'))
+
+# a pooled connection for each concurrent download from S3
+clients.configure(max_pool_connections=max(
+    int(os.environ.get('DELIVERY_WORKERS', 4)),
+    int(os.environ.get('S3_CONCURRENCY', 2))))
+
+
+@metrics.handler
+def new_motion_gifs_handler(
+        event: Union[SNSEvent, S3UpdateEvent, SQSEvent],
+        context: LambdaContext
+) -> Union[List[DeliveryReport], SQSBatchResponse]:
+    """AWS Lambda handler which receives notifications about new GIFs
+    and sends them to a configured chat room
+
+    When thumbnails are enabled (THUMBNAIL_FORMAT), the first thumbnail
+    of a job is posted as soon as it's available: on the PROGRESSING
+    notification or when S3 reports it landed in the output bucket.
+    The GIF is then posted as a reply in the thread of that message
+    once the job completes.
+
+    The notifications either come from SNS directly or in a batch of
+    SQS messages, which the queue's batching window collects over
+    DIGEST_WINDOW so a digest spans many jobs (see digest_window).
+    Thumbnails aren't posted while outputs are digested. For SQS the
+    result lists the messages with a failed delivery
+    (batchItemFailures). Otherwise the handler raises once the rest is
+    delivered when any delivery failed, so Lambda retries the event.
+
+    """
+    logger.debug('EVENT: %s', event)
+    clients.configure(context)
+    records = event['Records']
+    malformed: List[str] = []
+    queued = is_sqs_event(event)
+    if queued:
+        records, malformed = sns_records(event)
+
+    rocket = secrets.resolve(
+        {name: value for name, value in os.environ.items()
+         if name.startswith('ROCKET_')},
+        encrypted=ENCRYPTED_VARIABLES)
+    username = rocket['ROCKET_USERNAME']
+    password = rocket['ROCKET_PASSWORD']
+    server_url = rocket['ROCKET_SERVER']
+    room_id = rocket['ROCKET_ROOM_ID']
+
+    chat = rocketchat.get_client(
+        server_url, username=username, password=password,
+        token_cache=rocket.get('ROCKET_TOKEN_CACHE'),
+        timer=metrics.timer if metrics.enabled else None)
+
+    s3 = metrics.instrument(clients.client('s3'))
+    bucket = os.environ['PIPELINE_BUCKET']
+
+    # digests replace the thumbnail messages, see digest_window
+    thumbnail_format = '' if digest_window(room_id) else \
+        os.environ.get('THUMBNAIL_FORMAT', '')
+    keys: List[str] = []
+    message_ids: Dict[str, str] = {}
+    thumbnails: Dict[str, str] = {}
+    # thumbnails S3 reported, the others may not be written yet
+    written: List[str] = []
+    # SQS message of each output and thumbnail
+    sources: Dict[str, str] = {}
+    for record in records:
+        if 's3' in record:
+            thumbnail = record['s3']['object']['key']
+            output_key = thumbnail_output_key(thumbnail)
+            if output_key and thumbnail_format:
+                thumbnails[output_key] = thumbnail
+                written.append(thumbnail)
+            continue
+        job: TranscoderJobStatus = json.loads(record['Sns']['Message'])
+        state = JobState(job['state'])
+        if state is JobState.PROGRESSING and thumbnail_format:
+            for output in job['outputs']:
+                if output.get('thumbnailPattern'):
+                    thumbnails[output['key']] = thumbnail_key(
+                        output['key'], thumbnail_format)
+                    sources[thumbnails[output['key']]] = \
+                        record.get('messageId', '')
+        elif state is JobState.COMPLETED:
+            for output in job['outputs']:
+                keys.append(output['key'])
+                message_ids[output['key']] = record['Sns'].get('MessageId', '')
+                sources[output['key']] = record.get('messageId', '')
+
+    deadline = invocation_deadline(context)
+    report = deliver_thumbnails(s3, bucket, chat, room_id, thumbnails,
+                                deadline=deadline, written=written)
+    report += deliver_outputs(s3, bucket, chat, room_id, keys,
+                              deadline=deadline, message_ids=message_ids)
+    logger.info('REPORT: %s', report)
+    if not queued:
+        failures = [result['key'] for result in report
+                    if result['status'] == 'FAILED']
+        if failures:
+            raise RuntimeError('failed to deliver {}'.format(
+                ', '.join(failures)))
+        return report
+
+    failed = malformed + [sources[result['key']] for result in report
+                          if result['status'] == 'FAILED']
+    return {'batchItemFailures': [{'itemIdentifier': message_id}
+                                  for message_id in dict.fromkeys(failed)]}
+
+
+def is_sqs_event(event: Union[SNSEvent, S3UpdateEvent, SQSEvent]) -> bool:
+    records = event.get('Records') or [{}]
+    return records[0].get('eventSource') == 'aws:sqs'
+
+
+def sns_records(event: SQSEvent) -> Tuple[List[Dict], List[str]]:
+    """SNS records of the notifications in a batch of SQS messages,
+    each with the messageId of its message, and the ids of messages
+    which couldn't be parsed
+
+    Messages are SNS envelopes, or the notification itself when the
+    subscription uses raw message delivery.
+
+    """
+    records: List[Dict] = []
+    malformed: List[str] = []
+    for message in event['Records']:
+        try:
+            body = json.loads(message['body'])
+            if 'Message' in body:
+                sns = {'MessageId': body.get('MessageId',
+                                             message['messageId']),
+                       'Message': body['Message']}
+            else:
+                sns = {'MessageId': message['messageId'],
+                       'Message': message['body']}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error('malformed message %s: %s', message['messageId'], e)
+            malformed.append(message['messageId'])
+            continue
+        records.append({'Sns': sns, 'messageId': message['messageId']})
+    return records, malformed
+
+
+def deliver_thumbnails(s3, bucket: str, chat: rocketchat.RocketChat,
+                       room_id: str, thumbnails: Dict[str, str],
+                       deadline: Optional[float] = None,
+                       written: Sequence[str] = ()
+                       ) -> List[DeliveryReport]:
+    """Uploads the first thumbnail of each output (GIF key to
+    thumbnail key) and records the id of its message
+
+    A thumbnail is posted once, and not at all when its GIF has
+    already been delivered. Thumbnails other than the `written` ones
+    S3 reported are looked up first, one which isn't written yet is
+    skipped and posted when S3 reports it. Thumbnails of high priority
+    cameras are posted first.
+
+    """
+    report: List[DeliveryReport] = []
+    for output_key, thumbnail in sorted(
+            thumbnails.items(),
+            key=lambda item: not is_priority(item[0], camera_priorities)):
+        try:
+            if thumbnail not in written and \
+               not object_exists(s3, bucket, thumbnail):
+                logger.info('%s is not written yet', thumbnail)
+                report.append({'key': thumbnail, 'status': 'SKIPPED'})
+                continue
+        except Exception as e:
+            logger.error('failed to deliver %s: %s', thumbnail, e,
+                         exc_info=True)
+            report.append({'key': thumbnail, 'status': 'FAILED',
+                           'error': str(e)})
+            continue
+        if not idempotency.claim('thumb:' + output_key, THUMBNAIL_POSTING):
+            report.append({'key': thumbnail, 'status': 'SKIPPED'})
+            continue
+        # looked up after the claim, so a GIF delivered at the same
+        # time either sees the claim or is seen here
+        if idempotency.get('gif:' + output_key) is not None:
+            idempotency.release('thumb:' + output_key)
+            report.append({'key': thumbnail, 'status': 'SKIPPED'})
+            continue
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=thumbnail)
+            response = chat.upload(room_id, thumbnail, obj['Body'],
+                                   size=obj['ContentLength'],
+                                   deadline=deadline)
+        except s3.exceptions.NoSuchKey:
+            idempotency.release('thumb:' + output_key)
+            logger.info('%s is not written yet', thumbnail)
+            report.append({'key': thumbnail, 'status': 'SKIPPED'})
+            continue
+        except Exception as e:
+            idempotency.release('thumb:' + output_key)
+            logger.error('failed to deliver %s: %s', thumbnail, e,
+                         exc_info=True)
+            report.append({'key': thumbnail, 'status': 'FAILED',
+                           'error': str(e)})
+            continue
+        message_id = (response or {}).get('message', {}).get('_id')
+        idempotency.complete('thumb:' + output_key, message_id or '')
+        report.append({'key': thumbnail, 'status': 'SUCCEEDED'})
+    return report
+
+
+def object_exists(s3, bucket: str, key: str) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+def deliver_outputs(s3, bucket: str, chat: rocketchat.RocketChat,
+                    room_id: str, keys: List[str],
+                    deadline: Optional[float] = None,
+                    message_ids: Optional[Dict[str, str]] = None
+                    ) -> List[DeliveryReport]:
+    """Fetches outputs from S3 and uploads them to the chat room
+
+    Deliveries run on a small pool, so fetching one output overlaps
+    with uploading another. At most S3_CONCURRENCY outputs are read
+    from S3 at once, until their upload has consumed them, and at most
+    CHAT_CONCURRENCY requests go to the chat server. A failed delivery
+    doesn't stop the others. Outputs which were already delivered (the
+    SNS message id they came with is recorded) are skipped. Outputs
+    whose thumbnail was posted reply in the thread of its message, an
+    output whose thumbnail is being posted fails so it's retried once
+    the message is there. Outputs of a camera within the digest_window
+    are posted in one message, except for high priority cameras whose
+    outputs are delivered first on their own.
+
+    In `link` delivery mode (see delivery_mode) outputs are posted as
+    presigned links and never pass through the function, uploading
+    them is the fallback when a link can't be presigned. A failed post
+    isn't retried as an upload, the message may have been posted.
+
+    """
+    message_ids = message_ids or {}
+    window = digest_window(room_id)
+    # digests replace the thumbnail messages, see digest_window
+    thumbnail_format = '' if window else os.environ.get('THUMBNAIL_FORMAT')
+
+    def thumbnail_messages(group: List[str]) -> Dict[str, str]:
+        if not thumbnail_format:
+            return {}
+        return {key: message_id for key, message_id in (
+                    (key, idempotency.get('thumb:' + key)) for key in group)
+                if message_id}
+
+    posted = thumbnail_messages(keys)
+    s3_slots = threading.BoundedSemaphore(
+        int(os.environ.get('S3_CONCURRENCY', 2)))
+    chat_slots = threading.BoundedSemaphore(
+        int(os.environ.get('CHAT_CONCURRENCY', 2)))
+
+    mode = delivery_mode(room_id)
+    pending = [key for key in keys if key not in posted]
+    groups = prioritise(pending, window, camera_priorities)
+    groups.extend([key] for key in keys if key in posted)
+    groups.sort(key=lambda group: not is_priority(group[0],
+                                                  camera_priorities))
+
+    def deliver(group: List[str]) -> List[str]:
+        claimed = [key for key in group
+                   if idempotency.claim('gif:' + key, message_ids.get(key, ''))]
+        clip = parse_clip_key(group[0])
+        dimensions = {'Camera': clip.camera} if clip else {}
+        try:
+            # looked up again after the claim, see deliver_thumbnails
+            thumbnails = thumbnail_messages(claimed)
+            posting = [key for key, message_id in thumbnails.items()
+                       if message_id == THUMBNAIL_POSTING]
+            if posting:
+                raise RuntimeError('thumbnail of {} is being posted'.format(
+                    ', '.join(posting)))
+            with metrics.timer('deliver', **dimensions):
+                if len(claimed) == 1 and claimed[0] in thumbnails:
+                    reply(claimed[0], thumbnails[claimed[0]])
+                elif len(claimed) == 1 and mode == 'link':
+                    link(claimed[0])
+                elif len(claimed) == 1:
+                    upload(claimed[0])
+                elif claimed:
+                    post_digest(claimed)
+        except Exception:
+            for key in claimed:
+                idempotency.release('gif:' + key)
+            raise
+        for key in claimed:
+            idempotency.complete('gif:' + key, message_ids.get(key, ''))
+        return claimed
+
+    def upload(key: str, **message: Optional[str]) -> Dict:
+        # the body is streamed from S3 during the upload, so the S3 slot
+        # is held until it's consumed
+        with s3_slots:
+            source, obj = fetch_gif(s3, bucket, key, deadline=deadline)
+            with chat_slots:
+                return chat.upload(room_id, key, obj['Body'],
+                                   size=obj['ContentLength'],
+                                   reopen=lambda: s3.get_object(
+                                       Bucket=bucket, Key=source)['Body'],
+                                   deadline=deadline, **message)
+
+    def link(key: str, thread_id: Optional[str] = None) -> None:
+        try:
+            url = presign(s3, bucket, key)
+        except (ClientError, BotoCoreError) as e:
+            logger.warning('failed to presign %s, uploading it: %s', key, e)
+            upload(key, thread_id=thread_id)
+            return
+        attachments = [{'title': key, 'image_url': url}]
+        with chat_slots:
+            chat.post_message(room_id, attachments=attachments,
+                              deadline=deadline, thread_id=thread_id)
+
+    def reply(key: str, thread_id: str) -> None:
+        if mode == 'upload':
+            upload(key, thread_id=thread_id)
+        else:
+            link(key, thread_id)
+
+    def post_digest(group: List[str]) -> None:
+        clip = parse_clip_key(group[0])
+        text = '{} motion clips from camera {}'.format(
+            len(group), clip.camera if clip else '')
+        attachments = [{'title': key, 'image_url': presign(s3, bucket, key)}
+                       for key in group]
+        with chat_slots:
+            chat.post_message(room_id, text, attachments=attachments,
+                              deadline=deadline)
+
+    workers = int(os.environ.get('DELIVERY_WORKERS', 4))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(deliver, group) for group in groups]
+
+    report: Dict[str, DeliveryReport] = {}
+    for group, future in zip(groups, futures):
+        try:
+            delivered = future.result()
+        except Exception as e:
+            logger.error('failed to deliver %s: %s', ', '.join(group), e,
+                         exc_info=True)
+            for key in group:
+                report[key] = {'key': key, 'status': 'FAILED',
+                               'error': str(e)}
+            continue
+        for key in group:
+            if key not in delivered:
+                logger.info('%s is already delivered', key)
+            status = 'SUCCEEDED' if key in delivered else 'SKIPPED'
+            report[key] = {'key': key, 'status': status}
+    return [report[key] for key in keys]
+
+
+def fetch_gif(s3, bucket: str, key: str,
+              deadline: Optional[float] = None) -> Tuple[str, Dict]:
+    """Key and GetObject response of the GIF to upload for an output
+
+    With GIF_OPTIMISE set the optimised copy (gifopt.sibling_key) is
+    uploaded instead. It's made from the original the first time the
+    output is delivered and stored next to it, so a GIF is optimised
+    once. Optimised copies themselves, GIFs larger than
+    GIF_OPTIMISE_MAX_BYTES, GIFs which can't be optimised and ones whose
+    optimisation isn't expected to finish in half the time left before
+    `deadline` (at GIF_OPTIMISE_RATE bytes per second) are uploaded as
+    they are.
+
+    """
+    if not os.environ.get('GIF_OPTIMISE') or not gifopt.available() or \
+       gifopt.is_sibling(key):
+        return key, s3.get_object(Bucket=bucket, Key=key)
+    sibling = gifopt.sibling_key(key)
+    try:
+        return sibling, s3.get_object(Bucket=bucket, Key=sibling)
+    except s3.exceptions.NoSuchKey:
+        pass
+
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    limit = int(os.environ.get('GIF_OPTIMISE_MAX_BYTES', 2097152))
+    if obj['ContentLength'] > limit:
+        return key, obj
+    rate = float(os.environ.get('GIF_OPTIMISE_RATE', 393216))
+    if deadline is not None and \
+       obj['ContentLength'] / rate > (deadline - time.monotonic()) / 2:
+        logger.info('no time left to optimise %s', key)
+        return key, obj
+    data = obj['Body'].read()
+    try:
+        with metrics.timer('optimise'):
+            optimised = gifopt.optimise(data)
+    except ValueError as e:
+        logger.warning('failed to optimise %s: %s', key, e)
+        return key, {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+    logger.debug('optimised %s: %d -> %d bytes', key, len(data),
+                 len(optimised))
+    s3.put_object(Bucket=bucket, Key=sibling, Body=optimised,
+                  ContentType='image/gif')
+    return sibling, {'Body': io.BytesIO(optimised),
+                     'ContentLength': len(optimised)}
+
+
+def delivery_mode(room_id: str) -> str:
+    """How outputs are sent to a room, `upload` or `link`
+
+    DELIVERY_MODE is either a mode for all rooms or a JSON object of
+    room ids to modes, e.g. {"GENERAL": "link", "*": "upload"}.
+
+    """
+    setting = os.environ.get('DELIVERY_MODE', '').strip()
+    if setting.startswith('{'):
+        modes = json.loads(setting)
+        setting = modes.get(room_id, modes.get('*', ''))
+    mode = setting or 'upload'
+    if mode not in DELIVERY_MODES:
+        raise ValueError('unknown delivery mode {!r}'.format(mode))
+    return mode
+
+
+def digest_window(room_id: str) -> float:
+    """Seconds between the outputs of a camera which are posted in one
+    digest message, 0 when they aren't
+
+    Only links are digested (DIGEST_WINDOW): a message carries many
+    of them, while every upload is a message of its own, so batching
+    uploads would only delay them. Thumbnails aren't posted while
+    outputs are digested, the digest replaces their messages.
+
+    """
+    if delivery_mode(room_id) != 'link':
+        return 0
+    return float(os.environ.get('DIGEST_WINDOW', 0))
+
+
+def presign(s3, bucket: str, key: str) -> str:
+    """Presigned GET url of an output
+
+    The url stops working when it expires (LINK_EXPIRY seconds) or
+    when the function's role credentials it is signed with expire,
+    whichever comes first.
+
+    """
+    return s3.generate_presigned_url(
+        'get_object', Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=int(os.environ.get('LINK_EXPIRY', 3600)))
+
+
+def invocation_deadline(context: Optional[LambdaContext]) -> Optional[float]:
+    """time.monotonic() value by which retries have to stop, so the
+    handler still reports its results before the function times out
+
+    """
+    if context is None:
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000.0
+    return time.monotonic() + remaining - DEADLINE_MARGIN
@@ -0,0 +1,146 @@
+import threading
+
+from typing import Any, Dict, FrozenSet, Optional
+
+# upper bounds of the timeouts, in seconds
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+# boto3 takes longer to import than the rest of a handler, it's
+# imported on the first request for a client instead of at cold start
+_session = None
+_clients: Dict[str, Any] = {}
+_remaining: Optional[float] = None
+_options: Dict[str, Any] = {
+    'connect_timeout': CONNECT_TIMEOUT,
+    'read_timeout': READ_TIMEOUT,
+    'retries': {'mode': 'adaptive', 'max_attempts': 3},
+    'tcp_keepalive': True,
+}
+# error codes of requests botocore doesn't retry, by service
+_caller_retries: Dict[str, FrozenSet[str]] = {}
+_lock = threading.Lock()
+
+# options of the clients of single services on top of _options; the
+# video handler rate limits CreateJob calls itself (CREATE_JOB_RATE),
+# not with botocore's adaptive mode as well
+SERVICE_OPTIONS: Dict[str, Dict[str, Any]] = {
+    'elastictranscoder': {'retries': {'mode': 'standard', 'max_attempts': 3}},
+}
+
+
+def configure(context: Any = None, **options: Any) -> None:
+    """Sets botocore Config options of the clients created from now on
+
+    With a Lambda context the connect and read timeouts are capped to
+    a share of the time the invocation has left, so a stalled
+    connection fails while there is still time to retry it. Clients
+    are kept for the lifetime of the container, so this matters for
+    the invocation which creates them.
+
+    """
+    global _remaining
+    with _lock:
+        _options.update(options)
+        if context:
+            _remaining = context.get_remaining_time_in_millis() / 1000.0
+
+
+def retried_by_caller(name: str, codes: FrozenSet[str]) -> None:
+    """Stops botocore retrying the requests of `name` clients created
+    from now on which fail with one of the error `codes`, for callers
+    which retry them themselves, e.g. throttled requests with
+    throttling.retry_throttled; other errors are still retried
+
+    """
+    with _lock:
+        _caller_retries[name] = codes
+
+
+def config(name: Optional[str] = None) -> Any:
+    """botocore Config of a new client of the `name` service"""
+    from botocore.config import Config
+    with _lock:
+        options = dict(_options, **SERVICE_OPTIONS.get(name, {}))
+        if _remaining is not None:
+            options['connect_timeout'] = max(
+                1.0, min(options['connect_timeout'], _remaining / 4))
+            options['read_timeout'] = max(
+                1.0, min(options['read_timeout'], _remaining / 2))
+    return Config(**options)
+
+
+def session() -> Any:
+    """boto3 session shared by the clients of a container"""
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.Session()
+        return _session
+
+
+def client(name: str) -> Any:
+    """Client of an AWS service, created on first use and kept for the
+    lifetime of the container
+
+    """
+    try:
+        return _clients[name]
+    except KeyError:
+        pass
+    service = session().client(name, config=config(name))
+    codes = _caller_retries.get(name)
+    if codes:
+        skip_retries(service, codes)
+    with _lock:
+        return _clients.setdefault(name, service)
+
+
+def skip_retries(service: Any, codes: FrozenSet[str]) -> None:
+    """Replaces the standard mode retry handler of a client with one
+    which doesn't retry errors with one of the `codes`, others are
+    retried as configured
+
+    """
+    from botocore.retries import quota, standard
+
+    class Conditions(standard.StandardRetryConditions):
+        def is_retryable(self, context: Any) -> bool:
+            return context.get_error_code() not in codes and \
+                super().is_retryable(context)
+
+    events = service.meta.events
+    max_attempts = service.meta.config.retries['total_max_attempts']
+    name = service.meta.service_model.service_id.hyphenize()
+    retry_quota = standard.RetryQuotaChecker(quota.RetryQuota())
+    handler = standard.RetryHandler(
+        retry_policy=standard.RetryPolicy(
+            retry_checker=Conditions(max_attempts=max_attempts),
+            retry_backoff=standard.ExponentialBackoff()),
+        retry_event_adapter=standard.RetryEventAdapter(),
+        retry_quota=retry_quota)
+    events.register('after-call.' + name, retry_quota.release_retry_quota)
+    # the unique id botocore registers its own handler with
+    events.unregister('needs-retry.' + name,
+                      unique_id='retry-config-' + name)
+    events.register('needs-retry.' + name, handler.needs_retry,
+                    unique_id='retry-config-' + name)
+
+
+def inject(name: str, service: Any) -> None:
+    """Makes `client(name)` return `service`, e.g. a client wrapped in
+    botocore's Stubber or a mock
+
+    """
+    with _lock:
+        _clients[name] = service
+
+
+def reset() -> None:
+    """Forgets the session and the clients created so far"""
+    global _session, _remaining
+    with _lock:
+        _session = None
+        _remaining = None
+        _clients.clear()
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+# motion names recordings <camera>-<%Y%m%d%H%M%S>.<ext>
+CLIP_NAME = re.compile(r'(?P<camera>[^/]+?)-(?P<timestamp>\d{14})\.\w+$')
+
+# upper bound of inputs concatenated into a single transcoding job
+MAX_JOB_INPUTS = 50
+
+# elastic transcoder replaces {count} of a ThumbnailPattern with 00001,
+# 00002, ...; outputs use the pattern <name>-{count}
+THUMBNAIL_PATTERN = '{}-{{count}}'
+FIRST_THUMBNAIL = '-00001'
+
+# priorities of cameras, cameras missing from the map are normal
+HIGH_PRIORITY = 'high'
+NORMAL_PRIORITY = 'normal'
+PRIORITIES = (HIGH_PRIORITY, NORMAL_PRIORITY)
+
+
+class Clip(NamedTuple):
+    key: str
+    camera: str
+    timestamp: datetime
+
+
+def parse_clip_key(key: str) -> Optional[Clip]:
+    """Parses camera and time from a recording or output key, e.g.
+    01-20180730195708.mkv or 01-20180730195708.gif
+
+    """
+    match = CLIP_NAME.search(os.path.basename(key))
+    if not match:
+        return None
+    try:
+        timestamp = datetime.strptime(match.group('timestamp'),
+                                      '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+    return Clip(key, match.group('camera'), timestamp)
+
+
+def thumbnail_key(key: str, extension: str) -> str:
+    """Key of the first thumbnail of an output, e.g.
+    01-20180730195708.gif -> 01-20180730195708-00001.png
+
+    """
+    name, _ = os.path.splitext(key)
+    return '{}{}.{}'.format(name, FIRST_THUMBNAIL, extension)
+
+
+def thumbnail_output_key(key: str) -> Optional[str]:
+    """GIF key a first thumbnail belongs to, the reverse of
+    thumbnail_key
+
+    """
+    name, _ = os.path.splitext(key)
+    if not name.endswith(FIRST_THUMBNAIL):
+        return None
+    return '{}.gif'.format(name[:-len(FIRST_THUMBNAIL)])
+
+
+def coalesce(keys: List[str], window: float,
+             max_inputs: int = MAX_JOB_INPUTS) -> List[List[str]]:
+    """Groups back-to-back clips of one camera
+
+    A clip joins the group of the previous clip from the same camera
+    when it starts at most `window` seconds after it. Groups keep the
+    order of their first clip in `keys`, clips in a group are ordered
+    by time. Keys which aren't motion recordings stay on their own.
+
+    """
+    groups: List[List[int]] = []
+    last_group: Dict[str, List[int]] = {}
+    clips = {i: parse_clip_key(key) for i, key in enumerate(keys)}
+    recordings = sorted((i for i, clip in clips.items() if clip),
+                        key=lambda i: (clips[i].timestamp, i))
+    for i in recordings:
+        clip = clips[i]
+        group = last_group.get(clip.camera)
+        if group and len(group) < max_inputs and \
+           (clip.timestamp - clips[group[-1]].timestamp).total_seconds() \
+           <= window:
+            group.append(i)
+        else:
+            group = [i]
+            groups.append(group)
+            last_group[clip.camera] = group
+
+    groups.extend([i] for i, clip in clips.items() if clip is None)
+    groups.sort(key=min)
+    return [[keys[i] for i in group] for group in groups]
+
+
+def load_priorities(spec: Optional[str]) -> Dict[str, str]:
+    """Parses a JSON object of camera ids to priorities, e.g.
+    {"01": "high", "02": "normal"}
+
+    """
+    if not spec:
+        return {}
+    priorities = json.loads(spec)
+    unknown = set(priorities.values()) - set(PRIORITIES)
+    if unknown:
+        raise ValueError('unknown camera priorities {}'.format(
+            ', '.join(sorted(unknown))))
+    return priorities
+
+
+def is_priority(key: str, priorities: Dict[str, str]) -> bool:
+    """Whether a recording or output comes from a high priority camera"""
+    clip = parse_clip_key(key)
+    return bool(clip) and priorities.get(clip.camera) == HIGH_PRIORITY
+
+
+def prioritise(keys: List[str], window: float,
+               priorities: Dict[str, str]) -> List[List[str]]:
+    """Groups clips like coalesce, except that clips of high priority
+    cameras stay on their own and come first
+
+    Work is started in the order of the groups, so high priority clips
+    get the first claim on workers and rate limits.
+
+    """
+    urgent = [key for key in keys if is_priority(key, priorities)]
+    rest = [key for key in keys if not is_priority(key, priorities)]
+    if window > 0:
+        groups = coalesce(rest, window)
+    else:
+        groups = [[key] for key in rest]
+    return [[key] for key in urgent] + groups
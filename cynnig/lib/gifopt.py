@@ -0,0 +1,610 @@
+import importlib.util
+import os
+import struct
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, \
+    NamedTuple, Optional, Tuple
+
+# palette index of pixels which didn't change since the frame before
+TRANSPARENT = 255
+
+# colours of the global palette besides the transparent one
+PALETTE_SIZE = 255
+
+MAX_CODE = 4096
+
+# bits of the longest LZW code
+MAX_BITS = 12
+
+# frames whose pixels are counted when the colours of a GIF have to be
+# reduced to a palette
+SAMPLE_FRAMES = 8
+
+# runs of equal pixels at least this long are LZW encoded a run at a
+# time instead of a pixel at a time
+RUN_LENGTH = 8
+
+
+def available() -> bool:
+    """Whether NumPy is installed, GIFs are delivered as they are
+    without it
+
+    """
+    return importlib.util.find_spec('numpy') is not None
+
+
+def sibling_key(key: str) -> str:
+    """Key of the optimised copy of a GIF, next to the original"""
+    name, extension = os.path.splitext(key)
+    return '{}.optimised{}'.format(name, extension or '.gif')
+
+
+def is_sibling(key: str) -> bool:
+    """Whether the key is of an optimised copy"""
+    name, _ = os.path.splitext(key)
+    return name.endswith('.optimised')
+
+
+class Animation(NamedTuple):
+    """Frames of a GIF as composited RGB images (count, height, width,
+    3) and their delays in hundredths of a second
+
+    """
+    frames: Any
+    delays: List[int]
+    loop: Optional[int]
+
+
+class Screen(NamedTuple):
+    """Logical screen of a GIF"""
+    width: int
+    height: int
+    background: Any
+    loop: Optional[int]
+
+
+class Frame(NamedTuple):
+    """Image block of a GIF, its pixels still LZW compressed, with the
+    graphic control extension before it
+
+    """
+    left: int
+    top: int
+    width: int
+    height: int
+    interlaced: bool
+    colors: Any
+    min_size: int
+    lzw: bytes
+    delay: int
+    disposal: int
+    transparent: Optional[int]
+
+
+def optimise(data: bytes) -> bytes:
+    """Re-encodes a GIF with one global palette and frames cut down to
+    the pixels which changed, unchanged pixels inside the cut are
+    transparent so they compress to long runs
+
+    Frames are decoded one at a time as indices into the new palette,
+    so memory stays at a few frames whatever the length of the GIF.
+    The original is returned when it's already smaller.
+
+    """
+    import numpy as np
+
+    screen, frames = parse(data)
+    palette = sample_palette(screen, frames)
+    mappings: Dict[bytes, Any] = {}
+
+    def mapping(colors: Any) -> Any:
+        key = colors.tobytes()
+        if key not in mappings:
+            mappings[key] = _lookup(nearest(colors, palette).astype(np.uint8))
+        return mappings[key]
+
+    canvas = np.empty((screen.height, screen.width), np.uint8)
+    canvas[:] = mapping(screen.background[None])[0]
+    optimised = _encode(screen.width, screen.height, palette, screen.loop,
+                        composite(frames, canvas, mapping))
+    return optimised if len(optimised) < len(data) else data
+
+
+def decode(data: bytes) -> Animation:
+    import numpy as np
+
+    screen, frames = parse(data)
+    canvas = np.empty((screen.height, screen.width, 3), np.uint8)
+    canvas[:] = screen.background
+    composited = list(composite(frames, canvas, _lookup))
+    return Animation(np.stack([pixels for pixels, _ in composited]),
+                     [delay for _, delay in composited], screen.loop)
+
+
+def parse(data: bytes) -> Tuple[Screen, List[Frame]]:
+    """Logical screen and image blocks of a GIF, without decompressing
+    the images
+
+    """
+    import numpy as np
+
+    if data[:6] not in (b'GIF87a', b'GIF89a'):
+        raise ValueError('not a GIF')
+    width, height, packed, background = struct.unpack_from('<HHBB', data, 6)
+    offset = 13
+    palette = None
+    if packed & 0x80:
+        palette, offset = _color_table(data, offset, packed)
+    background_color = palette[background] if palette is not None \
+        and background < len(palette) else np.zeros(3, np.uint8)
+
+    frames: List[Frame] = []
+    loop = None
+    disposal, delay, transparent = 0, 0, None
+    while offset < len(data):
+        block = data[offset]
+        offset += 1
+        if block == 0x3B:
+            break
+        if block == 0x21:
+            label = data[offset]
+            chunks, offset = _sub_blocks(data, offset + 1)
+            if label == 0xF9 and chunks and len(chunks[0]) >= 4:
+                flags, delay, index = struct.unpack_from('<BHB', chunks[0])
+                disposal = (flags >> 2) & 7
+                transparent = index if flags & 1 else None
+            elif label == 0xFF and chunks and \
+                    chunks[0][:11] in (b'NETSCAPE2.0', b'ANIMEXTS1.0') \
+                    and len(chunks) > 1 and len(chunks[1]) >= 3:
+                loop = struct.unpack_from('<H', chunks[1], 1)[0]
+            continue
+        if block != 0x2C:
+            raise ValueError('unknown GIF block {:#x}'.format(block))
+
+        left, top, w, h, packed = struct.unpack_from('<HHHHB', data, offset)
+        offset += 9
+        colors = palette
+        if packed & 0x80:
+            colors, offset = _color_table(data, offset, packed)
+        if colors is None:
+            raise ValueError('GIF frame without a palette')
+        min_size = data[offset]
+        chunks, offset = _sub_blocks(data, offset + 1)
+        frames.append(Frame(left, top, w, h, bool(packed & 0x40), colors,
+                            min_size, b''.join(chunks), delay, disposal,
+                            transparent))
+        disposal, delay, transparent = 0, 0, None
+
+    if not frames:
+        raise ValueError('GIF without frames')
+    return Screen(width, height, background_color, loop), frames
+
+
+def frame_indices(frame: Frame) -> Any:
+    """Decompressed pixels of a frame, indices into its colour table"""
+    import numpy as np
+
+    pixels = lzw_decode(frame.lzw, frame.min_size, frame.width * frame.height)
+    # a short image block leaves the rest of the frame at index 0
+    indices = np.zeros(frame.width * frame.height, np.uint8)
+    indices[:len(pixels)] = np.frombuffer(pixels, np.uint8)
+    indices = indices.reshape(frame.height, frame.width)
+    return _deinterlace(indices) if frame.interlaced else indices
+
+
+def composite(frames: List[Frame], canvas: Any,
+              mapping: Callable[[Any], Any]) -> Iterator[Tuple[Any, int]]:
+    """Draws the frames one after the other onto the canvas and yields
+    a copy of it after each with the frame's delay
+
+    `mapping` turns a colour table into what the canvas holds for each
+    of the 256 indices, RGB colours or indices into another palette.
+    The canvas starts out filled with the background.
+
+    """
+    background = canvas[0, 0].copy()
+    for frame in frames:
+        colors = mapping(frame.colors)
+        pixels = frame_indices(frame)
+        previous = canvas.copy() if frame.disposal == 3 else None
+        region = canvas[frame.top:frame.top + frame.height,
+                        frame.left:frame.left + frame.width]
+        pixels = pixels[:region.shape[0], :region.shape[1]]
+        if frame.transparent is None:
+            region[:] = colors[pixels]
+        else:
+            opaque = pixels != frame.transparent
+            region[opaque] = colors[pixels[opaque]]
+        yield canvas.copy(), frame.delay
+
+        if frame.disposal == 2:
+            region[:] = background
+        elif previous is not None:
+            canvas[:] = previous
+
+
+def sample_palette(screen: Screen, frames: List[Frame]) -> Any:
+    """Palette of at most PALETTE_SIZE colours for the frames
+
+    The colours of the colour tables are used as they are when there
+    are few enough of them. Otherwise the pixels of SAMPLE_FRAMES
+    frames spread over the GIF are counted and their colours reduced
+    by a median cut weighted by the counts.
+
+    """
+    import numpy as np
+
+    tables = {frame.colors.tobytes(): frame.colors for frame in frames}
+    colors = np.unique(np.concatenate(
+        [_pack(table) for table in tables.values()] +
+        [_pack(screen.background[None])]))
+    if len(colors) <= PALETTE_SIZE:
+        return _unpack(colors)
+
+    step = max(1, -(-len(frames) // SAMPLE_FRAMES))
+    packed, counts = [], []
+    for frame in frames[::step]:
+        pixels = frame_indices(frame)
+        if frame.transparent is not None:
+            pixels = pixels[pixels != frame.transparent]
+        seen = np.bincount(pixels.reshape(-1), minlength=256)
+        table = _pack(frame.colors)
+        packed.append(table)
+        counts.append(seen[:len(table)])
+    sampled, inverse = np.unique(np.concatenate(packed), return_inverse=True)
+    weights = np.bincount(inverse.reshape(-1), np.concatenate(counts))
+    sampled, weights = sampled[weights > 0], weights[weights > 0]
+    if len(sampled) <= PALETTE_SIZE:
+        return _unpack(sampled)
+    return median_cut(_unpack(sampled), weights, PALETTE_SIZE)
+
+
+def encode(animation: Animation) -> bytes:
+    count, height, width, _ = animation.frames.shape
+    palette, indices = global_palette(animation.frames)
+    return _encode(width, height, palette, animation.loop,
+                   zip(indices, animation.delays))
+
+
+def _encode(width: int, height: int, palette: Any, loop: Optional[int],
+            frames: Iterable[Tuple[Any, int]]) -> bytes:
+    """GIF of frames given as indices into the palette, each frame is
+    cut down to the pixels which changed since the one before
+
+    """
+    import numpy as np
+
+    out = bytearray(b'GIF89a')
+    # global colour table of 256 entries, index 255 is transparent
+    out += struct.pack('<HHBBB', width, height, 0xF7, 0, 0)
+    table = np.zeros((256, 3), np.uint8)
+    table[:len(palette)] = palette
+    out += table.tobytes()
+    if loop is not None:
+        out += b'\x21\xFF\x0BNETSCAPE2.0\x03\x01'
+        out += struct.pack('<H', loop) + b'\x00'
+
+    def write(box: Tuple[int, int, int, int], pixels: Any,
+              delay: int) -> None:
+        left, top, w, h = box
+        # do not dispose, transparent pixels show the frame before
+        out.extend(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0x05, delay,
+                               TRANSPARENT, 0))
+        out.extend(struct.pack('<BHHHHB', 0x2C, left, top, w, h, 0))
+        out.extend(b'\x08')
+        out.extend(_blocks(lzw_encode(
+            np.ascontiguousarray(pixels).tobytes(), 8)))
+
+    previous = None
+    # the last frame is written once it's known the next isn't the same
+    pending: Optional[Tuple[Tuple[int, int, int, int], Any, int]] = None
+    for current, delay in frames:
+        if previous is None:
+            pending = ((0, 0, width, height), current, delay)
+            previous = current
+            continue
+        changed = current != previous
+        if not changed.any():
+            # a repeated frame only lengthens the one before it
+            box, pixels, before = pending
+            pending = (box, pixels, min(before + delay, 0xFFFF))
+            continue
+        write(*pending)
+        rows = np.flatnonzero(changed.any(axis=1))
+        columns = np.flatnonzero(changed.any(axis=0))
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = columns[0], columns[-1] + 1
+        pixels = current[y0:y1, x0:x1].copy()
+        pixels[~changed[y0:y1, x0:x1]] = TRANSPARENT
+        pending = ((x0, y0, x1 - x0, y1 - y0), pixels, delay)
+        previous = current
+    if pending is not None:
+        write(*pending)
+    out += b'\x3B'
+    return bytes(out)
+
+
+def global_palette(frames: Any) -> Tuple[Any, Any]:
+    """One palette of at most PALETTE_SIZE colours for all frames and
+    the frames as indices into it
+
+    Colours are exact when there are few enough of them, otherwise
+    they're reduced by a median cut weighted by how often they occur.
+
+    """
+    import numpy as np
+
+    colors, inverse, counts = np.unique(_pack(frames.reshape(-1, 3)),
+                                        return_inverse=True,
+                                        return_counts=True)
+    unique = _unpack(colors)
+    if len(unique) <= PALETTE_SIZE:
+        palette, mapping = unique, np.arange(len(unique))
+    else:
+        palette = median_cut(unique, counts, PALETTE_SIZE)
+        mapping = nearest(unique, palette)
+    indices = mapping.astype(np.uint8)[inverse.reshape(-1)]
+    return palette, indices.reshape(frames.shape[:3])
+
+
+def median_cut(colors: Any, counts: Any, size: int) -> Any:
+    import numpy as np
+
+    boxes = [np.arange(len(colors))]
+    while len(boxes) < size:
+        spans = [np.ptp(colors[box], axis=0).max() if len(box) > 1 else -1
+                 for box in boxes]
+        widest = int(np.argmax(spans))
+        if spans[widest] <= 0:
+            break
+        box = boxes.pop(widest)
+        channel = int(np.argmax(np.ptp(colors[box], axis=0)))
+        order = box[np.argsort(colors[box, channel], kind='stable')]
+        weights = np.cumsum(counts[order])
+        split = int(np.searchsorted(weights, weights[-1] / 2))
+        split = min(max(split, 1), len(order) - 1)
+        boxes += [order[:split], order[split:]]
+    return np.array([np.average(colors[box], axis=0, weights=counts[box])
+                     for box in boxes]).round().astype(np.uint8)
+
+
+def nearest(colors: Any, palette: Any, chunk: int = 4096) -> Any:
+    """Index of the closest palette colour of each colour"""
+    import numpy as np
+
+    palette = palette.astype(np.int32)
+    result = np.empty(len(colors), np.int64)
+    for start in range(0, len(colors), chunk):
+        part = colors[start:start + chunk].astype(np.int32)
+        distances = ((part[:, None, :] - palette[None, :, :]) ** 2).sum(-1)
+        result[start:start + chunk] = distances.argmin(axis=1)
+    return result
+
+
+def lzw_decode(data: bytes, min_size: int, count: int) -> bytes:
+    import numpy as np
+
+    # the MAX_BITS bits from each bit position, so reading a code is a
+    # lookup and a mask
+    bits = np.unpackbits(np.frombuffer(data, np.uint8), bitorder='little')
+    total = len(bits)
+    padded = np.concatenate([bits, np.zeros(MAX_BITS, np.uint8)])
+    windows = padded[:total].astype(np.uint16)
+    for shift in range(1, MAX_BITS):
+        windows |= padded[shift:shift + total].astype(np.uint16) << shift
+    codes = memoryview(windows.tobytes()).cast('H')
+
+    clear = 1 << min_size
+    end = clear + 1
+    # clear and end have no entries
+    table: List[Optional[bytes]] = [bytes([i]) for i in range(clear)]
+    table += [None, None]
+    available = len(table)
+    size = min_size + 1
+    mask, limit, stop = (1 << size) - 1, 1 << size, total - size
+    out = bytearray()
+    previous: Optional[bytes] = None
+    position = 0
+    while position <= stop:
+        code = codes[position] & mask
+        position += size
+        if code < available:
+            entry = table[code]
+            if entry is None:
+                if code == end:
+                    break
+                del table[end + 1:]
+                available = len(table)
+                size = min_size + 1
+                mask, limit, stop = (1 << size) - 1, 1 << size, total - size
+                previous = None
+                continue
+            if previous is not None and available < MAX_CODE:
+                table.append(previous + entry[:1])
+                available += 1
+        elif previous is not None:
+            entry = previous + previous[:1]
+            table.append(entry)
+            available += 1
+        else:
+            raise ValueError('invalid LZW code {}'.format(code))
+        out += entry
+        previous = entry
+        if available == limit and size < MAX_BITS:
+            size += 1
+            mask, limit, stop = (1 << size) - 1, 1 << size, total - size
+    return bytes(out[:count])
+
+
+def lzw_encode(data: bytes, min_size: int) -> bytes:
+    """LZW compressed data of a GIF image block, without the size
+    prefixes of its sub-blocks
+
+    Runs of equal bytes are found up front. Runs of at least
+    RUN_LENGTH take the code of the longest run of their byte in the
+    code table at once, the bytes between them are matched against
+    the table one at a time as usual.
+
+    """
+    import numpy as np
+
+    clear = 1 << min_size
+    end = clear + 1
+    codes: List[int] = [clear]
+    sizes: List[int] = [min_size + 1]
+    size = min_size + 1
+    next_code = end + 1
+    table: Dict[int, int] = {}
+    # codes of the runs of each byte, the code of b repeated k times
+    # is runs[b][k - 1]
+    runs: List[List[int]] = [[byte] for byte in range(256)]
+
+    def emit(code: int, following: Optional[int]) -> None:
+        """Writes a code and adds the table entry of it followed by
+        `following`, the first byte of the next code
+
+        """
+        nonlocal size, next_code, table, runs
+        codes.append(code)
+        sizes.append(size)
+        if following is None:
+            return
+        if next_code < MAX_CODE:
+            table[code << 8 | following] = next_code
+            run = runs[following]
+            if run[-1] == code:
+                run.append(next_code)
+            next_code += 1
+            if next_code > 1 << size and size < MAX_BITS:
+                size += 1
+        else:
+            codes.append(clear)
+            sizes.append(size)
+            table = {}
+            runs = [[byte] for byte in range(256)]
+            next_code = end + 1
+            size = min_size + 1
+
+    def match(part: bytes, prefix: Optional[int]) -> Optional[int]:
+        """Matches bytes against the table, returns the code of the
+        bytes matched since the last one written
+
+        """
+        for value in part:
+            if prefix is None:
+                prefix = value
+                continue
+            code = table.get(prefix << 8 | value)
+            if code is None:
+                emit(prefix, value)
+                prefix = value
+            else:
+                prefix = code
+        return prefix
+
+    pixels = np.frombuffer(data, np.uint8)
+    starts = np.flatnonzero(np.diff(pixels)) + 1
+    starts = np.concatenate([[0], starts]) if len(pixels) else starts
+    lengths = np.diff(np.append(starts, len(pixels)))
+    long_runs = np.flatnonzero(lengths >= RUN_LENGTH)
+
+    prefix: Optional[int] = None
+    position = 0
+    for start, length in zip(starts[long_runs].tolist(),
+                             lengths[long_runs].tolist()):
+        prefix = match(data[position:start], prefix)
+        value = data[start]
+        if prefix is not None:
+            emit(prefix, value)
+            prefix = None
+        position = start + length
+        while length:
+            run = runs[value]
+            taken = min(length, len(run))
+            length -= taken
+            if length:
+                following: Optional[int] = value
+            elif position < len(data):
+                following = data[position]
+            else:
+                following = None
+            emit(run[taken - 1], following)
+    prefix = match(data[position:], prefix)
+    if prefix is not None:
+        emit(prefix, None)
+    emit(end, None)
+
+    # codes are packed least significant bit first
+    widths = np.array(sizes)
+    bits = (np.array(codes)[:, None] >> np.arange(MAX_BITS)) & 1
+    bits = bits[np.arange(MAX_BITS) < widths[:, None]].astype(np.uint8)
+    return np.packbits(bits, bitorder='little').tobytes()
+
+
+def _color_table(data: bytes, offset: int, packed: int) -> Tuple[Any, int]:
+    import numpy as np
+
+    length = 3 << ((packed & 7) + 1)
+    table = np.frombuffer(data, np.uint8, length, offset).reshape(-1, 3)
+    return table, offset + length
+
+
+def _sub_blocks(data: bytes, offset: int) -> Tuple[List[bytes], int]:
+    chunks = []
+    while offset < len(data):
+        length = data[offset]
+        offset += 1
+        if not length:
+            break
+        chunks.append(data[offset:offset + length])
+        offset += length
+    return chunks, offset
+
+
+def _blocks(data: bytes) -> bytes:
+    out = bytearray()
+    for start in range(0, len(data), 255):
+        chunk = data[start:start + 255]
+        out.append(len(chunk))
+        out += chunk
+    out.append(0)
+    return bytes(out)
+
+
+def _lookup(colors: Any) -> Any:
+    """A colour table padded to 256 entries, indices past its end get
+    its last colour
+
+    """
+    import numpy as np
+
+    padded = np.empty((256,) + colors.shape[1:], colors.dtype)
+    padded[:len(colors)] = colors
+    padded[len(colors):] = colors[-1]
+    return padded
+
+
+def _pack(colors: Any) -> Any:
+    """RGB colours as one integer each"""
+    import numpy as np
+
+    rgb = colors.astype(np.uint32)
+    return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+
+def _unpack(packed: Any) -> Any:
+    import numpy as np
+
+    return np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF,
+                     packed & 0xFF], axis=1).astype(np.uint8)
+
+
+def _deinterlace(indices: Any) -> Any:
+    import numpy as np
+
+    rows = np.concatenate([np.arange(start, len(indices), step)
+                           for start, step in ((0, 8), (4, 8), (2, 4),
+                                               (1, 2))])
+    result = np.empty_like(indices)
+    result[rows] = indices
+    return result
@@ -0,0 +1,224 @@
+import abc
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+
+
+class Backend(abc.ABC):
+    """Storage for idempotency records
+
+    A record is a key with an optional value which expires at a point
+    in (epoch) time. Expired records are treated as missing.
+
+    """
+
+    @abc.abstractmethod
+    def put_if_absent(self, key: str, value: str, expires_at: float) -> bool:
+        """Stores the record unless a live one exists, returns True if
+        it was stored"""
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+
+class MemoryBackend(Backend):
+    """Least recently used records of a single warm container"""
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self._records: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put_if_absent(self, key: str, value: str, expires_at: float) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, value, expires_at)
+            return True
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._live(key)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._records.pop(key, None)
+
+    def _live(self, key: str) -> Optional[str]:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        value, expires_at = record
+        if expires_at <= time.time():
+            del self._records[key]
+            return None
+        self._records.move_to_end(key)
+        return value
+
+    def _store(self, key: str, value: str, expires_at: float) -> None:
+        self._records[key] = (value, expires_at)
+        self._records.move_to_end(key)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+
+
+class SQLiteBackend(Backend):
+    """Records in a local SQLite file, e.g. under /tmp"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS records ('
+                         'key TEXT PRIMARY KEY, value TEXT, '
+                         'expires_at REAL)')
+
+    def put_if_absent(self, key: str, value: str, expires_at: float) -> bool:
+        with self._lock:
+            self._db.execute('DELETE FROM records '
+                             'WHERE key = ? AND expires_at <= ?',
+                             (key, time.time()))
+            cursor = self._db.execute('INSERT OR IGNORE INTO records '
+                                      'VALUES (?, ?, ?)',
+                                      (key, value, expires_at))
+            return cursor.rowcount == 1
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO records '
+                             'VALUES (?, ?, ?)', (key, value, expires_at))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute('SELECT value FROM records '
+                                   'WHERE key = ? AND expires_at > ?',
+                                   (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute('DELETE FROM records WHERE key = ?', (key,))
+
+
+class DynamoDBBackend(Backend):
+    """Records in a DynamoDB table shared by all containers
+
+    The table has a string partition key `key`, `expires_at` holds
+    epoch seconds and can be used as the table's TTL attribute.
+
+    """
+
+    def __init__(self, table: str, client: Callable[[], Any]) -> None:
+        self.table = table
+        self.client = client
+
+    def put_if_absent(self, key: str, value: str, expires_at: float) -> bool:
+        client = self.client()
+        try:
+            client.put_item(
+                TableName=self.table,
+                Item=self._item(key, value, expires_at),
+                ConditionExpression='attribute_not_exists(#key) '
+                                    'OR expires_at <= :now',
+                ExpressionAttributeNames={'#key': 'key'},
+                ExpressionAttributeValues={
+                    ':now': {'N': str(int(time.time()))}
+                })
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        self.client().put_item(TableName=self.table,
+                               Item=self._item(key, value, expires_at))
+
+    def get(self, key: str) -> Optional[str]:
+        response = self.client().get_item(TableName=self.table,
+                                          Key={'key': {'S': key}},
+                                          ConsistentRead=True)
+        item = response.get('Item')
+        if not item or float(item['expires_at']['N']) <= time.time():
+            return None
+        return item['value']['S']
+
+    def delete(self, key: str) -> None:
+        self.client().delete_item(TableName=self.table,
+                                  Key={'key': {'S': key}})
+
+    def _item(self, key: str, value: str, expires_at: float):
+        return {
+            'key': {'S': key},
+            'value': {'S': value},
+            'expires_at': {'N': str(int(expires_at))}
+        }
+
+
+class IdempotencyStore:
+    """Remembers work which has been done, for `ttl` seconds
+
+    Work in progress is claimed for `lease` seconds only, a little
+    longer than the function may run. When an invocation times out or
+    crashes before the work completes the claim lapses, so a redelivery
+    of the event does the work instead of being skipped.
+
+    """
+
+    def __init__(self, backend: Backend, ttl: float = 86400.0,
+                 lease: float = 900.0) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.lease = lease
+
+    def claim(self, key: str, value: str = '') -> bool:
+        """Records the key as in progress, returns False if it was
+        already claimed or completed"""
+        return self.backend.put_if_absent(key, value,
+                                          time.time() + self.lease)
+
+    def complete(self, key: str, value: str = '') -> None:
+        """Records the work of the key as done"""
+        self.backend.put(key, value, time.time() + self.ttl)
+
+    def release(self, key: str) -> None:
+        """Forgets the key, e.g. when the work failed and may be retried"""
+        self.backend.delete(key)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.backend.get(key)
+
+
+def from_url(url: str, client: Callable[[str], Any],
+             ttl: float = 86400.0, lease: float = 900.0) -> IdempotencyStore:
+    """Creates a store from a url
+
+    memory[:<max size>], sqlite:<path> or dynamodb:<table name>
+
+    """
+    scheme, _, location = url.partition(':')
+    if scheme == 'memory':
+        backend: Backend = MemoryBackend(int(location or 10000))
+    elif scheme == 'sqlite':
+        backend = SQLiteBackend(location)
+    elif scheme == 'dynamodb':
+        backend = DynamoDBBackend(location, lambda: client('dynamodb'))
+    else:
+        raise ValueError('unknown idempotency store {!r}'.format(url))
+    return IdempotencyStore(backend, ttl=ttl, lease=lease)
@@ -40,8 +40,11 @@ class S3UpdateBucketInfo(TypedDict):
     name: str
 
 
-class S3UpdateObjectInfo(TypedDict):
+class S3UpdateObjectInfo(TypedDict, total=False):
     key: str
+    size: int
+    eTag: str
+    sequencer: str
 
 
 class S3UpdateInfo(TypedDict):
@@ -78,6 +81,27 @@ class S3UpdateEvent(TypedDict):
     Records: List[S3UpdateRecord]
 
 
+class SQSRecord(TypedDict, total=False):
+    messageId: str
+    receiptHandle: str
+    body: str                   # S3UpdateEvent as JSON
+    attributes: Dict[str, str]
+    eventSource: str            # aws:sqs
+    eventSourceARN: str
+
+
+class SQSEvent(TypedDict):
+    Records: List[SQSRecord]
+
+
+class SQSBatchItemFailure(TypedDict):
+    itemIdentifier: str         # messageId of a failed record
+
+
+class SQSBatchResponse(TypedDict):
+    batchItemFailures: List[SQSBatchItemFailure]
+
+
 class JobInput(TypedDict):
     Key: str
 
@@ -88,9 +112,24 @@ class JobOutput(TypedDict):
     Status: str # Submitted|Progressing|Completed|Warning|Error
 
 
-class JobSNSOutput(TypedDict):
+class TranscodingReport(TypedDict, total=False):
+    key: str
+    status: str                 # SUCCEEDED|SKIPPED|FAILED
+    jobId: str
+    error: str
+    motion: Dict                # savings of the motion stage, ffmpeg only
+
+
+class DeliveryReport(TypedDict, total=False):
+    key: str
+    status: str                 # SUCCEEDED|SKIPPED|FAILED
+    error: str
+
+
+class JobSNSOutput(TypedDict, total=False):
     presetId: str
     key: str
+    thumbnailPattern: str
     status: str # Progressing|Completed|Warning|Error
 
 
@@ -126,6 +165,25 @@ class AWSPipelineResponse(AWSElasticTranscoderResponse):
     Pipeline: PipelineInfo
 
 
+class ListPipelinesResponse(AWSElasticTranscoderResponse):
+    Pipelines: List[PipelineInfo]
+    NextPageToken: str
+
+
+class PresetInfo(TypedDict, total=False):
+    Id: str
+    Arn: str
+    Name: str
+    Container: str
+    Video: Dict
+    Thumbnails: Dict
+    Type: str                   # System|Custom
+
+
+class AWSPresetResponse(AWSElasticTranscoderResponse):
+    Preset: PresetInfo
+
+
 ReadPipelineResponse = AWSPipelineResponse
 CreatePipelineResponse = AWSPipelineResponse
 UpdatePipelineResponse = AWSPipelineResponse
@@ -133,12 +191,17 @@ UpdatePipelineResponse = AWSPipelineResponse
 
 class ElasticTranscoderClient:
 
-    def create_job(self, *, PipelineId: str, Input: JobInput, Output: JobOutput) -> Dict:
+    def create_job(self, *, PipelineId: str, Output: JobOutput,
+                   Input: JobInput = None,
+                   Inputs: List[JobInput] = None) -> Dict:
         pass
 
     def read_pipeline(self, *, Id: str) -> ReadPipelineResponse:
         pass
 
+    def list_pipelines(self, *, PageToken: str = None) -> ListPipelinesResponse:
+        pass
+
     def create_pipeline(self, *, Name: str, InputBucket: str,
                         OutputBucket: str, Role: str,
                         Notifications: PipelineNotifications) -> CreatePipelineResponse:
@@ -153,8 +216,20 @@ class ElasticTranscoderClient:
     def delete_pipeline(self, *, Id: str) -> AWSElasticTranscoderResponse:
         pass
 
+    def read_preset(self, *, Id: str) -> AWSPresetResponse:
+        pass
+
+    def create_preset(self, *, Name: str, Container: str, Video: Dict,
+                      Thumbnails: Dict,
+                      Description: str = None) -> AWSPresetResponse:
+        pass
+
+    def delete_preset(self, *, Id: str) -> AWSElasticTranscoderResponse:
+        pass
+
 
 class SNSRecord(TypedDict):
+    MessageId: str
     Message: str
 
 
@@ -221,6 +296,14 @@ class VideoPipelineProperties(TypedDict):
     OutputBucket: str           # output bucket arn
     Role: str                   # role arn for new pipeline
     Notifications: str          # SNS arn to send all notifications to
+    ShardCount: str             # number of pipelines, 1 by default
+
+
+class GifPresetProperties(TypedDict):
+    DisplayName: str            # The name of the preset, up to 40 chars
+    Width: str                  # even, 128 to 4096
+    Height: str                 # even, 96 to 3072
+    FrameRate: str              # 10|15|23.97|24|25|29.97|30|60
 
 
 class CustomResourceRequest(TypedDict):
@@ -253,6 +336,12 @@ class CustomResourceResponse(TypedDict):
 class VideoPipelineData(TypedDict):
     Id: str
     Arn: str
+    Ids: str                    # ids of all shards, comma separated
+
+
+class GifPresetData(TypedDict):
+    Id: str
+    Arn: str
 
 
 class CustomResourceSuccessResponse(CustomResourceResponse):
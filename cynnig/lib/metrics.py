@@ -0,0 +1,166 @@
+import functools
+import json
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+# CloudWatch takes at most 100 values of a metric in one EMF record
+MAX_VALUES = 100
+
+
+class _Untimed:
+    """Context manager which does nothing, used when metrics are off"""
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+UNTIMED = _Untimed()
+
+
+class _Timer:
+
+    def __init__(self, metrics: 'Metrics', phase: str,
+                 dimensions: Dict[str, str]) -> None:
+        self.metrics = metrics
+        self.phase = phase
+        self.dimensions = dimensions
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.metrics.record(self.phase, elapsed, **self.dimensions)
+
+
+class Metrics:
+    """Latency of the phases of an invocation, written to the log in
+    CloudWatch Embedded Metric Format
+
+    Every value is recorded with the Handler and Start (cold or warm)
+    dimensions of the invocation, the Phase and any extra dimensions
+    given to the timer, e.g. Camera. Values are buffered and written
+    as one record per set of dimensions when the invocation ends.
+
+    Without a namespace metrics are off: timers are a shared no-op and
+    decorators return the function as is.
+
+    """
+
+    def __init__(self, namespace: Optional[str],
+                 emit: Callable[[str], None] = print,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.namespace = namespace
+        self.enabled = bool(namespace)
+        self.emit = emit
+        self.clock = clock
+        self._cold = True
+        self._invocation: Dict[str, str] = {}
+        self._values: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def handler(self, fn: F) -> F:
+        """Decorates a Lambda handler, its invocations set the Handler
+        and Start dimensions and write the records when they end
+
+        """
+        if not self.enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.begin(fn.__name__)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.flush()
+        return wrapper  # type: ignore
+
+    def timed(self, phase: str) -> Callable[[F], F]:
+        """Decorator which times each call of a function"""
+        def decorate(fn: F) -> F:
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return fn(*args, **kwargs)
+            return wrapper  # type: ignore
+        return decorate
+
+    def timer(self, phase: str, **dimensions: str):
+        """Context manager which times its block"""
+        if not self.enabled:
+            return UNTIMED
+        return _Timer(self, phase, dimensions)
+
+    def instrument(self, client: Any) -> Any:
+        """Times every API call of a boto3 client, e.g. the phase of
+        s3.get_object is s3.GetObject
+
+        """
+        if not self.enabled:
+            return client
+        events = client.meta.events
+        events.register('before-parameter-build', self._before_call,
+                        unique_id='metrics-before-call')
+        events.register('after-call', self._after_call,
+                        unique_id='metrics-after-call')
+        return client
+
+    def begin(self, handler: str) -> None:
+        with self._lock:
+            self._invocation = {
+                'Handler': handler,
+                'Start': 'cold' if self._cold else 'warm'
+            }
+            self._cold = False
+
+    def record(self, phase: str, milliseconds: float,
+               **dimensions: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            key = tuple(sorted(dict(self._invocation, Phase=phase,
+                                    **dimensions).items()))
+            self._values.setdefault(key, []).append(milliseconds)
+
+    def flush(self) -> None:
+        with self._lock:
+            values, self._values = self._values, {}
+        timestamp = int(self.clock() * 1000)
+        for key, latencies in values.items():
+            dimensions = dict(key)
+            for i in range(0, len(latencies), MAX_VALUES):
+                self.emit(json.dumps(dict(dimensions, **{
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [sorted(dimensions)],
+                            'Metrics': [{'Name': 'Latency',
+                                         'Unit': 'Milliseconds'}]
+                        }]
+                    },
+                    'Latency': [round(latency, 3) for latency
+                                in latencies[i:i + MAX_VALUES]]
+                })))
+
+    def _before_call(self, model, context, **kwargs) -> None:
+        context['metrics_start'] = time.perf_counter()
+
+    def _after_call(self, model, context, **kwargs) -> None:
+        start = context.get('metrics_start')
+        if start is None:
+            return
+        phase = '{}.{}'.format(model.service_model.endpoint_prefix,
+                               model.name)
+        self.record(phase, (time.perf_counter() - start) * 1000)
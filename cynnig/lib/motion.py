@@ -0,0 +1,102 @@
+import importlib.util
+
+from typing import Any, List, NamedTuple, Tuple
+
+# a pixel moved when its grey level changes by more than this
+PIXEL_THRESHOLD = 16
+
+# a frame is kept when more than this share of the crop changed since
+# the last frame kept
+FRAME_THRESHOLD = 0.005
+
+# space around the motion, as a share of its width and height
+MARGIN = 0.1
+
+# smallest crop, as a share of the frame width and height
+MIN_CROP = 0.25
+
+
+def available() -> bool:
+    """Whether NumPy is installed, the motion stage is skipped without"""
+    return importlib.util.find_spec('numpy') is not None
+
+
+class MotionPlan(NamedTuple):
+    """How a clip is cut down before it's encoded
+
+    `box` is the crop as (x, y, width, height) shares of the frame,
+    `frames` the indices of the frames kept out of `total`.
+
+    """
+    box: Tuple[float, float, float, float]
+    frames: List[int]
+    total: int
+
+    @property
+    def pixel_ratio(self) -> float:
+        """Share of the pixels of the full clip which are encoded"""
+        if not self.total:
+            return 1.0
+        _, _, width, height = self.box
+        return width * height * len(self.frames) / self.total
+
+
+def plan(frames: Any, pixel_threshold: int = PIXEL_THRESHOLD,
+         frame_threshold: float = FRAME_THRESHOLD, margin: float = MARGIN,
+         min_crop: float = MIN_CROP) -> MotionPlan:
+    """Finds the bounding box of motion across a clip and the frames
+    which differ enough from the ones before them
+
+    `frames` is an array of grey frames shaped (count, height, width).
+    The first and the last frame are always kept, so the GIF lasts as
+    long as the clip.
+
+    """
+    import numpy as np
+
+    frames = np.asarray(frames, dtype=np.int16)
+    total, height, width = frames.shape
+    if total < 2:
+        return MotionPlan((0.0, 0.0, 1.0, 1.0), list(range(total)), total)
+
+    # union of the per-frame difference masks
+    moved = (np.abs(np.diff(frames, axis=0)) > pixel_threshold).any(axis=0)
+    if not moved.any():
+        return MotionPlan((0.0, 0.0, 1.0, 1.0), [0, total - 1], total)
+
+    rows = np.flatnonzero(moved.any(axis=1))
+    columns = np.flatnonzero(moved.any(axis=0))
+    x0, x1 = _span(columns[0], columns[-1] + 1, width, margin, min_crop)
+    y0, y1 = _span(rows[0], rows[-1] + 1, height, margin, min_crop)
+
+    crop = frames[:, y0:y1, x0:x1]
+    threshold = frame_threshold * crop.shape[1] * crop.shape[2]
+    kept = [0]
+    for i in range(1, total - 1):
+        changed = np.count_nonzero(
+            np.abs(crop[i] - crop[kept[-1]]) > pixel_threshold)
+        if changed > threshold:
+            kept.append(i)
+    kept.append(total - 1)
+
+    box = (x0 / width, y0 / height, (x1 - x0) / width, (y1 - y0) / height)
+    return MotionPlan(box, kept, total)
+
+
+def _span(start: int, end: int, size: int, margin: float,
+          min_crop: float) -> Tuple[int, int]:
+    """Widens [start, end) by the margin and to the smallest crop,
+    keeping it within [0, size)
+
+    """
+    pad = int(round((end - start) * margin))
+    start, end = start - pad, end + pad
+    shortfall = int(round(size * min_crop)) - (end - start)
+    if shortfall > 0:
+        start -= shortfall // 2
+        end += shortfall - shortfall // 2
+    if start < 0:
+        start, end = 0, end - start
+    if end > size:
+        start, end = max(0, start - (end - size)), size
+    return int(start), int(end)
@@ -0,0 +1,120 @@
+import hashlib
+import re
+import threading
+import time
+
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+from lambda_types import ElasticTranscoderClient
+
+
+class PipelineResolver:
+    """Resolves elastic transcoder pipeline ids by name
+
+    The name->id index is built from every page of ListPipelines and
+    kept for `ttl` seconds, so warm containers don't hit the API on
+    each invocation.
+
+    """
+
+    def __init__(self, ttl: float = 300.0) -> None:
+        self.ttl = ttl
+        self._index: Optional[Dict[str, str]] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def resolve_all(self, client: ElasticTranscoderClient, pattern: str,
+                    exclude: Optional[str] = None) -> List[str]:
+        """Ids of every pipeline whose name matches, i.e. all shards,
+        ordered by name so every container sees the same order
+
+        Pipelines whose name matches `exclude` are left out.
+
+        """
+        index = self.index(client)
+        pipeline_ids = [pipeline_id for name, pipeline_id
+                        in sorted(index.items())
+                        if re.search(pattern, name) and
+                        not (exclude and re.search(exclude, name))]
+        if not pipeline_ids:
+            raise LookupError('no pipeline matches {!r}'.format(pattern))
+        return pipeline_ids
+
+    def index(self, client: ElasticTranscoderClient) -> Dict[str, str]:
+        with self._lock:
+            if self._index is None or time.monotonic() >= self._expires_at:
+                self._index = list_pipelines(client)
+                self._expires_at = time.monotonic() + self.ttl
+            return self._index
+
+    def invalidate(self) -> None:
+        self._index = None
+
+
+def list_pipelines(client: ElasticTranscoderClient) -> Dict[str, str]:
+    index: Dict[str, str] = {}
+    response = client.list_pipelines()
+    while True:
+        for pipeline in response['Pipelines']:
+            index[pipeline['Name']] = pipeline['Id']
+        token = response.get('NextPageToken')
+        if not token:
+            return index
+        response = client.list_pipelines(PageToken=token)
+
+
+def shard_name(name: str, shard: int, generation: str = '') -> str:
+    """Name of a pipeline shard, the first one keeps the name as is so
+    a stack with one shard doesn't change
+
+    A set of shards which replaces another one has a `generation` in
+    its names, so the names of the two sets don't clash while the old
+    one is deleted.
+
+    """
+    if generation:
+        name = '{} {}'.format(name, generation)
+    return name if shard == 0 else '{} {}'.format(name, shard)
+
+
+def rendezvous(key: str, shards: Sequence[str]) -> str:
+    """Shard of a key by rendezvous (highest random weight) hashing
+
+    A key stays on its shard while the shard exists, adding or removing
+    a shard only moves the keys which land on or leave it.
+
+    """
+    def weight(shard: str) -> bytes:
+        return hashlib.md5('{}:{}'.format(shard, key).encode()).digest()
+
+    return max(shards, key=weight)
+
+
+class ShardLoad:
+    """Picks the shard with the fewest jobs submitted by this container
+    during the last `window` seconds
+
+    Elastic Transcoder doesn't tell how many jobs a pipeline has queued
+    without listing them, jobs submitted recently stand in for the ones
+    still in flight.
+
+    """
+
+    def __init__(self, window: float = 60.0) -> None:
+        self.window = window
+        self._submitted: Deque[Tuple[float, str]] = deque()
+        self._lock = threading.Lock()
+
+    def pick(self, shards: Sequence[str]) -> str:
+        now = time.monotonic()
+        with self._lock:
+            while self._submitted and \
+                    self._submitted[0][0] <= now - self.window:
+                self._submitted.popleft()
+            load = {shard: 0 for shard in shards}
+            for _, shard in self._submitted:
+                if shard in load:
+                    load[shard] += 1
+            shard = min(shards, key=lambda shard: load[shard])
+            self._submitted.append((now, shard))
+            return shard
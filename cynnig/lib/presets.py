@@ -0,0 +1,63 @@
+import json
+
+from typing import List, NamedTuple, Optional
+
+# elastic transcoder system preset "GIF (Animated)"
+SYSTEM_GIF_PRESET = '1351620000001-100200'
+
+# rough size of a GIF pixel after LZW compression of camera footage
+BYTES_PER_PIXEL = 0.2
+
+
+class PresetTier(NamedTuple):
+    id: str
+    width: int
+    height: int
+    fps: float
+
+    def estimate(self, duration: float) -> float:
+        """Estimated size in bytes of a GIF of `duration` seconds"""
+        return duration * self.fps * self.width * self.height * \
+            BYTES_PER_PIXEL
+
+
+DEFAULT_TIERS = [PresetTier(SYSTEM_GIF_PRESET, 480, 270, 10)]
+
+
+def load_tiers(spec: Optional[str]) -> List[PresetTier]:
+    """Parses a JSON list of tiers, best quality first, e.g.
+    [{"id": "...", "width": 480, "height": 270, "fps": 10}, ...]
+
+    """
+    if not spec:
+        return DEFAULT_TIERS
+    return [PresetTier(t['id'], int(t['width']), int(t['height']),
+                       float(t['fps']))
+            for t in json.loads(spec)]
+
+
+def select_preset(tiers: List[PresetTier], duration: float,
+                  budget: float) -> PresetTier:
+    """Picks the best tier whose GIF is expected to fit into `budget`
+    bytes, or the smallest one if none does
+
+    """
+    return next((tier for tier in tiers if tier.estimate(duration) <= budget),
+                tiers[-1])
+
+
+def clip_duration(head: dict, bitrate: float) -> float:
+    """Duration of a recording in seconds from its HeadObject response
+
+    Uses the `duration` user metadata when the recorder sets it,
+    otherwise estimates it from the size and the recording bitrate
+    (bytes per second).
+
+    """
+    duration = head.get('Metadata', {}).get('duration')
+    if duration:
+        try:
+            return float(duration)
+        except ValueError:
+            pass
+    return head['ContentLength'] / bitrate
@@ -1,10 +1,31 @@
+import hashlib
+import io
+import json
+import os
+import random
 import requests
+import threading
+import time
 import mimetypes
+import uuid
 
 from requests.auth import AuthBase
-from typing import BinaryIO, Optional, Dict
+from urllib3.exceptions import ConnectTimeoutError
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Callable, ContextManager, Optional, Dict, List, \
+    Mapping, Tuple, TYPE_CHECKING
+from urllib.parse import urlsplit
 from mypy_extensions import TypedDict
 
+if TYPE_CHECKING:
+    import asyncio
+
+# methods which can be sent again whether or not the server got them
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# seconds an attempt gets at least, even once the deadline has passed
+MIN_TIMEOUT = 0.1
+
 
 class LoginData(TypedDict):
     authToken: str
@@ -24,7 +45,11 @@ class RocketChat:
 
     def __init__(self, server_url: str,
                  username: Optional[str] = None, password: Optional[str] = None,
-                 user_id: Optional[str] = None, auth_token: Optional[str] = None) -> None:
+                 user_id: Optional[str] = None, auth_token: Optional[str] = None,
+                 token_cache: Optional[str] = None,
+                 retry: Optional['RetryPolicy'] = None,
+                 timer: Optional[Callable[[str], ContextManager]] = None
+                 ) -> None:
         assert (username and password) or (user_id and auth_token), \
             'either username/password or user_id/auth_token have to be provided'
 
@@ -33,29 +58,97 @@ class RocketChat:
         self.user_id = user_id
         self.auth_token = auth_token
         self.server_url = server_url
+        self.retry = retry or RetryPolicy()
+        self.timer = timer
 
         self._session = requests.Session()
         if self.username and self.password:
-            auth = LoginAuth(self, self.username, self.password)
+            auth = LoginAuth(self, self.username, self.password,
+                             token_cache=token_cache)
         elif self.user_id and self.auth_token:
             auth = TokenAuth(self.user_id, self.auth_token)
 
         self._session.auth = auth
 
-    def request(self, method: str, path: str, **kwargs: Dict) -> RocketResponse:
+    def request(self, method: str, path: str, deadline: Optional[float] = None,
+                **kwargs: Dict) -> RocketResponse:
+        """Sends a request to the server and returns the JSON response
+
+        Rate limited, 5xx and failed requests are retried according to
+        the retry policy, as long as the retry starts before `deadline`
+        (a time.monotonic() value) and the body can be sent again. A
+        POST is only retried when the server didn't process it: the
+        connection failed before it was sent or the response is one of
+        the policy's `unprocessed` statuses. Each attempt times out after
+        the policy's `timeout`, or when the deadline passes if sooner.
+
+        With a `timer`, each request (retries and a login it triggers
+        included) is timed as a phase named after the API method, e.g.
+        rocketchat.rooms.upload.
+
+        """
+        if self.timer is None:
+            return self._request(method, path, deadline, **kwargs)
+        with self.timer(_phase(path)):
+            return self._request(method, path, deadline, **kwargs)
+
+    def _request(self, method: str, path: str, deadline: Optional[float],
+                 **kwargs: Dict) -> RocketResponse:
         url = self.server_url + path
-        old_auth = None
-        if 'auth' in kwargs:
-            old_auth = self._session.auth
-            self._session.auth = kwargs['auth']
+        own_auth = 'auth' in kwargs
+        if own_auth and kwargs['auth'] is None:
+            # requests falls back to the session auth for auth=None,
+            # the session is shared between threads so it isn't swapped
+            kwargs['auth'] = _no_auth
 
-        resp = self._session.request(method, url, **kwargs)
-        if old_auth:
-            self._session.auth = old_auth
+        auth = self._session.auth
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        relogged = False
+        attempt = 0
+        timeout = kwargs.pop('timeout', self.retry.timeout)
+        while True:
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - time.monotonic(),
+                                           MIN_TIMEOUT))
+            try:
+                resp = self._session.request(method, url, timeout=timeout,
+                                             **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.retry.backoff(attempt)
+                if not (idempotent or _not_sent(e)) or \
+                   not self._can_retry(attempt, delay, deadline, kwargs):
+                    raise
+            else:
+                if resp.status_code == 401 and not own_auth and \
+                   not relogged and isinstance(auth, LoginAuth):
+                    # the token was revoked or has expired, log in again
+                    # and retry once if the request body can be sent again
+                    auth.reset()
+                    relogged = True
+                    if _rewind(kwargs):
+                        continue
+                    break
+                if resp.status_code not in self.retry.statuses or \
+                   not (idempotent or
+                        resp.status_code in self.retry.unprocessed):
+                    break
+                delay = self.retry.delay(attempt, resp.headers)
+                if not self._can_retry(attempt, delay, deadline, kwargs):
+                    break
+            time.sleep(delay)
+            attempt += 1
 
         resp.raise_for_status()
         return resp.json()
 
+    def _can_retry(self, attempt: int, delay: float,
+                   deadline: Optional[float], kwargs: Dict) -> bool:
+        if attempt + 1 >= self.retry.attempts:
+            return False
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return False
+        return _rewind(kwargs)
+
     def login(self, username: str, password: str) -> RocketLoginResponse:
         path = '/api/v1/login'
         creds = {
@@ -64,11 +157,174 @@ class RocketChat:
         }
         return self.request('post', path, json=creds, auth=None)
 
-    def upload(self, room_id: str, name: str, file: BinaryIO) -> RocketResponse:
+    def upload(self, room_id: str, name: str, file: BinaryIO,
+               size: Optional[int] = None,
+               reopen: Optional[Callable[[], BinaryIO]] = None,
+               deadline: Optional[float] = None,
+               text: Optional[str] = None,
+               thread_id: Optional[str] = None) -> RocketResponse:
+        """Uploads a file to a room, with `text` as the message and as
+        a reply in the thread of the `thread_id` message
+
+        When the size of the file is known the multipart body is
+        streamed from the file, so it's never held in memory. `reopen`
+        returns the file from the start again, it allows retries of
+        streams which can't be rewound.
+
+        """
         type, _ = mimetypes.guess_type(name)
-        files = {'file': (name, file, type)}
         path =  '/api/v1/rooms.upload/{}'.format(room_id)
-        return self.request('post', path, files=files)
+        fields = {}
+        if text is not None:
+            fields['msg'] = text
+        if thread_id is not None:
+            fields['tmid'] = thread_id
+        if size is None:
+            files = {'file': (name, file, type)}
+            return self.request('post', path, deadline=deadline, files=files,
+                                data=fields)
+
+        body = MultipartStream('file', name, file, size, type, reopen=reopen,
+                               fields=fields)
+        headers = {'Content-Type': body.content_type}
+        return self.request('post', path, deadline=deadline, data=body,
+                            headers=headers)
+
+
+    def post_message(self, room_id: str, text: Optional[str] = None,
+                     attachments: Optional[List[Dict]] = None,
+                     deadline: Optional[float] = None,
+                     thread_id: Optional[str] = None) -> RocketResponse:
+        """Posts a message to a room, as a reply in the thread of the
+        `thread_id` message"""
+        message: Dict = {'roomId': room_id}
+        if text is not None:
+            message['text'] = text
+        if attachments:
+            message['attachments'] = attachments
+        if thread_id:
+            message['tmid'] = thread_id
+        path = '/api/v1/chat.postMessage'
+        return self.request('post', path, deadline=deadline, json=message)
+
+
+class RetryPolicy:
+    """When and how long to wait before a request is sent again
+
+    Rate limited responses wait for Retry-After or X-RateLimit-Reset
+    (epoch milliseconds, as sent by Rocket.Chat), up to `max_delay`
+    seconds. Other errors, and headers which can't be parsed, use
+    capped exponential backoff with full jitter. `unprocessed` are the
+    statuses which mean the server didn't act on the request, only
+    those are retried for non-idempotent requests. `timeout` is the
+    connect and read timeout of each attempt in seconds.
+
+    """
+
+    def __init__(self, attempts: int = 4, base: float = 0.25,
+                 cap: float = 5.0, max_delay: float = 30.0,
+                 statuses: Tuple[int, ...] = (429, 500, 502, 503, 504),
+                 unprocessed: Tuple[int, ...] = (429, 503),
+                 timeout: float = 30.0) -> None:
+        self.attempts = attempts
+        self.timeout = timeout
+        self.base = base
+        self.cap = cap
+        self.max_delay = max_delay
+        self.statuses = statuses
+        self.unprocessed = unprocessed
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def delay(self, attempt: int, headers: Mapping[str, str]) -> float:
+        wait = _header_delay(headers)
+        if wait is None:
+            return self.backoff(attempt)
+        return min(self.max_delay, max(0.0, wait))
+
+
+class MultipartStream:
+    """File-like multipart/form-data body with a single file field
+
+    The form is read lazily: the part headers, then the file in chunks
+    and the closing boundary, so memory use doesn't depend on the size
+    of the file. `size` has to be the exact size of the file, it's used
+    for the Content-Length of the request. Text `fields` are sent
+    before the file.
+
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, field: str, name: str, file: BinaryIO, size: int,
+                 content_type: Optional[str] = None,
+                 reopen: Optional[Callable[[], BinaryIO]] = None,
+                 fields: Optional[Dict[str, str]] = None) -> None:
+        self.boundary = uuid.uuid4().hex
+        head = ''.join(
+            '--{boundary}\r\n'
+            'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            '{value}\r\n'.format(boundary=self.boundary, name=field_name,
+                                  value=value)
+            for field_name, value in (fields or {}).items())
+        head += ('--{boundary}\r\n'
+                'Content-Disposition: form-data; name="{field}"; '
+                'filename="{name}"\r\n'
+                'Content-Type: {type}\r\n\r\n').format(
+                    boundary=self.boundary, field=field,
+                    name=name.replace('"', '\\"'),
+                    type=content_type or 'application/octet-stream')
+        tail = '\r\n--{}--\r\n'.format(self.boundary)
+        self._file = file
+        self._reopen = reopen
+        self._parts = [io.BytesIO(head.encode('utf-8')), file,
+                       io.BytesIO(tail.encode('utf-8'))]
+        self._current = 0
+        self.len = len(self._parts[0].getvalue()) + size + \
+            len(self._parts[2].getvalue())
+
+    @property
+    def content_type(self) -> str:
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self) -> int:
+        return self.len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(self)
+        while self._current < len(self._parts):
+            chunk = self._parts[self._current].read(size)
+            if chunk:
+                return chunk
+            self._current += 1
+        return b''
+
+    def seekable(self) -> bool:
+        return self._reopen is not None or _seekable(self._file)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if (offset, whence) != (0, io.SEEK_SET):
+            raise io.UnsupportedOperation('can only rewind a multipart body')
+        if self._reopen is not None:
+            close = getattr(self._file, 'close', None)
+            if close:
+                close()
+            self._file = self._parts[1] = self._reopen()
+        else:
+            self._file.seek(0)
+        self._parts[0].seek(0)
+        self._parts[2].seek(0)
+        self._current = 0
+        return 0
 
 
 class TokenAuth(AuthBase):
@@ -87,21 +343,429 @@ class TokenAuth(AuthBase):
 
 class LoginAuth(AuthBase):
 
-    def __init__(self, chat: RocketChat, username: str, password: str) -> None:
+    def __init__(self, chat: RocketChat, username: str, password: str,
+                 token_cache: Optional[str] = None) -> None:
         self.username = username
         self.password = password
         self.chat = chat
+        self.token_cache = token_cache
         self.__token_auth = None
+        # uploads may run on several threads, only one of them logs in
+        self.__lock = threading.Lock()
 
     @property
     def token_auth(self) -> TokenAuth:
-        if not self.__token_auth:
-            resp = self.chat.login(self.username, self.password)
-            data = resp['data']
-            user_id = data['userId']
-            auth_token = data['authToken']
-            self.__token_auth = TokenAuth(user_id, auth_token)
-        return self.__token_auth
+        with self.__lock:
+            if not self.__token_auth:
+                self.__token_auth = self._load_token()
+            if not self.__token_auth:
+                resp = self.chat.login(self.username, self.password)
+                data = resp['data']
+                user_id = data['userId']
+                auth_token = data['authToken']
+                self.__token_auth = TokenAuth(user_id, auth_token)
+                self._store_token(user_id, auth_token)
+            return self.__token_auth
+
+    def reset(self) -> None:
+        self.__token_auth = None
+        path = self._token_path()
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _token_path(self) -> Optional[str]:
+        if not self.token_cache:
+            return None
+        key = '{}|{}'.format(self.chat.server_url, self.username)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.token_cache,
+                            'rocketchat-{}.json'.format(digest))
+
+    def _load_token(self) -> Optional[TokenAuth]:
+        path = self._token_path()
+        if not path:
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return TokenAuth(data['userId'], data['authToken'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _store_token(self, user_id: str, auth_token: str) -> None:
+        path = self._token_path()
+        if not path:
+            return
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'userId': user_id, 'authToken': auth_token}, f)
 
     def __call__(self, request):
         return self.token_auth(request)
+
+
+class AsyncRocketChat:
+    """asyncio counterpart of RocketChat
+
+    asyncio is imported when the client is first used (see _asyncio),
+    handlers which only need RocketChat don't pay for it at cold start.
+    Requests share a pool of keep-alive connections to the server, so a
+    handler can gather many uploads on one event loop. Authentication
+    follows RocketChat: a token is used as is, username/password log in
+    once on first use and again when the server answers with a 401.
+
+    """
+
+    def __init__(self, server_url: str,
+                 username: Optional[str] = None, password: Optional[str] = None,
+                 user_id: Optional[str] = None, auth_token: Optional[str] = None,
+                 max_connections: int = 10) -> None:
+        assert (username and password) or (user_id and auth_token), \
+            'either username/password or user_id/auth_token have to be provided'
+
+        self.username = username
+        self.password = password
+        self.user_id = user_id
+        self.auth_token = auth_token
+        self.server_url = server_url
+
+        self._pool = _ConnectionPool(server_url, max_connections)
+        self._token_auth: Optional[TokenAuth] = None
+        if self.user_id and self.auth_token:
+            self._token_auth = TokenAuth(self.user_id, self.auth_token)
+        self._login_lock: Optional['asyncio.Lock'] = None
+
+    async def __aenter__(self) -> 'AsyncRocketChat':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    async def request(self, method: str, path: str, *,
+                      json: Optional[Dict] = None,
+                      data: Optional[BinaryIO] = None,
+                      headers: Optional[Dict[str, str]] = None,
+                      auth: bool = True) -> RocketResponse:
+        headers = dict(headers or {})
+        body = data
+        if json is not None:
+            body = _json_body(json)
+            headers['Content-Type'] = 'application/json'
+
+        token_auth = None
+        if auth:
+            token_auth = await self.token_auth()
+            token_auth(_Headers(headers))
+        resp = await self._pool.request(method.upper(), path, headers, body)
+
+        if resp.status == 401 and auth and self.username and self.password:
+            # the token was revoked or has expired, log in again and
+            # retry once if the request body can be sent again
+            if self._token_auth is token_auth:
+                self._token_auth = None
+            if body is None or _rewind({'data': body}):
+                (await self.token_auth())(_Headers(headers))
+                resp = await self._pool.request(
+                    method.upper(), path, headers, body)
+
+        resp.raise_for_status()
+        return resp.json()
+
+    async def token_auth(self) -> TokenAuth:
+        if self._login_lock is None:
+            self._login_lock = _asyncio().Lock()
+        async with self._login_lock:
+            if not self._token_auth:
+                resp = await self.login(self.username, self.password)
+                data = resp['data']
+                self._token_auth = TokenAuth(data['userId'], data['authToken'])
+            return self._token_auth
+
+    async def login(self, username: str, password: str) -> RocketLoginResponse:
+        path = '/api/v1/login'
+        creds = {
+            'username': username,
+            'password': password
+        }
+        return await self.request('post', path, json=creds, auth=False)
+
+    async def upload(self, room_id: str, name: str, file: BinaryIO,
+                     size: Optional[int] = None) -> RocketResponse:
+        type, _ = mimetypes.guess_type(name)
+        path =  '/api/v1/rooms.upload/{}'.format(room_id)
+        if size is None:
+            file = io.BytesIO(await _read(file))
+            size = len(file.getvalue())
+        body = MultipartStream('file', name, file, size, type)
+        headers = {'Content-Type': body.content_type}
+        return await self.request('post', path, data=body, headers=headers)
+
+
+class _Headers:
+    """Adapts a header dict to what requests' auth callables expect"""
+
+    def __init__(self, headers: Dict[str, str]) -> None:
+        self.headers = headers
+
+
+class _Response:
+
+    def __init__(self, status: int, reason: str, headers: Dict[str, str],
+                 body: bytes, url: str) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise requests.HTTPError('{} {} for url: {}'.format(
+                self.status, self.reason, self.url))
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class _ConnectionPool:
+    """Minimal HTTP/1.1 client keeping idle connections for reuse"""
+
+    def __init__(self, server_url: str, max_connections: int) -> None:
+        url = urlsplit(server_url)
+        self.url = server_url
+        self.host = url.hostname
+        self.ssl = url.scheme == 'https'
+        self.port = url.port or (443 if self.ssl else 80)
+        self.prefix = url.path.rstrip('/')
+        self.max_connections = max_connections
+        self._idle: List[Tuple['asyncio.StreamReader',
+                               'asyncio.StreamWriter']] = []
+        self._slots: Optional['asyncio.Semaphore'] = None
+
+    async def request(self, method: str, path: str, headers: Dict[str, str],
+                      body: Optional[BinaryIO]) -> _Response:
+        if self._slots is None:
+            self._slots = _asyncio().Semaphore(self.max_connections)
+        async with self._slots:
+            reader, writer, reused = await self._connect()
+            try:
+                return await self._exchange(reader, writer, method, path,
+                                            headers, body)
+            except (requests.ConnectionError, ConnectionError):
+                # the server may close an idle connection just as it's
+                # reused, the request is sent once more on a new one
+                if not reused or not (body is None or
+                                      _rewind({'data': body})):
+                    raise
+            reader, writer, _ = await self._connect(fresh=True)
+            return await self._exchange(reader, writer, method, path,
+                                        headers, body)
+
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            await _close(writer)
+
+    async def _connect(self, fresh: bool = False):
+        while self._idle and not fresh:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            await _close(writer)
+        reader, writer = await _asyncio().open_connection(
+            self.host, self.port, ssl=self.ssl or None)
+        return reader, writer, False
+
+    async def _exchange(self, reader, writer, method, path, headers, body):
+        try:
+            resp, keep_alive = await self._send(
+                reader, writer, method, path, headers, body)
+        except BaseException:
+            await _close(writer)
+            raise
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            await _close(writer)
+        return resp
+
+    async def _send(self, reader, writer, method, path, headers, body):
+        if body is None:
+            length = 0
+        elif isinstance(body, io.BytesIO):
+            length = len(body.getbuffer())
+        else:
+            length = len(body)
+        lines = ['{} {}{} HTTP/1.1'.format(method, self.prefix, path),
+                 'Host: {}'.format(self.host),
+                 'Content-Length: {}'.format(length),
+                 'Accept: application/json']
+        lines.extend('{}: {}'.format(name, value)
+                     for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        while body is not None:
+            chunk = await _read(body, MultipartStream.chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise requests.ConnectionError('connection closed by server')
+        _, status, reason = status_line.decode('latin-1').rstrip(
+            '\r\n').split(' ', 2)
+        resp_headers: Dict[str, str] = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+
+        if resp_headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await _read_chunked(reader)
+        elif 'content-length' in resp_headers:
+            content = await reader.readexactly(
+                int(resp_headers['content-length']))
+        else:
+            content = await reader.read()
+            resp_headers['connection'] = 'close'
+
+        keep_alive = resp_headers.get('connection', '').lower() != 'close'
+        resp = _Response(int(status), reason, resp_headers, content,
+                         self.url + path)
+        return resp, keep_alive
+
+
+def _asyncio():
+    """The asyncio module, imported on first use"""
+    import asyncio
+    return asyncio
+
+
+async def _close(writer: 'asyncio.StreamWriter') -> None:
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+def _json_body(payload: Dict) -> BinaryIO:
+    return io.BytesIO(json.dumps(payload).encode('utf-8'))
+
+
+async def _read_chunked(reader: 'asyncio.StreamReader') -> bytes:
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+            await reader.readline()
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+async def _read(body: BinaryIO, size: int = -1) -> bytes:
+    # in-memory bodies are read inline, anything else (e.g. an S3
+    # stream) may block on the network, so it's read on a thread
+    source = body._file if isinstance(body, MultipartStream) else body
+    if isinstance(source, io.BytesIO):
+        return body.read(size)
+    loop = _asyncio().get_running_loop()
+    return await loop.run_in_executor(None, body.read, size)
+
+
+_clients: Dict[Tuple[str, str], RocketChat] = {}
+
+
+def get_client(server_url: str, username: str, password: str,
+               token_cache: Optional[str] = None,
+               timer: Optional[Callable[[str], ContextManager]] = None
+               ) -> RocketChat:
+    """Returns a client shared across invocations of a warm container
+
+    Clients are keyed by server url and username, so the underlying
+    session (and its connections) and the auth token are reused.
+
+    """
+    key = (server_url, username)
+    chat = _clients.get(key)
+    if chat is None or chat.password != password:
+        chat = RocketChat(server_url, username=username, password=password,
+                          token_cache=token_cache, timer=timer)
+        _clients[key] = chat
+    return chat
+
+
+def _phase(path: str) -> str:
+    # /api/v1/rooms.upload/<room id> -> rocketchat.rooms.upload
+    parts = path.split('/')
+    return 'rocketchat.' + (parts[3] if len(parts) > 3 else path)
+
+
+def _no_auth(request):
+    return request
+
+
+def _not_sent(error: Exception) -> bool:
+    """Whether a request failed before it reached the server, so it's
+    safe to send it again whatever its method
+
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def _header_delay(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait according to Retry-After or X-RateLimit-Reset,
+    None when neither is there or parses
+
+    """
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(retry_after).timestamp() - \
+                time.time()
+        except (TypeError, ValueError, IndexError):
+            pass
+    reset = headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return int(reset) / 1000.0 - time.time()
+        except ValueError:
+            pass
+    return None
+
+
+def _rewind(kwargs: Dict) -> bool:
+    """Rewinds file bodies of a request so it can be sent again
+
+    Returns False if any of them is a stream which can't be rewound.
+
+    """
+    files = kwargs.get('files') or {}
+    bodies = [f[1] if isinstance(f, tuple) else f for f in files.values()]
+    bodies.append(kwargs.get('data'))
+    streams = [body for body in bodies if hasattr(body, 'read')]
+    if not all(_seekable(body) for body in streams):
+        return False
+    for body in streams:
+        body.seek(0)
+    return True
+
+
+def _seekable(body: BinaryIO) -> bool:
+    seekable = getattr(body, 'seekable', None)
+    return seekable() if seekable else hasattr(body, 'seek')
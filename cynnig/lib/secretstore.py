@@ -0,0 +1,193 @@
+import time
+
+from base64 import b64decode
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+KMS_PREFIX = 'kms:'
+SSM_PREFIX = 'ssm:'
+SECRETS_MANAGER_PREFIX = 'secretsmanager:'
+
+# limits of GetParameters and BatchGetSecretValue
+SSM_BATCH_SIZE = 10
+SECRETS_MANAGER_BATCH_SIZE = 20
+
+
+class SecretStore:
+    """Decrypts and fetches secrets once per container
+
+    Plain text values are kept in memory for `ttl` seconds. Values are
+    referenced with a prefix:
+
+    kms:<base64 ciphertext>     decrypted with KMS
+    ssm:<parameter name>        SSM Parameter Store (with decryption)
+    secretsmanager:<secret id>  Secrets Manager secret string
+
+    """
+
+    def __init__(self, client: Callable[[str], Any],
+                 ttl: float = 900.0) -> None:
+        self.client = client
+        self.ttl = ttl
+        self._cache: Dict[Tuple[str, str], Tuple[str, float]] = {}
+
+    def resolve(self, values: Dict[str, str],
+                encrypted: Iterable[str] = ()) -> Dict[str, str]:
+        """Resolves all referenced secrets in values
+
+        Names listed in `encrypted` hold KMS ciphertext even without
+        the kms: prefix. SSM parameters and Secrets Manager secrets are
+        fetched in batches.
+
+        """
+        encrypted = set(encrypted)
+        refs: Dict[str, Tuple[str, str]] = {}
+        for name, value in values.items():
+            if value.startswith(KMS_PREFIX):
+                refs[name] = ('kms', value[len(KMS_PREFIX):])
+            elif value.startswith(SSM_PREFIX):
+                refs[name] = ('ssm', value[len(SSM_PREFIX):])
+            elif value.startswith(SECRETS_MANAGER_PREFIX):
+                refs[name] = ('secretsmanager',
+                              value[len(SECRETS_MANAGER_PREFIX):])
+            elif name in encrypted:
+                refs[name] = ('kms', value)
+
+        parameters = self.parameters(
+            [ref for source, ref in refs.values() if source == 'ssm'])
+        secrets = self.secrets(
+            [ref for source, ref in refs.values()
+             if source == 'secretsmanager'])
+
+        resolved = dict(values)
+        for name, (source, ref) in refs.items():
+            if source == 'kms':
+                resolved[name] = self.decrypt(ref)
+            elif source == 'ssm':
+                resolved[name] = parameters[ref]
+            else:
+                resolved[name] = secrets[ref]
+        return resolved
+
+    def decrypt(self, ciphertext: str) -> str:
+        key = ('kms', ciphertext)
+        value = self._cached(key)
+        if value is None:
+            kms = self.client('kms')
+            response = kms.decrypt(CiphertextBlob=b64decode(ciphertext))
+            value = response['Plaintext'].decode('utf-8')
+            self._store(key, value)
+        return value
+
+    def parameters(self, names: List[str]) -> Dict[str, str]:
+        """Values of SSM parameters by the names, ARNs or
+        name:version selectors they're referenced with
+
+        """
+        values, missing = self._lookup('ssm', names)
+        for batch in _batches(missing, SSM_BATCH_SIZE):
+            ssm = self.client('ssm')
+            response = ssm.get_parameters(Names=batch, WithDecryption=True)
+            if response.get('InvalidParameters'):
+                raise KeyError('unknown parameters: {}'.format(
+                    ', '.join(response['InvalidParameters'])))
+            found = {}
+            for parameter in response['Parameters']:
+                selector = parameter.get('Selector', '')
+                for ref in (parameter['Name'], parameter.get('ARN')):
+                    if ref:
+                        found[ref] = found[ref + selector] = \
+                            parameter['Value']
+            self._collect('ssm', batch, found, values)
+        return values
+
+    def secrets(self, ids: List[str]) -> Dict[str, str]:
+        """Secret strings by the names, ARNs or partial ARNs the secrets
+        are referenced with
+
+        BatchGetSecretValue is used when the SDK has it, secrets are
+        fetched one by one otherwise.
+
+        """
+        values, missing = self._lookup('secretsmanager', ids)
+        if not missing:
+            return values
+        secretsmanager = self.client('secretsmanager')
+        if not hasattr(secretsmanager, 'batch_get_secret_value'):
+            found = {}
+            for secret_id in missing:
+                try:
+                    secret = secretsmanager.get_secret_value(
+                        SecretId=secret_id)
+                except secretsmanager.exceptions.ResourceNotFoundException:
+                    continue
+                found[secret_id] = secret['SecretString']
+            self._collect('secretsmanager', missing, found, values)
+            return values
+
+        for batch in _batches(missing, SECRETS_MANAGER_BATCH_SIZE):
+            response = secretsmanager.batch_get_secret_value(
+                SecretIdList=batch)
+            if response.get('Errors'):
+                raise KeyError('unknown secrets: {}'.format(
+                    ', '.join(e['SecretId'] for e in response['Errors'])))
+            found = {}
+            for secret_id in batch:
+                for secret in response['SecretValues']:
+                    if _same_secret(secret_id, secret):
+                        found[secret_id] = secret['SecretString']
+            self._collect('secretsmanager', batch, found, values)
+        return values
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+
+    def _lookup(self, source: str,
+                refs: List[str]) -> Tuple[Dict[str, str], List[str]]:
+        values: Dict[str, str] = {}
+        missing: List[str] = []
+        for ref in dict.fromkeys(refs):
+            value = self._cached((source, ref))
+            if value is None:
+                missing.append(ref)
+            else:
+                values[ref] = value
+        return values, missing
+
+    def _collect(self, source: str, refs: List[str], found: Dict[str, str],
+                 values: Dict[str, str]) -> None:
+        """Stores the values of refs, raises KeyError when one of them
+        isn't in `found`
+
+        """
+        unknown = [ref for ref in refs if ref not in found]
+        if unknown:
+            raise KeyError('unknown {} references: {}'.format(
+                source, ', '.join(unknown)))
+        for ref in refs:
+            values[ref] = found[ref]
+            self._store((source, ref), found[ref])
+
+    def _cached(self, key: Tuple[str, str]):
+        value, expires_at = self._cache.get(key, (None, 0.0))
+        if time.monotonic() < expires_at:
+            return value
+        return None
+
+    def _store(self, key: Tuple[str, str], value: str) -> None:
+        self._cache[key] = (value, time.monotonic() + self.ttl)
+
+
+def _batches(items: List[str], size: int) -> Iterable[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _same_secret(secret_id: str, secret: Dict[str, str]) -> bool:
+    """Whether a name, ARN or partial ARN (without the random suffix
+    Secrets Manager adds) references the secret
+
+    """
+    arn = secret.get('ARN', '')
+    return secret_id in (secret.get('Name'), arn) or \
+        (secret_id.startswith('arn:') and arn.startswith(secret_id + '-'))
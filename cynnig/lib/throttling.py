@@ -0,0 +1,77 @@
+import random
+import threading
+import time
+
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+# error codes AWS services use to report throttled requests
+THROTTLING_ERRORS = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+])
+
+
+class TokenBucket:
+    """Thread safe token bucket
+
+    Tokens are refilled at `rate` per second up to `capacity`, callers
+    block in `acquire` until a token is available.
+
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        while True:
+            with self._lock:
+                now = self._clock()
+                elapsed = now - self._updated_at
+                self._tokens = min(self.capacity,
+                                   self._tokens + elapsed * self.rate)
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+def is_throttling_error(error: Exception) -> bool:
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    return code in THROTTLING_ERRORS
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Capped exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_throttled(fn: Callable[..., T], *args,
+                    attempts: int = 5, base: float = 0.1, cap: float = 5.0,
+                    sleep: Callable[[float], None] = time.sleep,
+                    **kwargs) -> T:
+    """Calls fn and retries it while AWS throttles the request"""
+    for attempt in range(attempts - 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            sleep(backoff_delay(attempt, base, cap))
+    return fn(*args, **kwargs)
@@ -0,0 +1,253 @@
+import abc
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+import motion
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from lambda_types import TranscoderJobStatus
+from presets import DEFAULT_TIERS, PresetTier
+
+# size of the pieces a recording is streamed to /tmp in
+CHUNK_SIZE = 1024 * 1024
+
+# width of the grey frames the motion stage looks at
+ANALYSIS_WIDTH = 160
+
+logger = logging.getLogger()
+
+
+class TranscoderBackend(abc.ABC):
+    """Turns recordings into a GIF named after the first one
+
+    `transcode` returns a CreateJob like response ({'Job': {'Id': ...}})
+    whichever backend makes the GIF, so reports don't depend on it.
+
+    """
+
+    name = ''
+
+    def accepts(self, bucket: str, object_keys: List[str],
+                heads: Optional[Dict[str, Dict]] = None) -> bool:
+        """Whether the backend takes these recordings, the first backend
+        which does makes the GIF
+
+        `heads` are the HeadObject responses of the recordings by key
+        when the caller already has them.
+
+        """
+        return True
+
+    @abc.abstractmethod
+    def transcode(self, bucket: str, object_keys: List[str],
+                  preset_id: str) -> Dict:
+        pass
+
+
+class ElasticTranscoderBackend(TranscoderBackend):
+    """Submits a job to an elastic transcoder pipeline, the notification
+    function learns about the GIF from the pipeline's SNS topic
+
+    """
+
+    name = 'elastictranscoder'
+
+    def __init__(self, submit: Callable[[List[str], str], Dict]) -> None:
+        self.submit = submit
+
+    def transcode(self, bucket: str, object_keys: List[str],
+                  preset_id: str) -> Dict:
+        return self.submit(object_keys, preset_id)
+
+
+class FFmpegBackend(TranscoderBackend):
+    """Makes the GIF inside the function with ffmpeg
+
+    Recordings are streamed from S3 into a scratch directory under
+    /tmp, encoded with the size and frame rate of the preset tier and
+    the GIF is written to the output bucket. The job status is then
+    handed to `notify` as if the pipeline had published it, so short
+    clips skip the pipeline queue and the SNS hop. Recordings larger
+    than `max_bytes` are left to the next backend.
+
+    With `motion_stage` on (and NumPy installed) the clip is cropped to
+    the region with motion and near duplicate frames are dropped before
+    it's encoded, see motion.plan.
+
+    """
+
+    name = 'ffmpeg'
+
+    def __init__(self, client: Callable[[str], Any], output_bucket: str,
+                 notify: Callable[[TranscoderJobStatus], None],
+                 tiers: Sequence[PresetTier] = DEFAULT_TIERS,
+                 max_bytes: int = 8 * 1024 * 1024,
+                 ffmpeg: str = 'ffmpeg', timeout: float = 60.0,
+                 tmp_dir: Optional[str] = None, motion_stage: bool = False,
+                 run: Callable[..., Any] = subprocess.run) -> None:
+        self.client = client
+        self.output_bucket = output_bucket
+        self.notify = notify
+        self.tiers = {tier.id: tier for tier in tiers}
+        self.max_bytes = max_bytes
+        self.ffmpeg = ffmpeg
+        self.timeout = timeout
+        self.tmp_dir = tmp_dir
+        self.motion_stage = motion_stage
+        self.run = run
+
+    def accepts(self, bucket: str, object_keys: List[str],
+                heads: Optional[Dict[str, Dict]] = None) -> bool:
+        if heads is None:
+            s3 = self.client('s3')
+            heads = {key: s3.head_object(Bucket=bucket, Key=key)
+                     for key in object_keys}
+        size = sum(heads[key]['ContentLength'] for key in object_keys)
+        return size <= self.max_bytes
+
+    def transcode(self, bucket: str, object_keys: List[str],
+                  preset_id: str) -> Dict:
+        job_id = 'ffmpeg-{}'.format(uuid.uuid4().hex)
+        tier = self.tiers.get(preset_id, DEFAULT_TIERS[0])
+        name, _ = os.path.splitext(object_keys[0])
+        output_key = '{}.gif'.format(name)
+
+        workdir = tempfile.mkdtemp(prefix='cynnig-', dir=self.tmp_dir)
+        try:
+            inputs = [self.download(bucket, key, workdir)
+                      for key in object_keys]
+            started = time.perf_counter()
+            cut = self.analyse(inputs, tier, workdir)
+            analysed = time.perf_counter()
+            gif = os.path.join(workdir, 'output.gif')
+            self.encode(inputs, tier, gif, workdir, cut)
+            encoded = time.perf_counter()
+            size = os.path.getsize(gif)
+            with open(gif, 'rb') as body:
+                self.client('s3').put_object(
+                    Bucket=self.output_bucket, Key=output_key, Body=body,
+                    ContentType='image/gif')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        self.notify({
+            'state': 'COMPLETED',
+            'outputs': [{'key': output_key, 'presetId': preset_id,
+                         'status': 'Complete'}]
+        })
+        result: Dict = {'Job': {'Id': job_id}}
+        if cut is not None:
+            result['Motion'] = savings(cut, size, analysed - started,
+                                       encoded - analysed)
+            logger.info('motion stage of %s: %s', output_key,
+                        result['Motion'])
+        return result
+
+    def download(self, bucket: str, key: str, workdir: str) -> str:
+        path = os.path.join(workdir, '{}-{}'.format(
+            len(os.listdir(workdir)), os.path.basename(key)))
+        response = self.client('s3').get_object(Bucket=bucket, Key=key)
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: response['Body'].read(CHUNK_SIZE), b''):
+                f.write(chunk)
+        return path
+
+    def analyse(self, inputs: List[str], tier: PresetTier,
+                workdir: str) -> Optional[motion.MotionPlan]:
+        """Decodes small grey frames of the clip and plans the crop and
+        the frames to drop, None when the stage is off or NumPy is
+        missing
+
+        """
+        if not self.motion_stage or not motion.available():
+            return None
+        import numpy as np
+
+        width = ANALYSIS_WIDTH
+        height = max(2, int(round(width * tier.height / tier.width)))
+        filters = 'fps={:g},scale={}:{},format=gray'.format(
+            tier.fps, width, height)
+        output = self.ffmpeg_run(
+            self.input_arguments(inputs, workdir)
+            + ['-vf', filters, '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+            stdout=subprocess.PIPE)
+        frames = np.frombuffer(output.stdout, dtype=np.uint8)
+        return motion.plan(frames.reshape(-1, height, width))
+
+    def encode(self, inputs: List[str], tier: PresetTier, output: str,
+               workdir: str,
+               cut: Optional[motion.MotionPlan] = None) -> None:
+        filters = ['fps={:g}'.format(tier.fps)]
+        if cut is not None:
+            filters += cut_filters(cut)
+        # a palette made for the clip instead of the generic GIF one
+        filters.append(
+            'scale={}:{}:force_original_aspect_ratio=decrease:flags=lanczos,'
+            'split[frames][palette];[palette]palettegen[p];'
+            '[frames][p]paletteuse'.format(tier.width, tier.height))
+        self.ffmpeg_run(
+            self.input_arguments(inputs, workdir)
+            # frames keep their timestamps, dropped ones lengthen the
+            # delay of the frame before them
+            + ['-vf', ','.join(filters), '-vsync', 'vfr', '-loop', '0',
+               output],
+            stdout=subprocess.DEVNULL)
+
+    def input_arguments(self, inputs: List[str], workdir: str) -> List[str]:
+        if len(inputs) == 1:
+            return ['-i', inputs[0]]
+        playlist = os.path.join(workdir, 'inputs.txt')
+        with open(playlist, 'w') as f:
+            f.writelines("file '{}'\n".format(path) for path in inputs)
+        return ['-f', 'concat', '-safe', '0', '-i', playlist]
+
+    def ffmpeg_run(self, arguments: List[str], stdout: int) -> Any:
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-y']
+        try:
+            return self.run(command + arguments, stdout=stdout,
+                            stderr=subprocess.PIPE, timeout=self.timeout,
+                            check=True)
+        except subprocess.CalledProcessError as e:
+            error = (e.stderr or b'').decode('utf-8', 'replace').strip()
+            raise RuntimeError('ffmpeg failed: {}'.format(
+                error.splitlines()[-1] if error else e.returncode)) from None
+
+
+def cut_filters(cut: motion.MotionPlan) -> List[str]:
+    """ffmpeg filters which crop to the motion and drop the frames the
+    plan leaves out
+
+    """
+    x, y, width, height = cut.box
+    filters = []
+    if (width, height) != (1.0, 1.0):
+        filters.append('crop=iw*{:.4f}:ih*{:.4f}:iw*{:.4f}:ih*{:.4f}'.format(
+            width, height, x, y))
+    if len(cut.frames) < cut.total:
+        filters.append("select='{}'".format('+'.join(
+            r'eq(n\,{})'.format(i) for i in cut.frames)))
+    return filters
+
+
+def savings(cut: motion.MotionPlan, size: int, analysis: float,
+            encoding: float) -> Dict:
+    """What the motion stage saved on a clip: frames and pixels left
+    out, the GIF size against the estimate for the full clip, and the
+    time spent
+
+    """
+    return {
+        'frames': len(cut.frames),
+        'totalFrames': cut.total,
+        'pixelRatio': round(cut.pixel_ratio, 4),
+        'bytes': size,
+        'fullBytesEstimate': int(round(size / cut.pixel_ratio))
+        if cut.pixel_ratio else size,
+        'analysisMs': round(analysis * 1000, 1),
+        'encodeMs': round(encoding * 1000, 1),
+    }
@@ -0,0 +1,231 @@
+import logging
+import os
+import sys
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CWD, 'lib'))
+
+import clients
+import crhelper
+from pipelines import shard_name
+
+from typing import Dict, List, Tuple
+from lambda_types import LambdaContext, ElasticTranscoderClient, \
+    VideoPipelineData, PipelineInfo, CustomResourceUpdateRequest, \
+    CustomResourceRequest, VideoPipelineProperties, GifPresetData, \
+    GifPresetProperties, PresetInfo
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+def elastictranscoder_resource_handler(
+        event: CustomResourceRequest, context: LambdaContext) -> None:
+    """AWS Lambda handler for ElasticTranscoder service to
+    create/update and delete Video Pipelines and GIF Presets
+    (Custom::ElasticTranscoderPreset) from using CFN
+
+    """
+    clients.configure(context)
+    try:
+        logger = crhelper.log_config(event)
+        init_failed = False
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        init_failed = True
+
+    if event['ResourceType'] == 'Custom::ElasticTranscoderPreset':
+        crhelper.cfn_handler(event, context, create_preset, update_preset,
+                             delete_preset, logger, init_failed)
+    else:
+        crhelper.cfn_handler(event, context, create_pipeline,
+                             update_pipeline, delete_pipeline, logger,
+                             init_failed)
+
+
+def create_pipeline(event: CustomResourceRequest, context: LambdaContext,
+                    generation: str = '') -> Tuple[str, VideoPipelineData]:
+    """Creates ShardCount pipelines, the physical id lists their ids
+    separated by commas
+
+    """
+    properties = event['ResourceProperties']
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    created: List[PipelineInfo] = []
+    try:
+        for shard in range(shard_count(properties)):
+            result = client.create_pipeline(
+                Name=shard_name(properties['DisplayName'], shard, generation),
+                InputBucket=properties['InputBucket'],
+                OutputBucket=properties['OutputBucket'],
+                Role=properties['Role'],
+                Notifications=notifications(properties)
+            )
+            created.append(result['Pipeline'])
+    except Exception:
+        # CloudFormation doesn't know about shards of a failed create
+        for pipeline in created:
+            delete_pipelines(client, [pipeline['Id']])
+        raise
+    return pipelines_data(created)
+
+
+def update_pipeline(event: CustomResourceUpdateRequest,
+                    context: LambdaContext) -> Tuple[str, VideoPipelineData]:
+    """Updates the pipelines in place, a new set of pipelines is created
+    when the number of shards changes or one of them is gone, and
+    CloudFormation then deletes the old set
+
+    The names of a new set carry a generation taken from the request
+    id, both sets exist until the old one is deleted.
+
+    """
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    pipeline_ids = event['PhysicalResourceId'].split(',')
+    properties = event['ResourceProperties']
+    if len(pipeline_ids) != shard_count(properties):
+        logger.debug('resharding %s', event['PhysicalResourceId'])
+        return create_pipeline(event, context, request_generation(event))
+
+    existing: List[PipelineInfo] = []
+    for pipeline_id in pipeline_ids:
+        try:
+            read_response = client.read_pipeline(Id=pipeline_id)
+        except client.exceptions.ResourceNotFoundException:
+            logger.debug('resource %s not found', pipeline_id)
+            return create_pipeline(event, context, request_generation(event))
+        existing.append(read_response['Pipeline'])
+
+    if event['OldResourceProperties'] == properties:
+        return pipelines_data(existing)
+
+    for shard, pipeline in enumerate(existing):
+        client.update_pipeline(
+            Id=pipeline['Id'],
+            Name=shard_name(properties['DisplayName'], shard),
+            InputBucket=properties['InputBucket'],
+            Role=properties['Role'],
+            Notifications=notifications(properties),
+            ContentConfig={
+                'Bucket': properties['OutputBucket']
+            },
+            ThumbnailConfig={
+                'Bucket': properties['OutputBucket']
+            }
+        )
+    return pipelines_data(existing)
+
+
+def delete_pipeline(event: CustomResourceRequest,
+                    context: LambdaContext) -> None:
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    delete_pipelines(client, event['PhysicalResourceId'].split(','))
+
+
+def delete_pipelines(client: ElasticTranscoderClient,
+                     pipeline_ids: List[str]) -> None:
+    for pipeline_id in pipeline_ids:
+        try:
+            client.delete_pipeline(Id=pipeline_id)
+        except client.exceptions.ResourceNotFoundException:
+            logger.debug('resource %s not found', pipeline_id)
+
+
+def request_generation(event: CustomResourceRequest) -> str:
+    return event['RequestId'][:6].lower()
+
+
+def shard_count(properties: VideoPipelineProperties) -> int:
+    count = int(properties.get('ShardCount', 1))
+    if count < 1:
+        raise ValueError('ShardCount must be at least 1, got {}'.format(
+            count))
+    return count
+
+
+def notifications(properties: VideoPipelineProperties) -> Dict[str, str]:
+    sns = properties['Notifications']
+    return {
+        'Progressing': sns,
+        'Completed': sns,
+        'Warning': sns,
+        'Error': sns
+    }
+
+
+def pipelines_data(
+        pipelines: List[PipelineInfo]) -> Tuple[str, VideoPipelineData]:
+    pipeline_ids = ','.join(pipeline['Id'] for pipeline in pipelines)
+    data = {
+        'Arn': pipelines[0]['Arn'],
+        'Id': pipelines[0]['Id'],
+        'Ids': pipeline_ids
+    }
+    return pipeline_ids, data
+
+
+def create_preset(event: CustomResourceRequest,
+                  context: LambdaContext) -> Tuple[str, GifPresetData]:
+    """Creates a looping GIF preset with png thumbnails of the same
+    size, the physical id is the preset id
+
+    """
+    properties: GifPresetProperties = event['ResourceProperties']
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    result = client.create_preset(
+        # names are up to 40 characters, the end tells the tiers apart
+        Name=properties['DisplayName'][-40:],
+        Description='GIF of motion recordings',
+        Container='gif',
+        Video={
+            'Codec': 'gif',
+            'CodecOptions': {'Loop': 'Infinite'},
+            'FrameRate': str(properties['FrameRate']),
+            'MaxWidth': str(properties['Width']),
+            'MaxHeight': str(properties['Height']),
+            'SizingPolicy': 'ShrinkToFit',
+            'PaddingPolicy': 'NoPad',
+            'DisplayAspectRatio': 'auto'
+        },
+        Thumbnails={
+            'Format': 'png',
+            'Interval': '60',
+            'MaxWidth': str(properties['Width']),
+            'MaxHeight': str(properties['Height']),
+            'SizingPolicy': 'ShrinkToFit',
+            'PaddingPolicy': 'NoPad'
+        }
+    )
+    return preset_data(result['Preset'])
+
+
+def update_preset(event: CustomResourceUpdateRequest,
+                  context: LambdaContext) -> Tuple[str, GifPresetData]:
+    """Presets can't be changed, a new one is created when the
+    properties change or the preset is gone, and CloudFormation then
+    deletes the old one
+
+    """
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    if event['OldResourceProperties'] != event['ResourceProperties']:
+        return create_preset(event, context)
+    try:
+        read_response = client.read_preset(Id=event['PhysicalResourceId'])
+    except client.exceptions.ResourceNotFoundException:
+        logger.debug('resource %s not found', event['PhysicalResourceId'])
+        return create_preset(event, context)
+    return preset_data(read_response['Preset'])
+
+
+def delete_preset(event: CustomResourceRequest,
+                  context: LambdaContext) -> None:
+    client: ElasticTranscoderClient = clients.client('elastictranscoder')
+    try:
+        client.delete_preset(Id=event['PhysicalResourceId'])
+    except client.exceptions.ResourceNotFoundException:
+        logger.debug('resource %s not found', event['PhysicalResourceId'])
+
+
+def preset_data(preset: PresetInfo) -> Tuple[str, GifPresetData]:
+    return preset['Id'], {'Id': preset['Id'], 'Arn': preset['Arn']}
@@ -0,0 +1,393 @@
+import json
+import logging
+import os
+import re
+import sys
+import uuid
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CWD, 'lib'))
+
+from clips import THUMBNAIL_PATTERN, is_priority, load_priorities, \
+    parse_clip_key, prioritise
+import clients
+import idempotency as idempotency_store
+from metrics import Metrics
+from pipelines import PipelineResolver, ShardLoad, rendezvous
+from presets import SYSTEM_GIF_PRESET, clip_duration, load_tiers, \
+    select_preset
+from throttling import THROTTLING_ERRORS, TokenBucket, retry_throttled
+from transcoders import ElasticTranscoderBackend, FFmpegBackend, \
+    TranscoderBackend
+
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from lambda_types import LambdaContext, S3UpdateEvent, \
+    ElasticTranscoderClient, TranscodingReport, S3UpdateRecord, SQSEvent, \
+    SQSBatchResponse, TranscoderJobStatus
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+metrics = Metrics(os.environ.get('METRICS_NAMESPACE'))
+pipelines = PipelineResolver(
+    ttl=float(os.environ.get('PIPELINE_CACHE_TTL', 300)))
+
+idempotency = idempotency_store.from_url(
+    os.environ.get('IDEMPOTENCY_STORE', 'memory'),
+    lambda name: metrics.instrument(clients.client(name)),
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+    lease=float(os.environ.get('IDEMPOTENCY_LEASE', 900)))
+
+# GIF presets from the best to the smallest output
+preset_tiers = load_tiers(os.environ.get('GIF_PRESETS'))
+
+# camera id -> high|normal, see clips.prioritise
+camera_priorities = load_priorities(os.environ.get('CAMERA_PRIORITY'))
+
+# jobs submitted to each pipeline shard, see choose_pipeline
+shard_load = ShardLoad(window=float(os.environ.get('SHARD_WINDOW', 60)))
+
+# client side limit for elastic transcoder CreateJob requests per second
+job_rate = TokenBucket(rate=float(os.environ.get('CREATE_JOB_RATE', 20)))
+
+# throttled CreateJob calls are retried with retry_throttled, not by
+# botocore as well
+clients.retried_by_caller('elastictranscoder', THROTTLING_ERRORS)
+
+# a pooled connection for each job submitted concurrently
+clients.configure(
+    max_pool_connections=int(os.environ.get('JOB_CONCURRENCY', 4)))
+
+
+@metrics.handler
+def new_motion_video_handler(
+        event: Union[S3UpdateEvent, SQSEvent], context: LambdaContext
+) -> Union[List[TranscodingReport], SQSBatchResponse]:
+    """AWS Lambda handler which receives notifications with new video
+    recording and send a request to elastic transcoder to make a GIF,
+    which can be viewed in a chat app
+
+    Jobs are submitted concurrently, the result is a report for each
+    record, so one failed record doesn't abort the rest of the batch.
+
+    The notifications either come from S3 directly or in a batch of
+    SQS messages. For SQS the result lists the messages with a failed
+    record (batchItemFailures), only those are received again. For S3
+    the handler raises once the other jobs are submitted when any
+    record failed, so Lambda retries the event.
+
+    """
+    logger.debug('EVENT: %s', event)
+    clients.configure(context)
+    if not is_sqs_event(event):
+        report = transcode_records(event['Records'])
+        logger.info('REPORT: %s', report)
+        failures = [result['key'] for result in report
+                    if result['status'] == 'FAILED']
+        if failures:
+            raise RuntimeError('failed to schedule {}'.format(
+                ', '.join(failures)))
+        return report
+
+    records, message_ids, failed = sqs_records(event)
+    report = transcode_records(records)
+    logger.info('REPORT: %s', report)
+    for message_id, result in zip(message_ids, report):
+        if result['status'] == 'FAILED' and message_id not in failed:
+            failed.append(message_id)
+    return {'batchItemFailures': [{'itemIdentifier': message_id}
+                                  for message_id in failed]}
+
+
+def is_sqs_event(event: Union[S3UpdateEvent, SQSEvent]) -> bool:
+    records = event.get('Records') or [{}]
+    return records[0].get('eventSource') == 'aws:sqs'
+
+
+def sqs_records(
+        event: SQSEvent) -> Tuple[List[S3UpdateRecord], List[str], List[str]]:
+    """S3 records of the messages in a batch, the id of the message of
+    each record and the ids of messages which couldn't be parsed
+
+    S3 sends an s3:TestEvent without records when the notification is
+    set up, such messages have nothing to transcode.
+
+    """
+    records: List[S3UpdateRecord] = []
+    message_ids: List[str] = []
+    malformed: List[str] = []
+    for message in event['Records']:
+        try:
+            body = json.loads(message['body'])
+            s3_records = [record for record in body.get('Records', [])
+                          if record['s3']['object']['key']]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error('malformed message %s: %s', message['messageId'], e)
+            malformed.append(message['messageId'])
+            continue
+        records.extend(s3_records)
+        message_ids.extend(message['messageId'] for _ in s3_records)
+    return records, message_ids, malformed
+
+
+def transcode_records(
+        records: List[S3UpdateRecord]) -> List[TranscodingReport]:
+    if not records:
+        return []
+    client: ElasticTranscoderClient = metrics.instrument(
+        clients.client('elastictranscoder'))
+    pipeline_ids: List[str] = find_pipeline_ids(client)
+
+    report: Dict[str, TranscodingReport] = {}
+    record_ids: Dict[str, str] = {}
+    sequencers: Dict[str, str] = {}
+    buckets: Dict[str, str] = {}
+    for record in records:
+        object_key = record['s3']['object']['key']
+        buckets[object_key] = record['s3'].get('bucket', {}).get('name', '')
+        record_id = s3_record_id(record)
+        sequencer = record['s3']['object'].get('sequencer', '')
+        if idempotency.claim(record_id, sequencer):
+            record_ids[object_key] = record_id
+            sequencers[object_key] = sequencer
+        else:
+            logger.info('%s is already scheduled', object_key)
+            report[object_key] = {'key': object_key, 'status': 'SKIPPED'}
+
+    # clips of high priority cameras aren't coalesced and are submitted
+    # first, to their own pipeline when there is one
+    window = float(os.environ.get('COALESCE_WINDOW', 0))
+    groups = prioritise(list(record_ids), window, camera_priorities)
+    backends = transcoder_backends(client, pipeline_ids)
+    priority_ids = os.environ.get('PRIORITY_PIPELINE_ID')
+    priority_backends = transcoder_backends(
+        client, priority_ids.split(',')) if priority_ids else backends
+
+    workers = int(os.environ.get('JOB_CONCURRENCY', 4))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(
+            transcode_group,
+            priority_backends if is_priority(group[0], camera_priorities)
+            else backends,
+            buckets[group[0]], group)
+            for group in groups]
+
+    for group, future in zip(groups, futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error('failed to schedule %s: %s', ', '.join(group), e,
+                         exc_info=True)
+            for object_key in group:
+                idempotency.release(record_ids[object_key])
+                report[object_key] = {'key': object_key, 'status': 'FAILED',
+                                      'error': str(e)}
+        else:
+            logger.debug('job scheduled: %s', result)
+            savings = result.get('Motion')
+            for object_key in group:
+                idempotency.complete(record_ids[object_key],
+                                     sequencers[object_key])
+                report[object_key] = {'key': object_key,
+                                      'status': 'SUCCEEDED',
+                                      'jobId': result.get('Job', {}).get('Id')}
+                if savings:
+                    report[object_key]['motion'] = savings
+    return [report[record['s3']['object']['key']] for record in records]
+
+
+def s3_record_id(record: S3UpdateRecord) -> str:
+    obj = record['s3']['object']
+    bucket = record['s3'].get('bucket', {}).get('name', '')
+    version = obj.get('eTag') or obj.get('sequencer') or ''
+    return 's3:{}/{}:{}'.format(bucket, obj['key'], version)
+
+
+def transcode_group(backends: List[TranscoderBackend], bucket: str,
+                    object_keys: List[str]) -> Dict:
+    clip = parse_clip_key(object_keys[0])
+    dimensions = {'Camera': clip.camera} if clip else {}
+    with metrics.timer('transcode', **dimensions):
+        heads = None
+        if len(preset_tiers) > 1 or len(backends) > 1:
+            heads = head_objects(bucket, object_keys)
+            if heads is None:
+                # only the pipeline, the last backend, takes recordings
+                # of unknown size
+                backends = backends[-1:]
+        preset_id = SYSTEM_GIF_PRESET
+        if heads and len(preset_tiers) > 1:
+            preset_id = choose_preset(heads)
+        backend = next(backend for backend in backends
+                       if backend.accepts(bucket, object_keys, heads))
+        logger.debug('%s makes the GIF of %s', backend.name,
+                     ', '.join(object_keys))
+        return backend.transcode(bucket, object_keys, preset_id)
+
+
+def transcoder_backends(client: ElasticTranscoderClient,
+                        pipeline_ids: List[str]) -> List[TranscoderBackend]:
+    """Backends which may make a GIF, in order of preference
+
+    With TRANSCODER_BACKEND=ffmpeg recordings up to FFMPEG_MAX_BYTES
+    are transcoded inside the function, elastic transcoder takes the
+    rest. MOTION_STAGE crops those GIFs to the motion and drops near
+    duplicate frames.
+
+    """
+    backends: List[TranscoderBackend] = []
+    if os.environ.get('TRANSCODER_BACKEND') == 'ffmpeg':
+        backends.append(FFmpegBackend(
+            lambda name: metrics.instrument(clients.client(name)),
+            output_bucket=os.environ['PIPELINE_BUCKET'],
+            notify=notify_delivery,
+            tiers=preset_tiers,
+            max_bytes=int(os.environ.get('FFMPEG_MAX_BYTES', 8388608)),
+            ffmpeg=os.environ.get('FFMPEG_PATH', 'ffmpeg'),
+            timeout=float(os.environ.get('FFMPEG_TIMEOUT', 60)),
+            motion_stage=bool(os.environ.get('MOTION_STAGE'))))
+    backends.append(ElasticTranscoderBackend(
+        partial(submit_transcoding, client, pipeline_ids)))
+    return backends
+
+
+def notify_delivery(job: TranscoderJobStatus) -> None:
+    """Invokes the notification function with the status of a job
+    made in the function, wrapped like the pipeline's SNS messages
+
+    """
+    event = {'Records': [{'Sns': {'MessageId': uuid.uuid4().hex,
+                                  'Message': json.dumps(job)}}]}
+    metrics.instrument(clients.client('lambda')).invoke(
+        FunctionName=os.environ['NOTIFICATION_FUNCTION'],
+        InvocationType='Event',
+        Payload=json.dumps(event).encode('utf-8'))
+
+
+def choose_pipeline(pipeline_ids: List[str], object_key: str) -> str:
+    """Picks the pipeline shard of a job
+
+    With SHARD_STRATEGY=hash (the default) the clips of a camera always
+    go to the same shard, so they're transcoded in order. With
+    least-loaded a job goes to the shard with the fewest jobs
+    submitted recently, which spreads a burst from one camera.
+
+    """
+    if len(pipeline_ids) == 1:
+        return pipeline_ids[0]
+    if os.environ.get('SHARD_STRATEGY', 'hash') == 'least-loaded':
+        return shard_load.pick(pipeline_ids)
+    clip = parse_clip_key(object_key)
+    return rendezvous(clip.camera if clip else object_key, pipeline_ids)
+
+
+def head_objects(bucket: str,
+                 object_keys: List[str]) -> Optional[Dict[str, Dict]]:
+    """HeadObject responses of the recordings by key, None when one of
+    them fails
+
+    """
+    s3 = metrics.instrument(clients.client('s3'))
+    try:
+        return {key: s3.head_object(Bucket=bucket, Key=key)
+                for key in object_keys}
+    except (ClientError, BotoCoreError) as e:
+        logger.warning('HeadObject of %s failed, using the system GIF '
+                       'preset: %s', ', '.join(object_keys), e)
+        return None
+
+
+def choose_preset(heads: Dict[str, Dict]) -> str:
+    """Picks the GIF preset whose output is expected to stay under
+    GIF_BUDGET bytes, based on the length of the recordings
+
+    """
+    bitrate = float(os.environ.get('INPUT_BITRATE', 250000))
+    duration = sum(clip_duration(head, bitrate) for head in heads.values())
+    budget = float(os.environ.get('GIF_BUDGET', 5 * 1024 * 1024))
+    tier = select_preset(preset_tiers, duration, budget)
+    logger.debug('preset %s for %.1fs of %s', tier.id, duration,
+                 ', '.join(heads))
+    return tier.id
+
+
+def submit_transcoding(client: ElasticTranscoderClient,
+                       pipeline_ids: List[str], object_keys: List[str],
+                       preset_id: str = SYSTEM_GIF_PRESET) -> Dict:
+    pipeline_id = choose_pipeline(pipeline_ids, object_keys[0])
+    try:
+        return throttled_transcoding(client, pipeline_id, object_keys,
+                                     preset_id)
+    except client.exceptions.ResourceNotFoundException:
+        if os.environ.get('PIPELINE_ID'):
+            raise
+        # the cached pipeline is gone (e.g. the stack recreated it),
+        # look it up again and retry once
+        logger.debug('pipeline %s not found', pipeline_id)
+        pipelines.invalidate()
+        pipeline_id = choose_pipeline(find_pipeline_ids(client),
+                                      object_keys[0])
+        return throttled_transcoding(client, pipeline_id, object_keys,
+                                     preset_id)
+
+
+def throttled_transcoding(client: ElasticTranscoderClient, pipeline_id: str,
+                          object_keys: List[str], preset_id: str) -> Dict:
+    def create_job() -> Dict:
+        job_rate.acquire()
+        return schedule_gif_transcoding(client, pipeline_id, object_keys[0],
+                                        concatenate=object_keys[1:],
+                                        preset_id=preset_id)
+
+    return retry_throttled(create_job)
+
+
+def schedule_gif_transcoding(client: ElasticTranscoderClient, pipeline_id: str,
+                             object_key: str,
+                             concatenate: Sequence[str] = (),
+                             preset_id: str = SYSTEM_GIF_PRESET) -> Dict:
+    """Creates a job to make a GIF out of a recording
+
+    Recordings listed in `concatenate` are appended to the first one,
+    the GIF is named after the first recording.
+
+    """
+    name, _ = os.path.splitext(object_key)
+    output_key = '{}.gif'.format(name)
+    output = {
+        'PresetId': preset_id,
+        'Key': output_key
+    }
+    if os.environ.get('THUMBNAIL_FORMAT'):
+        output['ThumbnailPattern'] = THUMBNAIL_PATTERN.format(name)
+    if concatenate:
+        inputs = [{'Key': key} for key in [object_key, *concatenate]]
+        return client.create_job(PipelineId=pipeline_id, Inputs=inputs,
+                                 Output=output)
+    return client.create_job(
+        PipelineId=pipeline_id,
+        Input={
+            'Key': object_key
+        },
+        Output=output
+    )
+
+
+def find_pipeline_ids(client: ElasticTranscoderClient) -> List[str]:
+    """Ids of the pipeline shards, PIPELINE_ID may list them separated
+    by commas (VideoPipeline.Ids)
+
+    Without it the shards are looked up by the stack name, leaving out
+    the priority pipeline (PriorityVideoPipeline) of the same stack.
+
+    """
+    pipeline_ids = os.environ.get('PIPELINE_ID')
+    if pipeline_ids:
+        return pipeline_ids.split(',')
+    stack_name = os.environ['STACK_NAME']
+    return pipelines.resolve_all(
+        client, stack_name,
+        exclude='{} priority pipeline'.format(re.escape(stack_name)))
@@ -0,0 +1,120 @@
+# coding: utf-8
+
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class FakeRocketChat:
+    """Rocket.Chat REST API stand-in running on a local port
+
+    Records every request it receives and answers login, info and
+    rooms.upload calls. Handlers can be overridden per path. `latency`
+    seconds are added to every response. Without `keep_alive` the
+    server closes each connection after the response, without telling
+    the client.
+
+    """
+
+    def __init__(self, user_id='test-user-id', auth_token='test-auth-token',
+                 latency=0.0):
+        self.user_id = user_id
+        self.auth_token = auth_token
+        self.latency = latency
+        self.keep_alive = True
+        self.requests = []
+        self.handlers = {}
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def do_PUT(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def connections(self):
+        return {request['client'] for request in self.requests}
+
+    def route(self, path):
+        def register(handler):
+            self.handlers[path] = handler
+            return handler
+        return register
+
+    def _handle(self, http):
+        length = int(http.headers.get('Content-Length') or 0)
+        body = http.rfile.read(length)
+        path = urlparse(http.path).path
+        request = {
+            'client': http.client_address,
+            'method': http.command,
+            'path': path,
+            'headers': dict(http.headers),
+            'body': body
+        }
+        with self._lock:
+            self.requests.append(request)
+
+        handler = next((h for pattern, h in self.handlers.items()
+                        if re.fullmatch(pattern, path)), self._default)
+        status, headers, payload = handler(request)
+        if self.latency:
+            time.sleep(self.latency)
+        data = json.dumps(payload).encode('utf-8')
+        http.send_response(status)
+        http.send_header('Content-Type', 'application/json')
+        http.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            http.send_header(name, value)
+        http.end_headers()
+        http.wfile.write(data)
+        if not self.keep_alive:
+            http.close_connection = True
+
+    def _default(self, request):
+        if request['path'] == '/api/v1/login':
+            data = {'userId': self.user_id, 'authToken': self.auth_token}
+            return 200, {}, {'status': 'success', 'data': data}
+        if request['headers'].get('X-Auth-Token') != self.auth_token:
+            return 401, {}, {'status': 'error', 'message': 'unauthorized'}
+        return 200, {}, {'success': True}
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+import pytest
+
+from unittest.mock import Mock
+from cynnig.lib import clients
+from cynnig.lib.throttling import THROTTLING_ERRORS
+
+
+@pytest.fixture()
+def session(monkeypatch):
+    clients.reset()
+    session = Mock()
+    monkeypatch.setattr(clients, '_session', session)
+    monkeypatch.setattr(clients, '_options', dict(clients._options))
+    yield session
+    clients.reset()
+
+
+def test_client_created_once(session):
+    assert clients.client('s3') is clients.client('s3')
+    session.client.assert_called_once()
+    assert session.client.call_args[0] == ('s3',)
+
+
+def test_reset(session):
+    clients.client('s3')
+    clients.reset()
+    assert clients._session is None
+
+
+def test_inject(session):
+    service = Mock()
+    clients.inject('s3', service)
+    assert clients.client('s3') is service
+    session.client.assert_not_called()
+
+
+def test_pool_size(session):
+    clients.configure(max_pool_connections=8)
+    clients.client('s3')
+    config = session.client.call_args[1]['config']
+    assert config.max_pool_connections == 8
+    assert config.retries == {'mode': 'adaptive', 'max_attempts': 3}
+
+
+class RawResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self):
+        yield self.body
+
+
+@pytest.mark.parametrize('code, status, by_caller, calls', [
+    ('ThrottlingException', 400, True, 1),
+    ('InternalFailure', 500, True, 4),
+    ('ThrottlingException', 400, False, 4),
+])
+def test_retried_by_caller(code, status, by_caller, calls, monkeypatch):
+    from botocore.awsrequest import AWSResponse
+    from botocore.exceptions import ClientError
+    clients.reset()
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr('botocore.retries.standard.ExponentialBackoff'
+                        '.delay_amount', lambda self, context: 0)
+    monkeypatch.setattr(clients, '_caller_retries', {})
+    if by_caller:
+        clients.retried_by_caller('elastictranscoder', THROTTLING_ERRORS)
+    service = clients.client('elastictranscoder')
+    assert service.meta.config.tcp_keepalive
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        body = b'{"message": "boom"}'
+        return AWSResponse(request.url, status,
+                           {'x-amzn-ErrorType': code}, RawResponse(body))
+
+    service.meta.events.register('before-send', send)
+    with pytest.raises(ClientError) as e:
+        service.list_pipelines()
+    assert e.value.response['Error']['Code'] == code
+    assert len(sent) == calls
+    clients.reset()
+
+
+def test_timeouts_capped_by_remaining_time(session):
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    clients.configure(context)
+    config = clients.config()
+    assert (config.connect_timeout, config.read_timeout) == (2.5, 5.0)
+
+    context.get_remaining_time_in_millis.return_value = 900000
+    clients.configure(context)
+    config = clients.config()
+    assert (config.connect_timeout, config.read_timeout) == \
+        (clients.CONNECT_TIMEOUT, clients.READ_TIMEOUT)
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+from datetime import datetime
+import pytest
+
+from cynnig.lib.clips import Clip, parse_clip_key, coalesce, thumbnail_key, \
+    thumbnail_output_key, load_priorities, prioritise
+
+
+def test_parse_clip_key():
+    assert parse_clip_key('01-20180730195708.mkv') == \
+        Clip('01-20180730195708.mkv', '01', datetime(2018, 7, 30, 19, 57, 8))
+    assert parse_clip_key('garden/front-door-20180730195708.gif') == \
+        Clip('garden/front-door-20180730195708.gif', 'front-door',
+             datetime(2018, 7, 30, 19, 57, 8))
+    assert parse_clip_key('01-latest.mkv') is None
+    assert parse_clip_key('01-20181399999999.mkv') is None
+
+
+def test_coalesce_back_to_back_clips():
+    keys = ['01-20180730195708.mkv',
+            '02-20180730195710.mkv',
+            '01-20180730195800.mkv',
+            'snapshot.mkv',
+            '01-20180730195830.mkv',
+            '01-20180730201000.mkv']
+    assert coalesce(keys, window=60) == [
+        ['01-20180730195708.mkv', '01-20180730195800.mkv',
+         '01-20180730195830.mkv'],
+        ['02-20180730195710.mkv'],
+        ['snapshot.mkv'],
+        ['01-20180730201000.mkv']
+    ]
+
+
+def test_coalesce_orders_clips_by_time():
+    keys = ['01-20180730195800.mkv', '01-20180730195708.mkv']
+    assert coalesce(keys, window=60) == [
+        ['01-20180730195708.mkv', '01-20180730195800.mkv']
+    ]
+
+
+def test_coalesce_max_inputs():
+    keys = ['01-2018073019570{}.mkv'.format(i) for i in range(5)]
+    assert coalesce(keys, window=60, max_inputs=2) == [
+        keys[0:2], keys[2:4], keys[4:5]
+    ]
+
+
+def test_load_priorities():
+    assert load_priorities('') == {}
+    assert load_priorities('{"01": "high", "02": "normal"}') == \
+        {'01': 'high', '02': 'normal'}
+    with pytest.raises(ValueError):
+        load_priorities('{"01": "urgent"}')
+
+
+def test_prioritise_skips_coalescing():
+    keys = ['01-20180730195708.mkv',
+            '02-20180730195710.mkv',
+            '01-20180730195750.mkv',
+            '02-20180730195750.mkv']
+    assert prioritise(keys, window=60, priorities={'02': 'high'}) == [
+        ['02-20180730195710.mkv'],
+        ['02-20180730195750.mkv'],
+        ['01-20180730195708.mkv', '01-20180730195750.mkv']
+    ]
+    assert prioritise(keys[:2], window=0, priorities={}) == \
+        [[keys[0]], [keys[1]]]
+
+
+def test_thumbnail_key():
+    key = thumbnail_key('01-20180730195708.gif', 'png')
+    assert key == '01-20180730195708-00001.png'
+    assert thumbnail_output_key(key) == '01-20180730195708.gif'
+    assert thumbnail_output_key('01-20180730195708.gif') is None
@@ -3,8 +3,8 @@
 import json
 import pytest
 
-from cynnig import app
-from unittest.mock import Mock
+from cynnig import resource_handler
+from unittest.mock import MagicMock, Mock, call
 
 
 REQUEST_ID = '41F948A0-D65C-4C1C-9BAC-9EA2E57557DA'
@@ -123,26 +123,26 @@ def lambda_context():
 
 
 @pytest.fixture()
-def requests(monkeypatch):
-    requests = Mock()
-    response = requests.put.return_value
+def urlopen(monkeypatch):
+    urlopen = MagicMock()
+    response = urlopen.return_value.__enter__.return_value
     response.reason = "OK"
-    monkeypatch.setattr('crhelper.requests', requests)
-    return requests
+    monkeypatch.setattr('crhelper.urlopen', urlopen)
+    return urlopen
 
 
 @pytest.fixture()
 def session(monkeypatch):
     session_mock = Mock()
-    monkeypatch.setattr('cynnig.app.session', session_mock)
+    monkeypatch.setattr('clients.client', session_mock.client)
     return session_mock
 
 
-def test_create(create_event, lambda_context, session, requests):
+def test_create(create_event, lambda_context, session, urlopen):
     create_pipeline_test(
-        app.elastictranscoder_resource_handler,
+        resource_handler.elastictranscoder_resource_handler,
         create_event, lambda_context, session, PIPELINE_ARN, PIPELINE_ID,
-        requests)
+        urlopen)
     client = session.client.return_value
     client.create_pipeline.assert_called_with(
         Name=DISPLAY_NAME,
@@ -162,17 +162,17 @@ class ResourceNotFoundException(Exception):
     pass
 
 
-def test_update_not_found(update_event, lambda_context, session, requests):
+def test_update_not_found(update_event, lambda_context, session, urlopen):
     client = session.client.return_value
     client.exceptions.ResourceNotFoundException = ResourceNotFoundException
     client.read_pipeline.side_effect = ResourceNotFoundException()
     create_pipeline_test(
-        app.elastictranscoder_resource_handler,
+        resource_handler.elastictranscoder_resource_handler,
         update_event, lambda_context, session, PIPELINE_ARN, PIPELINE_ID,
-        requests)
+        urlopen)
     client.read_pipeline.assert_called_with(Id=PIPELINE_ID)
     client.create_pipeline.assert_called_with(
-        Name=DISPLAY_NAME_UPDATED,
+        Name=DISPLAY_NAME_UPDATED + ' 41f948',
         InputBucket=INPUT_BUCKET_UPDATED,
         OutputBucket=OUTPUT_BUCKET_UPDATED,
         Role=ROLE_ARN_UPDATED,
@@ -185,25 +185,25 @@ def test_update_not_found(update_event, lambda_context, session, requests):
     )
 
 
-def test_non_update(non_update_event, lambda_context, session, requests):
+def test_non_update(non_update_event, lambda_context, session, urlopen):
     data = {
         'Arn': PIPELINE_ARN,
         'Id': PIPELINE_ID
     }
     client = session.client.return_value
     client.read_pipeline.return_value = {'Pipeline': data}
-    app.elastictranscoder_resource_handler(non_update_event, lambda_context)
-    assert_cfn_response(requests, data)
+    resource_handler.elastictranscoder_resource_handler(non_update_event, lambda_context)
+    assert_cfn_response(urlopen, dict(data, Ids=PIPELINE_ID))
 
 
-def test_update(update_event, lambda_context, session, requests):
+def test_update(update_event, lambda_context, session, urlopen):
     data = {
         'Arn': PIPELINE_ARN,
         'Id': PIPELINE_ID
     }
     client = session.client.return_value
     client.read_pipeline.return_value = {'Pipeline': data}
-    app.elastictranscoder_resource_handler(update_event, lambda_context)
+    resource_handler.elastictranscoder_resource_handler(update_event, lambda_context)
     sns = SNS_ARN_UPDATED
     client.update_pipeline.assert_called_with(
         Id=PIPELINE_ID,
@@ -223,27 +223,27 @@ def test_update(update_event, lambda_context, session, requests):
             'Bucket': OUTPUT_BUCKET_UPDATED
         }
     )
-    assert_cfn_response(requests, data)
+    assert_cfn_response(urlopen, dict(data, Ids=PIPELINE_ID))
 
 
-def test_delete(delete_event, lambda_context, session, requests):
-    app.elastictranscoder_resource_handler(delete_event, lambda_context)
+def test_delete(delete_event, lambda_context, session, urlopen):
+    resource_handler.elastictranscoder_resource_handler(delete_event, lambda_context)
     client = session.client.return_value
     client.delete_pipeline.assert_called_with(Id=PIPELINE_ID)
-    assert_cfn_response(requests)
+    assert_cfn_response(urlopen)
 
 
-def test_delete_not_found(delete_event, lambda_context, session, requests):
+def test_delete_not_found(delete_event, lambda_context, session, urlopen):
     client = session.client.return_value
     client.exceptions.ResourceNotFoundException = ResourceNotFoundException
     client.delete_pipeline.side_effect = ResourceNotFoundException()
-    app.elastictranscoder_resource_handler(delete_event, lambda_context)
+    resource_handler.elastictranscoder_resource_handler(delete_event, lambda_context)
     client.delete_pipeline.assert_called_with(Id=PIPELINE_ID)
-    assert_cfn_response(requests)
+    assert_cfn_response(urlopen)
 
 
 def create_pipeline_test(lambda_fn, event, context, session,
-                         pipeline_arn, pipeline_id, requests):
+                         pipeline_arn, pipeline_id, urlopen):
     data = {
         'Arn': pipeline_arn,
         'Id': pipeline_id
@@ -251,14 +251,77 @@ def create_pipeline_test(lambda_fn, event, context, session,
     client = session.client.return_value
     client.create_pipeline.return_value = {'Pipeline': data}
     lambda_fn(event, context)
-    assert_cfn_response(requests, data)
+    assert_cfn_response(urlopen, dict(data, Ids=pipeline_id))
 
 
-def assert_cfn_response(requests, data=None):
+def test_create_shards(create_event, lambda_context, session, urlopen):
+    create_event['ResourceProperties']['ShardCount'] = '3'
+    client = session.client.return_value
+    client.create_pipeline.side_effect = [
+        {'Pipeline': {'Arn': PIPELINE_ARN + str(shard),
+                      'Id': PIPELINE_ID + str(shard)}}
+        for shard in range(3)
+    ]
+    resource_handler.elastictranscoder_resource_handler(create_event,
+                                                        lambda_context)
+    assert [c[1]['Name'] for c in client.create_pipeline.call_args_list] == [
+        DISPLAY_NAME, DISPLAY_NAME + ' 1', DISPLAY_NAME + ' 2']
+    ids = ','.join(PIPELINE_ID + str(shard) for shard in range(3))
+    assert_cfn_response(urlopen, {'Arn': PIPELINE_ARN + '0',
+                                   'Id': PIPELINE_ID + '0', 'Ids': ids},
+                        physical_id=ids)
+
+
+def test_create_shards_failed(create_event, lambda_context, session,
+                              urlopen):
+    create_event['ResourceProperties']['ShardCount'] = '2'
+    client = session.client.return_value
+    client.create_pipeline.side_effect = [
+        {'Pipeline': {'Arn': PIPELINE_ARN, 'Id': PIPELINE_ID}},
+        ValueError('limit exceeded')
+    ]
+    resource_handler.elastictranscoder_resource_handler(create_event,
+                                                        lambda_context)
+    client.delete_pipeline.assert_called_once_with(Id=PIPELINE_ID)
+    assert json.loads(sent_request(urlopen).data)['Status'] == 'FAILED'
+
+
+def test_update_reshards(update_event, lambda_context, session, urlopen):
+    update_event['ResourceProperties']['ShardCount'] = '2'
+    client = session.client.return_value
+    client.create_pipeline.side_effect = [
+        {'Pipeline': {'Arn': PIPELINE_ARN + str(shard),
+                      'Id': PIPELINE_ID + str(shard)}}
+        for shard in range(2)
+    ]
+    resource_handler.elastictranscoder_resource_handler(update_event,
+                                                        lambda_context)
+    client.read_pipeline.assert_not_called()
+    client.update_pipeline.assert_not_called()
+    # the old pipelines exist until CloudFormation deletes them
+    assert [c[1]['Name'] for c in client.create_pipeline.call_args_list] == [
+        DISPLAY_NAME_UPDATED + ' 41f948', DISPLAY_NAME_UPDATED + ' 41f948 1']
+    response = json.loads(sent_request(urlopen).data)
+    assert response['PhysicalResourceId'] == \
+        '{0}0,{0}1'.format(PIPELINE_ID)
+
+
+def test_delete_shards(delete_event, lambda_context, session, urlopen):
+    delete_event['PhysicalResourceId'] = PIPELINE_ID + ',' + PIPELINE_ID + '1'
+    client = session.client.return_value
+    client.exceptions.ResourceNotFoundException = ResourceNotFoundException
+    client.delete_pipeline.side_effect = [ResourceNotFoundException(), {}]
+    resource_handler.elastictranscoder_resource_handler(delete_event,
+                                                        lambda_context)
+    assert client.delete_pipeline.call_args_list == [
+        call(Id=PIPELINE_ID), call(Id=PIPELINE_ID + '1')]
+
+
+def assert_cfn_response(urlopen, data=None, physical_id=PIPELINE_ID):
     response_obj = {
         'Status': 'SUCCESS',
         'Reason': 'See details in CloudWatch Log Stream: log_stream_name',
-        'PhysicalResourceId': PIPELINE_ID,
+        'PhysicalResourceId': physical_id,
         'StackId': STACK_ID,
         'RequestId': REQUEST_ID,
         'LogicalResourceId': LOGICAL_RESOURCE_ID
@@ -268,11 +331,97 @@ def assert_cfn_response(requests, data=None):
         response_obj['Data'] = data
 
     response_body = json.dumps(response_obj)
-    requests.put.assert_called_with(
-        'https://httpbin.org/put',
-        data=response_body,
-        headers={
-            'content-type': '',
-            'content-length': str(len(response_body))
+    request = sent_request(urlopen)
+    assert request.get_method() == 'PUT'
+    assert request.full_url == 'https://httpbin.org/put'
+    assert request.data == response_body.encode('utf-8')
+    assert request.headers == {
+        'Content-type': '',
+        'Content-length': str(len(response_body))
+    }
+
+
+def sent_request(urlopen):
+    (request,), _ = urlopen.call_args
+    return request
+
+
+PRESET_ARN = 'arn:aws:elastictranscoder:eu-west-1:034029384242:preset/1532349581389-preset'
+PRESET_ID = '1532349581389-preset'
+
+
+@pytest.fixture()
+def preset_event():
+    return {
+        'RequestType': 'Create',
+        'RequestId': REQUEST_ID,
+        'ResponseURL': 'https://httpbin.org/put',
+        'ResourceType': 'Custom::ElasticTranscoderPreset',
+        'LogicalResourceId': LOGICAL_RESOURCE_ID,
+        'StackId': STACK_ID,
+        'ResourceProperties': {
+            'DisplayName': 'test-stack GIF 320x180',
+            'Width': '320',
+            'Height': '180',
+            'FrameRate': '10'
         }
-    )
+    }
+
+
+def test_create_preset(preset_event, lambda_context, session, urlopen):
+    client = session.client.return_value
+    client.create_preset.return_value = {
+        'Preset': {'Arn': PRESET_ARN, 'Id': PRESET_ID}}
+    resource_handler.elastictranscoder_resource_handler(preset_event,
+                                                        lambda_context)
+    client.create_pipeline.assert_not_called()
+    preset = client.create_preset.call_args[1]
+    assert preset['Name'] == 'test-stack GIF 320x180'
+    assert preset['Container'] == 'gif'
+    assert preset['Video']['Codec'] == 'gif'
+    assert preset['Video']['FrameRate'] == '10'
+    assert (preset['Video']['MaxWidth'], preset['Video']['MaxHeight']) == \
+        ('320', '180')
+    assert preset['Thumbnails']['Format'] == 'png'
+    assert_cfn_response(urlopen, {'Id': PRESET_ID, 'Arn': PRESET_ARN},
+                        physical_id=PRESET_ID)
+
+
+def test_update_preset(preset_event, lambda_context, session, urlopen):
+    client = session.client.return_value
+    client.read_preset.return_value = {
+        'Preset': {'Arn': PRESET_ARN, 'Id': PRESET_ID}}
+    client.create_preset.return_value = {
+        'Preset': {'Arn': PRESET_ARN + '-new', 'Id': PRESET_ID + '-new'}}
+    preset_event.update({
+        'RequestType': 'Update',
+        'PhysicalResourceId': PRESET_ID,
+        'OldResourceProperties': dict(preset_event['ResourceProperties'])
+    })
+    resource_handler.elastictranscoder_resource_handler(preset_event,
+                                                        lambda_context)
+    client.create_preset.assert_not_called()
+    assert_cfn_response(urlopen, {'Id': PRESET_ID, 'Arn': PRESET_ARN},
+                        physical_id=PRESET_ID)
+
+    # presets are immutable, CloudFormation deletes the replaced one
+    preset_event['ResourceProperties']['FrameRate'] = '15'
+    resource_handler.elastictranscoder_resource_handler(preset_event,
+                                                        lambda_context)
+    assert client.create_preset.call_args[1]['Video']['FrameRate'] == '15'
+    assert_cfn_response(urlopen, {'Id': PRESET_ID + '-new',
+                                   'Arn': PRESET_ARN + '-new'},
+                        physical_id=PRESET_ID + '-new')
+
+
+def test_delete_preset(preset_event, lambda_context, session, urlopen):
+    client = session.client.return_value
+    client.exceptions.ResourceNotFoundException = ResourceNotFoundException
+    client.delete_preset.side_effect = ResourceNotFoundException()
+    preset_event.update({'RequestType': 'Delete',
+                         'PhysicalResourceId': PRESET_ID})
+    resource_handler.elastictranscoder_resource_handler(preset_event,
+                                                        lambda_context)
+    client.delete_preset.assert_called_once_with(Id=PRESET_ID)
+    client.delete_pipeline.assert_not_called()
+    assert_cfn_response(urlopen, physical_id=PRESET_ID)
@@ -0,0 +1,133 @@
+# coding: utf-8
+
+import random
+import struct
+import pytest
+
+from cynnig.lib import gifopt
+
+np = pytest.importorskip('numpy')
+
+
+def animation(count=10, height=60, width=80):
+    """A gradient with a red square moving across it"""
+    frames = np.zeros((count, height, width, 3), np.uint8)
+    frames[:, :, :, 1] = np.linspace(0, 200, width).astype(np.uint8)
+    for i in range(count):
+        frames[i, 20:30, i * 5:i * 5 + 10] = [250, 20, 20]
+    return gifopt.Animation(frames, [10] * count, 0)
+
+
+def test_sibling_key():
+    assert gifopt.sibling_key('01-20180730195708.gif') == \
+        '01-20180730195708.optimised.gif'
+
+
+@pytest.mark.parametrize('size', [10, 5000, 100000])
+def test_lzw_roundtrip(size):
+    rng = random.Random(size)
+    # runs and noise, long enough to fill the code table and clear it
+    data = bytes(rng.choice([0, 0, 0, 1, rng.randrange(256)])
+                 for _ in range(size))
+    encoded = gifopt.lzw_encode(data, 8)
+    assert gifopt.lzw_decode(encoded, 8, len(data)) == data
+
+
+def test_lzw_runs_roundtrip():
+    rng = random.Random(0)
+    # runs around RUN_LENGTH and long enough to clear the code table
+    data = b''.join(bytes([rng.choice([0, 255, rng.randrange(256)])]) *
+                    rng.choice([1, 2, gifopt.RUN_LENGTH - 1,
+                                gifopt.RUN_LENGTH, 40, 5000])
+                    for _ in range(3000))
+    encoded = gifopt.lzw_encode(data, 8)
+    assert len(encoded) < len(data) / 10
+    assert gifopt.lzw_decode(encoded, 8, len(data)) == data
+
+
+def test_encode_decode():
+    original = animation()
+    data = gifopt.encode(original)
+    decoded = gifopt.decode(data)
+    assert (decoded.frames == original.frames).all()
+    assert decoded.delays == original.delays
+    assert decoded.loop == 0
+
+
+def test_repeated_frames_merged():
+    original = animation(count=3)
+    frames = np.concatenate([original.frames, original.frames[-1:]])
+    data = gifopt.encode(gifopt.Animation(frames, [10, 10, 10, 25], None))
+    decoded = gifopt.decode(data)
+    assert len(decoded.frames) == 3
+    assert decoded.delays == [10, 10, 35]
+    assert decoded.loop is None
+
+
+def test_palette_reduced():
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 256, (2, 40, 40, 3)).astype(np.uint8)
+    palette, indices = gifopt.global_palette(frames)
+    assert len(palette) <= gifopt.PALETTE_SIZE
+    assert indices.max() < gifopt.TRANSPARENT
+    error = np.abs(palette[indices].astype(int) - frames).mean()
+    assert error < 32
+
+
+def full_frames(original):
+    """GIF with every frame in full, as the system preset writes it"""
+    palette, indices = gifopt.global_palette(original.frames)
+    count, height, width, _ = original.frames.shape
+    table = np.zeros((256, 3), np.uint8)
+    table[:len(palette)] = palette
+    data = b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0)
+    data += table.tobytes()
+    for i in range(count):
+        data += struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0, 10, 0, 0)
+        data += struct.pack('<BHHHHB', 0x2C, 0, 0, width, height, 0)
+        data += b'\x08' + gifopt._blocks(
+            gifopt.lzw_encode(indices[i].tobytes(), 8))
+    return data + b'\x3B'
+
+
+def test_optimise_smaller():
+    original = animation(count=14)
+    plain = full_frames(original)
+    assert (gifopt.decode(plain).frames == original.frames).all()
+
+    optimised = gifopt.optimise(plain)
+    assert len(optimised) < len(plain)
+    assert (gifopt.decode(optimised).frames == original.frames).all()
+
+
+def test_palette_sampled():
+    rng = np.random.RandomState(0)
+    count, height, width = 12, 40, 60
+    # each frame has a colour table of its own, too many colours for
+    # one palette
+    tables = rng.randint(0, 256, (count, 256, 3)).astype(np.uint8)
+    indices = np.zeros((count, height, width), np.uint8)
+    for i in range(count):
+        indices[i] = rng.randint(0, 256, (height // 4, width // 4)).repeat(
+            4, axis=0).repeat(4, axis=1)
+    data = b'GIF89a' + struct.pack('<HHBBB', width, height, 0x70, 0, 0)
+    for i in range(count):
+        data += struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0, 10, 0, 0)
+        data += struct.pack('<BHHHHB', 0x2C, 0, 0, width, height, 0x87)
+        data += tables[i].tobytes() + b'\x08' + gifopt._blocks(
+            gifopt.lzw_encode(indices[i].tobytes(), 8))
+    data += b'\x3B'
+    original = np.stack([tables[i][indices[i]] for i in range(count)])
+    assert (gifopt.decode(data).frames == original).all()
+
+    screen, frames = gifopt.parse(data)
+    palette = gifopt.sample_palette(screen, frames)
+    assert len(palette) == gifopt.PALETTE_SIZE
+    pixels = original.reshape(-1, 3)
+    mapped = palette[gifopt.nearest(pixels, palette)]
+    assert np.abs(mapped.astype(int) - pixels).mean() < 32
+
+
+def test_optimise_not_a_gif():
+    with pytest.raises(ValueError):
+        gifopt.optimise(b'\x89PNG')
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+import os
+import pytest
+import time
+import uuid
+
+from cynnig.lib import idempotency
+from cynnig.lib.idempotency import IdempotencyStore, MemoryBackend, \
+    SQLiteBackend, DynamoDBBackend
+
+DYNAMODB_ENDPOINT = os.environ.get('DYNAMODB_ENDPOINT')
+
+
+def dynamodb_backend():
+    if not DYNAMODB_ENDPOINT:
+        pytest.skip('DYNAMODB_ENDPOINT (DynamoDB Local) is not set')
+    import boto3
+    client = boto3.client('dynamodb', endpoint_url=DYNAMODB_ENDPOINT,
+                          region_name='us-east-1',
+                          aws_access_key_id='local',
+                          aws_secret_access_key='local')
+    table = 'cynnig-test-{}'.format(uuid.uuid4().hex)
+    client.create_table(
+        TableName=table,
+        KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'key', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    return DynamoDBBackend(table, lambda: client)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'dynamodb'])
+def backend(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryBackend()
+    if request.param == 'sqlite':
+        return SQLiteBackend(str(tmpdir.join('idempotency.db')))
+    return dynamodb_backend()
+
+
+def test_claim(backend):
+    store = IdempotencyStore(backend)
+    assert store.claim('s3:bucket/01-20180730195708.mkv:etag', 'seq')
+    assert not store.claim('s3:bucket/01-20180730195708.mkv:etag', 'seq')
+    assert store.get('s3:bucket/01-20180730195708.mkv:etag') == 'seq'
+
+
+def test_release(backend):
+    store = IdempotencyStore(backend)
+    assert store.claim('gif:01-20180730195708.gif')
+    store.release('gif:01-20180730195708.gif')
+    assert store.claim('gif:01-20180730195708.gif')
+
+
+def test_expired(backend):
+    store = IdempotencyStore(backend, ttl=-1)
+    assert store.claim('gif:01-20180730195708.gif')
+    store.complete('gif:01-20180730195708.gif')
+    assert store.get('gif:01-20180730195708.gif') is None
+    assert store.claim('gif:01-20180730195708.gif')
+
+
+def test_lapsed_claim(backend):
+    store = IdempotencyStore(backend, lease=-1)
+    assert store.claim('gif:01-20180730195708.gif')
+    assert store.claim('gif:01-20180730195708.gif')
+
+
+def test_complete(backend):
+    store = IdempotencyStore(backend, lease=-1)
+    assert store.claim('gif:01-20180730195708.gif')
+    store.complete('gif:01-20180730195708.gif', 'message-id')
+    assert not store.claim('gif:01-20180730195708.gif')
+    assert store.get('gif:01-20180730195708.gif') == 'message-id'
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        idempotency.Backend()
+
+
+def test_memory_evicts_least_recently_used():
+    backend = MemoryBackend(max_size=2)
+    expires_at = time.time() + 60
+    backend.put('a', '', expires_at)
+    backend.put('b', '', expires_at)
+    backend.get('a')
+    backend.put('c', '', expires_at)
+    assert backend.get('a') == ''
+    assert backend.get('b') is None
+
+
+def test_from_url(tmpdir):
+    clients = []
+    path = str(tmpdir.join('idempotency.db'))
+    assert isinstance(idempotency.from_url('memory', clients.append).backend,
+                      MemoryBackend)
+    sqlite = idempotency.from_url('sqlite:' + path, clients.append).backend
+    assert sqlite.path == path
+    dynamodb = idempotency.from_url('dynamodb:table', clients.append).backend
+    assert dynamodb.table == 'table'
+    assert clients == []
+    with pytest.raises(ValueError):
+        idempotency.from_url('redis:localhost', clients.append)
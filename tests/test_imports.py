@@ -0,0 +1,25 @@
+# coding: utf-8
+
+import os
+import subprocess
+import sys
+import pytest
+
+CYNNIG = os.path.join(os.path.dirname(__file__), os.pardir, 'cynnig')
+
+# modules a handler leaves for later, so they don't add to cold starts
+DEFERRED = {
+    'video_handler': ['boto3', 'requests', 'rocketchat', 'crhelper',
+                      'asyncio'],
+    'gifs_handler': ['boto3', 'crhelper', 'asyncio'],
+    'resource_handler': ['boto3', 'requests', 'rocketchat', 'asyncio'],
+}
+
+
+@pytest.mark.parametrize('handler', sorted(DEFERRED))
+def test_handler_imports(handler):
+    script = 'import sys, {}; print(" ".join(sys.modules))'.format(handler)
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=CYNNIG)
+    imported = output.decode('utf-8').split()
+    assert [name for name in DEFERRED[handler] if name in imported] == []
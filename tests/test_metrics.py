@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import boto3
+import json
+
+from botocore.stub import Stubber
+from unittest.mock import Mock
+from cynnig.lib.metrics import Metrics, UNTIMED
+
+
+def test_disabled():
+    metrics = Metrics(None, emit=Mock())
+
+    def handler(event, context):
+        return 'done'
+
+    assert metrics.handler(handler) is handler
+    assert metrics.timed('phase')(handler) is handler
+    assert metrics.timer('phase') is UNTIMED
+    client = Mock()
+    assert metrics.instrument(client) is client
+    client.meta.events.register.assert_not_called()
+
+
+def test_emf_records():
+    lines = []
+    metrics = Metrics('cynnig', emit=lines.append, clock=lambda: 1534090839.0)
+
+    @metrics.handler
+    def handler(event, context):
+        with metrics.timer('deliver', Camera='01'):
+            pass
+        with metrics.timer('deliver', Camera='01'):
+            pass
+        metrics.record('s3.GetObject', 12.5)
+
+    handler({}, None)
+    handler({}, None)
+    records = [json.loads(line) for line in lines]
+    assert len(records) == 4
+    cold = records[0]
+    assert cold['_aws'] == {
+        'Timestamp': 1534090839000,
+        'CloudWatchMetrics': [{
+            'Namespace': 'cynnig',
+            'Dimensions': [['Camera', 'Handler', 'Phase', 'Start']],
+            'Metrics': [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+        }]
+    }
+    assert cold['Handler'] == 'handler'
+    assert cold['Start'] == 'cold'
+    assert cold['Phase'] == 'deliver'
+    assert len(cold['Latency']) == 2
+    assert records[1]['Latency'] == [12.5]
+    assert [r['Start'] for r in records[2:]] == ['warm', 'warm']
+
+
+def test_instrument_client():
+    lines = []
+    metrics = Metrics('cynnig', emit=lines.append)
+    client = boto3.Session(region_name='eu-west-1',
+                           aws_access_key_id='test',
+                           aws_secret_access_key='test').client('kms')
+    metrics.instrument(client)
+    metrics.instrument(client)
+    with Stubber(client) as stubber:
+        stubber.add_response('decrypt', {'Plaintext': b'password'})
+        client.decrypt(CiphertextBlob=b'ciphertext')
+    metrics.flush()
+    records = [json.loads(line) for line in lines]
+    assert [(r['Phase'], len(r['Latency'])) for r in records] == \
+        [('kms.Decrypt', 1)]
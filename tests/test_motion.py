@@ -0,0 +1,50 @@
+# coding: utf-8
+
+import pytest
+
+from cynnig.lib import motion
+
+np = pytest.importorskip('numpy')
+
+
+def clip(count=20, height=90, width=160):
+    """Grey frames with a square moving across the bottom right corner
+    during the first half of the clip and still afterwards
+
+    """
+    frames = np.full((count, height, width), 100, dtype=np.uint8)
+    for i in range(count):
+        x = 110 + min(i, count // 2) * 2
+        frames[i, 60:70, x:x + 10] = 250
+    return frames
+
+
+def test_plan_crops_to_motion():
+    cut = motion.plan(clip(), margin=0.0, min_crop=0.0)
+    x, y, width, height = cut.box
+    assert (x * 160, y * 90) == (110, 60)
+    assert (width * 160, height * 90) == (30, 10)
+
+
+def test_plan_margin_and_min_crop():
+    cut = motion.plan(clip(), margin=0.1, min_crop=0.25)
+    x, y, width, height = cut.box
+    assert width * 160 == 40
+    # 10 rows of motion widened to a quarter of the frame
+    assert round(height * 90) == 22
+    assert 0 <= x and x + width <= 1
+    assert 0 <= y and y + height <= 1
+
+
+def test_plan_drops_still_frames():
+    cut = motion.plan(clip())
+    assert cut.total == 20
+    assert cut.frames == list(range(11)) + [19]
+    assert cut.pixel_ratio < 0.2
+
+
+def test_plan_without_motion():
+    frames = np.zeros((5, 90, 160), dtype=np.uint8)
+    cut = motion.plan(frames)
+    assert cut.box == (0.0, 0.0, 1.0, 1.0)
+    assert cut.frames == [0, 4]
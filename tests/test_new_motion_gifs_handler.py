@@ -1,11 +1,22 @@
 # coding: utf-8
 
+import io
 import json
 import pytest
+import time
 
 from base64 import b64encode
+from botocore.exceptions import ClientError, NoCredentialsError
 from unittest.mock import Mock, MagicMock, sentinel
-from cynnig import app
+from cynnig import gifs_handler
+from cynnig.lib.idempotency import IdempotencyStore, MemoryBackend
+
+@pytest.fixture(autouse=True)
+def idempotency(monkeypatch):
+    store = IdempotencyStore(MemoryBackend())
+    monkeypatch.setattr('cynnig.gifs_handler.idempotency', store)
+    return store
+
 
 @pytest.fixture()
 def sns_job_completed_lambda_event():
@@ -31,45 +42,495 @@ def sns_job_completed_lambda_event():
     }
 
 
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv('ROCKET_USERNAME', 'test/username')
+    monkeypatch.setenv('ROCKET_PASSWORD', 'kms:' + b64encode(b'pwd').decode())
+    monkeypatch.setenv('ROCKET_SERVER', 'https://rocket.test.srv')
+    monkeypatch.setenv('ROCKET_ROOM_ID', 'test/room-id')
+    monkeypatch.setenv('PIPELINE_BUCKET', 'test-output-bucket')
+
+
+@pytest.fixture()
+def s3():
+    return MagicMock()
+
+
+@pytest.fixture()
+def get_client(s3, monkeypatch):
+    session = Mock()
+    session.client.side_effect = lambda name: KMS() if name == 'kms' else s3
+    monkeypatch.setattr('clients.client', session.client)
+    get_client = Mock()
+    monkeypatch.setattr('cynnig.gifs_handler.rocketchat.get_client',
+                        get_client)
+    return get_client
+
+
+@pytest.fixture()
+def chat(get_client):
+    return get_client.return_value
+
+
+@pytest.fixture(autouse=True)
+def secrets():
+    gifs_handler.secrets.invalidate()
+    yield gifs_handler.secrets
+    gifs_handler.secrets.invalidate()
+
+
 class KMS:
 
+    def __init__(self):
+        self.calls = 0
+
     def decrypt(self, CiphertextBlob):
+        self.calls += 1
         return {
             'Plaintext': CiphertextBlob + b'-decrypted'
         }
 
 
-def test_new_motion_video_handler(sns_job_completed_lambda_event, monkeypatch):
-    monkeypatch.setenv('ROCKET_USERNAME', 'test/username')
+def test_new_motion_video_handler(sns_job_completed_lambda_event, s3,
+                                  get_client, monkeypatch):
     encoded_pwd = b64encode(b'test/password').decode('ascii')
     monkeypatch.setenv('ROCKET_PASSWORD', encoded_pwd)
-    monkeypatch.setenv('ROCKET_SERVER', 'https://rocket.test.srv')
-    monkeypatch.setenv('ROCKET_ROOM_ID', 'test/room-id')
-    monkeypatch.setenv('PIPELINE_BUCKET', 'test-output-bucket')
-
-    s3 = MagicMock()
-    s3_obj = s3.get_object.return_value
-    s3_obj.__getitem__.return_value = sentinel.s3_file
-    def mocked_client(name):
-        if name == 'kms':
-            return KMS()
-        elif name == 's3':
-            return s3
-
-    session = Mock()
-    session.client.side_effect = mocked_client
-    monkeypatch.setattr('cynnig.app.session', session)
-    rocket_chat = Mock()
-    chat = rocket_chat.return_value
-    monkeypatch.setattr('cynnig.app.RocketChat', rocket_chat)
-    app.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
-    rocket_chat.assert_called_with(
+    s3.get_object.return_value = {
+        'Body': sentinel.s3_file,
+        'ContentLength': 1024
+    }
+    gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    get_client.assert_called_with(
         'https://rocket.test.srv',
         username='test/username',
-        password='test/password-decrypted'
+        password='test/password-decrypted',
+        token_cache=None,
+        timer=None
     )
-    s3_obj.__getitem__.assert_called_with('Body')
     s3.get_object.assert_called_with(
         Bucket='test-output-bucket', Key='25-20180801023512.gif')
-    chat.upload.assert_called_with(
-        'test/room-id', '25-20180801023512.gif', sentinel.s3_file)
+    args, kwargs = get_client.return_value.upload.call_args
+    assert args == ('test/room-id', '25-20180801023512.gif', sentinel.s3_file)
+    assert kwargs['size'] == 1024
+    assert kwargs['deadline'] is None
+
+
+def test_password_decrypted_once(sns_job_completed_lambda_event, monkeypatch):
+    encoded_pwd = b64encode(b'test/password').decode('ascii')
+    monkeypatch.setenv('ROCKET_PASSWORD', encoded_pwd)
+    kms = KMS()
+    session = Mock()
+    session.client.side_effect = \
+        lambda name: kms if name == 'kms' else MagicMock()
+    monkeypatch.setattr('clients.client', session.client)
+    monkeypatch.setattr('cynnig.gifs_handler.rocketchat.get_client', Mock())
+    gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    assert kms.calls == 1
+
+
+def test_failed_upload_does_not_drop_others(s3, chat):
+    keys = ['01-20180801023512.gif', '02-20180801023513.gif',
+            '03-20180801023514.gif']
+    event = {
+        'Records': [
+            {'Sns': {'Message': json.dumps({
+                'state': 'COMPLETED',
+                'outputs': [{'key': key} for key in keys[:2]]
+            })}},
+            {'Sns': {'Message': json.dumps({
+                'state': 'COMPLETED',
+                'outputs': [{'key': keys[2]}]
+            })}}
+        ]
+    }
+
+    s3.get_object.side_effect = \
+        lambda Bucket, Key: {'Body': Key, 'ContentLength': 1024}
+
+    def upload(room_id, name, body, size, reopen, deadline):
+        if name == keys[1]:
+            raise IOError('connection reset')
+
+    chat.upload.side_effect = upload
+    with pytest.raises(RuntimeError, match='failed to deliver ' + keys[1]):
+        gifs_handler.new_motion_gifs_handler(event, None)
+    assert [c[0][1] for c in chat.upload.call_args_list] == keys
+
+
+def test_s3_slot_held_while_streaming(s3, chat, monkeypatch):
+    monkeypatch.setenv('S3_CONCURRENCY', '1')
+    monkeypatch.setenv('CHAT_CONCURRENCY', '2')
+    monkeypatch.setenv('DELIVERY_WORKERS', '2')
+    keys = ['01-20180801023512.gif', '02-20180801023513.gif']
+    event = {'Records': [{'Sns': {'Message': json.dumps({
+        'state': 'COMPLETED', 'outputs': [{'key': key} for key in keys]})}}]}
+    streaming = []
+    overlapped = []
+
+    def upload(room_id, key, body, **kwargs):
+        streaming.append(key)
+        overlapped.append(len(streaming) > 1)
+        time.sleep(0.05)
+        streaming.remove(key)
+
+    chat.upload.side_effect = upload
+    report = gifs_handler.new_motion_gifs_handler(event, None)
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 2
+    assert overlapped == [False, False]
+
+
+def test_redelivered_output_skipped(sns_job_completed_lambda_event, chat):
+    gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    report = gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    assert report == [{'key': '25-20180801023512.gif', 'status': 'SKIPPED'}]
+    assert chat.upload.call_count == 1
+
+
+def test_uploads_not_digested(chat, monkeypatch):
+    monkeypatch.setenv('DIGEST_WINDOW', '120')
+    monkeypatch.setenv('DELIVERY_WORKERS', '1')
+    keys = ['01-20180801023512.gif', '01-20180801023600.gif',
+            '02-20180801023540.gif']
+    event = {
+        'Records': [
+            {'Sns': {'MessageId': str(i), 'Message': json.dumps({
+                'state': 'COMPLETED',
+                'outputs': [{'key': key}]
+            })}}
+            for i, key in enumerate(keys)
+        ]
+    }
+
+    report = gifs_handler.new_motion_gifs_handler(event, None)
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 3
+    chat.post_message.assert_not_called()
+    uploads = [(c[0][1], c[1].get('text'), c[1].get('thread_id'))
+               for c in chat.upload.call_args_list]
+    assert uploads == [(key, None, None) for key in keys]
+
+
+def test_digest_links(s3, chat, monkeypatch):
+    monkeypatch.setenv('DIGEST_WINDOW', '120')
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    keys = ['01-20180801023512.gif', '01-20180801023600.gif']
+    event = {
+        'Records': [
+            {'Sns': {'MessageId': str(i), 'Message': json.dumps({
+                'state': 'COMPLETED',
+                'outputs': [{'key': key}]
+            })}}
+            for i, key in enumerate(keys)
+        ]
+    }
+
+    s3.generate_presigned_url.side_effect = \
+        lambda method, Params, ExpiresIn: 'https://s3/' + Params['Key']
+    report = gifs_handler.new_motion_gifs_handler(event, None)
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 2
+    chat.post_message.assert_called_once_with(
+        'test/room-id', '2 motion clips from camera 01',
+        attachments=[
+            {'title': keys[0], 'image_url': 'https://s3/' + keys[0]},
+            {'title': keys[1], 'image_url': 'https://s3/' + keys[1]}
+        ],
+        deadline=None)
+    chat.upload.assert_not_called()
+
+
+def test_digest_from_queue(s3, chat, monkeypatch):
+    monkeypatch.setenv('DIGEST_WINDOW', '120')
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    monkeypatch.setenv('DELIVERY_WORKERS', '1')
+    keys = ['01-20180801023512.gif', '01-20180801023600.gif',
+            '02-20180801023540.gif']
+    messages = [json.dumps({'state': 'COMPLETED', 'outputs': [{'key': key}]})
+                for key in keys]
+    event = {
+        'Records': [
+            # SNS envelope, raw message delivery and an unparseable body
+            {'messageId': 'm0', 'eventSource': 'aws:sqs',
+             'body': json.dumps({'Type': 'Notification', 'MessageId': 'sns0',
+                                 'Message': messages[0]})},
+            {'messageId': 'm1', 'eventSource': 'aws:sqs',
+             'body': messages[1]},
+            {'messageId': 'm2', 'eventSource': 'aws:sqs',
+             'body': json.dumps({'Type': 'Notification', 'MessageId': 'sns2',
+                                 'Message': messages[2]})},
+            {'messageId': 'm3', 'eventSource': 'aws:sqs', 'body': '{'}
+        ]
+    }
+
+    def post_message(room_id, text=None, attachments=None, **kwargs):
+        if attachments[0]['title'] == keys[2]:
+            raise RuntimeError('post failed')
+
+    s3.generate_presigned_url.side_effect = \
+        lambda method, Params, ExpiresIn: 'https://s3/' + Params['Key']
+    chat.post_message.side_effect = post_message
+    response = gifs_handler.new_motion_gifs_handler(event, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm3'},
+                                              {'itemIdentifier': 'm2'}]}
+    assert chat.post_message.call_args_list[0][0][1] == \
+        '2 motion clips from camera 01'
+    chat.upload.assert_not_called()
+
+
+def test_digest_replaces_thumbnails(s3, chat, idempotency, monkeypatch):
+    monkeypatch.setenv('DIGEST_WINDOW', '120')
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    monkeypatch.setenv('THUMBNAIL_FORMAT', 'png')
+    keys = ['01-20180801023512.gif', '01-20180801023600.gif']
+    progressing = {'Records': [{'Sns': {'Message': json.dumps({
+        'state': 'PROGRESSING',
+        'outputs': [{'key': key, 'thumbnailPattern': key[:-4] + '-{count}'}
+                    for key in keys]})}}]}
+    landed = {'Records': [{'s3': {'object': {
+        'key': '01-20180801023512-00001.png'}}}]}
+    assert gifs_handler.new_motion_gifs_handler(progressing, None) == []
+    assert gifs_handler.new_motion_gifs_handler(landed, None) == []
+    chat.upload.assert_not_called()
+
+    # a thumbnail posted before digests were turned on
+    idempotency.complete('thumb:' + keys[0], 'message-id')
+    completed = {'Records': [{'Sns': {'Message': json.dumps({
+        'state': 'COMPLETED',
+        'outputs': [{'key': key} for key in keys]})}}]}
+    report = gifs_handler.new_motion_gifs_handler(completed, None)
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 2
+    chat.post_message.assert_called_once()
+    assert chat.post_message.call_args[1].get('thread_id') is None
+
+
+def test_priority_camera_skips_digest(s3, chat, monkeypatch):
+    monkeypatch.setenv('DIGEST_WINDOW', '120')
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    monkeypatch.setenv('DELIVERY_WORKERS', '1')
+    monkeypatch.setattr('cynnig.gifs_handler.camera_priorities',
+                        {'02': 'high'})
+    keys = ['01-20180801023512.gif', '02-20180801023540.gif',
+            '02-20180801023600.gif']
+    event = {
+        'Records': [
+            {'Sns': {'MessageId': str(i), 'Message': json.dumps({
+                'state': 'COMPLETED',
+                'outputs': [{'key': key}]
+            })}}
+            for i, key in enumerate(keys)
+        ]
+    }
+
+    s3.generate_presigned_url.side_effect = \
+        lambda method, Params, ExpiresIn: 'https://s3/' + Params['Key']
+    report = gifs_handler.new_motion_gifs_handler(event, None)
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 3
+    chat.upload.assert_not_called()
+    assert [[a['title'] for a in c[1]['attachments']]
+            for c in chat.post_message.call_args_list] == \
+        [[keys[1]], [keys[2]], [keys[0]]]
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+def test_thumbnail_then_gif(s3, chat, monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_FORMAT', 'png')
+    key = '01-20180801023512.gif'
+    thumbnail = '01-20180801023512-00001.png'
+
+    def notification(state):
+        return {'Records': [{'Sns': {'Message': json.dumps({
+            'state': state,
+            'outputs': [{'key': key,
+                         'thumbnailPattern': '01-20180801023512-{count}'}]
+        })}}]}
+
+    s3.head_object.side_effect = ClientError(
+        {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+    chat.upload.return_value = {'message': {'_id': 'message-id'},
+                                'success': True}
+
+    # not written yet when the job starts
+    report = gifs_handler.new_motion_gifs_handler(notification('PROGRESSING'), None)
+    assert report == [{'key': thumbnail, 'status': 'SKIPPED'}]
+    s3.get_object.assert_not_called()
+
+    s3.head_object.reset_mock()
+    s3.get_object.return_value = {'Body': sentinel.thumbnail,
+                                  'ContentLength': 512}
+    landed = {'Records': [{'s3': {'object': {'key': thumbnail}}}]}
+    report = gifs_handler.new_motion_gifs_handler(landed, None)
+    assert report == [{'key': thumbnail, 'status': 'SUCCEEDED'}]
+    args, _ = chat.upload.call_args
+    assert args == ('test/room-id', thumbnail, sentinel.thumbnail)
+
+    s3.head_object.assert_not_called()
+
+    report = gifs_handler.new_motion_gifs_handler(notification('COMPLETED'), None)
+    assert report == [{'key': key, 'status': 'SUCCEEDED'}]
+    assert chat.upload.call_count == 2
+    args, kwargs = chat.upload.call_args
+    assert args[1] == key
+    assert kwargs['thread_id'] == 'message-id'
+    chat.post_message.assert_not_called()
+
+
+def test_gif_waits_for_thumbnail(idempotency, s3, chat, monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_FORMAT', 'png')
+    key = '01-20180801023512.gif'
+    event = {'Records': [{'Sns': {'MessageId': 'sns-id', 'Message': json.dumps({
+        'state': 'COMPLETED', 'outputs': [{'key': key}]})}}]}
+
+
+    # another invocation is posting the thumbnail
+    idempotency.claim('thumb:' + key, gifs_handler.THUMBNAIL_POSTING)
+    with pytest.raises(RuntimeError, match=key):
+        gifs_handler.new_motion_gifs_handler(event, None)
+    chat.upload.assert_not_called()
+    assert idempotency.get('gif:' + key) is None
+
+    # and the thumbnail isn't posted while the GIF is delivered
+    idempotency.release('thumb:' + key)
+    idempotency.claim('gif:' + key, 'sns-id')
+    landed = {'Records': [{'s3': {'object': {
+        'key': '01-20180801023512-00001.png'}}}]}
+    report = gifs_handler.new_motion_gifs_handler(landed, None)
+    assert report[0]['status'] == 'SKIPPED'
+    chat.upload.assert_not_called()
+    assert idempotency.get('thumb:' + key) is None
+
+
+def test_link_mode(sns_job_completed_lambda_event, s3, chat, monkeypatch):
+    monkeypatch.setenv('DELIVERY_MODE',
+                       json.dumps({'test/room-id': 'link', '*': 'upload'}))
+    key = '25-20180801023512.gif'
+
+    s3.generate_presigned_url.return_value = 'https://s3/' + key
+    report = gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    assert report == [{'key': key, 'status': 'SUCCEEDED'}]
+    chat.post_message.assert_called_once_with(
+        'test/room-id',
+        attachments=[{'title': key, 'image_url': 'https://s3/' + key}],
+        deadline=None, thread_id=None)
+    s3.get_object.assert_not_called()
+    chat.upload.assert_not_called()
+
+
+def test_link_mode_falls_back_to_upload(sns_job_completed_lambda_event, s3,
+                                        chat, monkeypatch):
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    s3.generate_presigned_url.side_effect = NoCredentialsError()
+    report = gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    assert report[0]['status'] == 'SUCCEEDED'
+    chat.post_message.assert_not_called()
+    assert chat.upload.call_count == 1
+
+
+def test_link_reply_falls_back_to_upload(idempotency, s3, chat,
+                                         monkeypatch):
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    monkeypatch.setenv('THUMBNAIL_FORMAT', 'png')
+    key = '01-20180801023512.gif'
+    idempotency.complete('thumb:' + key, 'message-id')
+    s3.generate_presigned_url.side_effect = NoCredentialsError()
+    event = {'Records': [{'Sns': {'Message': json.dumps({
+        'state': 'COMPLETED', 'outputs': [{'key': key}]})}}]}
+    report = gifs_handler.new_motion_gifs_handler(event, None)
+    assert report == [{'key': key, 'status': 'SUCCEEDED'}]
+    chat.post_message.assert_not_called()
+    assert chat.upload.call_args[1]['thread_id'] == 'message-id'
+
+
+def test_link_mode_failed_post_not_uploaded(sns_job_completed_lambda_event,
+                                            chat, monkeypatch):
+    monkeypatch.setenv('DELIVERY_MODE', 'link')
+    chat.post_message.side_effect = IOError('read timed out')
+    with pytest.raises(RuntimeError):
+        gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event,
+                                             None)
+    chat.upload.assert_not_called()
+
+
+def test_optimised_gif_uploaded(sns_job_completed_lambda_event, s3, chat,
+                                monkeypatch):
+    np = pytest.importorskip('numpy')
+    from cynnig.lib import gifopt
+    monkeypatch.setenv('GIF_OPTIMISE', '1')
+    key = '25-20180801023512.gif'
+    sibling = '25-20180801023512.optimised.gif'
+
+    frames = np.zeros((8, 40, 40, 3), np.uint8)
+    for i in range(8):
+        frames[i, 10:20, i * 4:i * 4 + 10] = 255
+    original = gifopt.encode(gifopt.Animation(frames, [10] * 8, 0))
+    # pad the original, as if it was encoded without delta frames
+    original = original[:-1] + b'\x21\xFE\x02ab\x00' * 1000 + b'\x3B'
+    objects = {key: original}
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise NoSuchKey()
+        return {'Body': io.BytesIO(objects[Key]),
+                'ContentLength': len(objects[Key])}
+
+    def put_object(Bucket, Key, Body, ContentType):
+        objects[Key] = Body
+
+    s3.exceptions.NoSuchKey = NoSuchKey
+    s3.get_object.side_effect = get_object
+    s3.put_object.side_effect = put_object
+
+    report = gifs_handler.new_motion_gifs_handler(
+        sns_job_completed_lambda_event, None)
+    assert report == [{'key': key, 'status': 'SUCCEEDED'}]
+    assert len(objects[sibling]) < len(original)
+    args, kwargs = chat.upload.call_args
+    assert args[1] == key
+    assert args[2].read() == objects[sibling]
+    assert kwargs['size'] == len(objects[sibling])
+
+    # delivered again, e.g. to another room: the copy is reused
+    idempotency = gifs_handler.idempotency
+    idempotency.release('gif:' + key)
+    s3.put_object.reset_mock()
+    gifs_handler.new_motion_gifs_handler(sns_job_completed_lambda_event, None)
+    s3.put_object.assert_not_called()
+    assert s3.get_object.call_args[1]['Key'] == sibling
+
+
+def test_optimise_skipped_without_time(s3, monkeypatch):
+    monkeypatch.setenv('GIF_OPTIMISE', '1')
+    monkeypatch.setenv('GIF_OPTIMISE_RATE', '1000')
+    monkeypatch.setattr('gifopt.available', lambda: True)
+    optimise = Mock(return_value=b'GIF89a')
+    monkeypatch.setattr('gifopt.optimise', optimise)
+
+    def get_object(Bucket, Key):
+        if Key != 'a.gif':
+            raise NoSuchKey()
+        return {'Body': io.BytesIO(b'GIF89a' * 500), 'ContentLength': 3000}
+
+    s3.exceptions.NoSuchKey = NoSuchKey
+    s3.get_object.side_effect = get_object
+
+    # 3s to optimise, 4s left
+    key, obj = gifs_handler.fetch_gif(s3, 'test-output-bucket', 'a.gif',
+                                      deadline=time.monotonic() + 4)
+    assert key == 'a.gif'
+    optimise.assert_not_called()
+
+    key, obj = gifs_handler.fetch_gif(s3, 'test-output-bucket', 'a.gif',
+                                      deadline=time.monotonic() + 10)
+    assert key == 'a.optimised.gif'
+    optimise.assert_called_once()
+
+
+def test_optimised_copy_not_optimised(s3, monkeypatch):
+    monkeypatch.setenv('GIF_OPTIMISE', '1')
+    monkeypatch.setattr('gifopt.available', lambda: True)
+    key, _ = gifs_handler.fetch_gif(s3, 'test-output-bucket',
+                                    'a.optimised.gif')
+    assert key == 'a.optimised.gif'
+    s3.get_object.assert_called_once_with(Bucket='test-output-bucket',
+                                          Key='a.optimised.gif')
@@ -1,10 +1,24 @@
 # coding: utf-8
 
+import io
 import json
+import os
 import pytest
 
-from unittest.mock import Mock
-from cynnig import app
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from unittest.mock import Mock, call
+from cynnig import video_handler
+from cynnig.lib.idempotency import IdempotencyStore, MemoryBackend
+from cynnig.lib.pipelines import ShardLoad
+from cynnig.lib.presets import PresetTier
+
+
+@pytest.fixture(autouse=True)
+def idempotency(monkeypatch):
+    store = IdempotencyStore(MemoryBackend())
+    monkeypatch.setattr('cynnig.video_handler.idempotency', store)
+    return store
 
 
 @pytest.fixture()
@@ -25,11 +39,22 @@ def s3_new_object_lambda_event():
         ]
     }
 
-def test_new_motion_video_handler(s3_new_object_lambda_event, monkeypatch):
+
+@pytest.fixture(autouse=True)
+def pipelines(monkeypatch):
+    monkeypatch.delenv('PIPELINE_ID', raising=False)
+    video_handler.pipelines.invalidate()
+    yield video_handler.pipelines
+    video_handler.pipelines.invalidate()
+
+
+@pytest.fixture()
+def client(monkeypatch):
     monkeypatch.setenv('STACK_NAME', 'cynnig')
     session = Mock()
-    monkeypatch.setattr('cynnig.app.session', session)
+    monkeypatch.setattr('clients.client', session.client)
     client = session.client.return_value
+    client.exceptions.ResourceNotFoundException = ResourceNotFoundException
     client.list_pipelines.return_value = {
         'Pipelines': [
             {
@@ -42,6 +67,14 @@ def test_new_motion_video_handler(s3_new_object_lambda_event, monkeypatch):
             }
         ]
     }
+    return client
+
+
+class ResourceNotFoundException(Exception):
+    pass
+
+
+def test_new_motion_video_handler(s3_new_object_lambda_event, client):
     client.create_job.return_value = {
         'Job': {
             'Arn': 'arn:aws:elastictranscoder:eu-west-1:0340292934242:job/15340920394528-sk29dbs',
@@ -72,7 +105,7 @@ def test_new_motion_video_handler(s3_new_object_lambda_event, monkeypatch):
             'RequestId': 'a6a13a74-9e4b-11e8-badf-7d077783343e',
             'RetryAttempts': 0}
     }
-    app.new_motion_video_handler(s3_new_object_lambda_event, "")
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
     client.create_job.assert_called_with(
         PipelineId='1534090839028-jh9ib4',
         Input={
@@ -84,3 +117,420 @@ def test_new_motion_video_handler(s3_new_object_lambda_event, monkeypatch):
             'Key': '01-20180730195708.gif'
         }
     )
+
+
+def test_pipeline_lookup_pages(s3_new_object_lambda_event, client):
+    client.list_pipelines.side_effect = [
+        {
+            'Pipelines': [{'Name': 'foo bar baz', 'Id': '0534090839028-barbaz'}],
+            'NextPageToken': 'page-2'
+        },
+        {
+            'Pipelines': [{'Name': 'cynnig motion pipeline',
+                           'Id': '1534090839028-jh9ib4'}]
+        }
+    ]
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.list_pipelines.call_args_list == [
+        call(), call(PageToken='page-2')]
+    assert client.create_job.call_args[1]['PipelineId'] == \
+        '1534090839028-jh9ib4'
+
+
+def test_pipeline_lookup_cached(s3_new_object_lambda_event, client):
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    s3_new_object_lambda_event['Records'][0]['s3']['object']['key'] = \
+        '01-20180730195715.mkv'
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.list_pipelines.call_count == 1
+    assert client.create_job.call_count == 2
+
+
+def test_pipeline_id_from_env(s3_new_object_lambda_event, client,
+                              monkeypatch):
+    monkeypatch.setenv('PIPELINE_ID', '1534090839999-envenv')
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    client.list_pipelines.assert_not_called()
+    assert client.create_job.call_args[1]['PipelineId'] == \
+        '1534090839999-envenv'
+
+
+def test_pipeline_not_found_invalidates_cache(s3_new_object_lambda_event,
+                                              client):
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    s3_new_object_lambda_event['Records'][0]['s3']['object']['key'] = \
+        '01-20180730195715.mkv'
+    client.list_pipelines.return_value = {
+        'Pipelines': [{'Name': 'cynnig motion pipeline',
+                       'Id': '1534090839030-newnew'}]
+    }
+    client.create_job.side_effect = [ResourceNotFoundException(), {}]
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.list_pipelines.call_count == 2
+    assert client.create_job.call_args[1]['PipelineId'] == \
+        '1534090839030-newnew'
+
+
+def test_report_per_record(client):
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-20180730195708.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195709.mkv'}}}
+        ]
+    }
+
+    def create_job(PipelineId, Input, Output):
+        if Input['Key'].startswith('01-'):
+            raise ValueError('boom')
+        return {'Job': {'Id': '1534090839028-job002'}}
+
+    client.create_job.side_effect = create_job
+    report = video_handler.transcode_records(event['Records'])
+    assert report == [
+        {'key': '01-20180730195708.mkv', 'status': 'FAILED',
+         'error': 'boom'},
+        {'key': '02-20180730195709.mkv', 'status': 'SUCCEEDED',
+         'jobId': '1534090839028-job002'}
+    ]
+
+
+def test_failed_s3_record_raised(client):
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-20180730195708.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195709.mkv'}}}
+        ]
+    }
+
+    def create_job(PipelineId, Input, Output):
+        if Input['Key'].startswith('01-'):
+            raise ValueError('boom')
+        return {'Job': {'Id': '1534090839028-job002'}}
+
+    client.create_job.side_effect = create_job
+    with pytest.raises(RuntimeError,
+                       match='failed to schedule 01-20180730195708.mkv$'):
+        video_handler.new_motion_video_handler(event, "")
+    # the other record was still submitted
+    assert client.create_job.call_count == 2
+
+
+def test_throttled_job_retried(s3_new_object_lambda_event, client,
+                               monkeypatch):
+    monkeypatch.setattr('throttling.backoff_delay', lambda *args: 0)
+    throttled = Exception('slow down')
+    throttled.response = {'Error': {'Code': 'ThrottlingException'}}
+    client.create_job.side_effect = [throttled, {'Job': {'Id': 'job-id'}}]
+    report = video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.create_job.call_count == 2
+    assert report[0]['status'] == 'SUCCEEDED'
+
+
+def test_redelivered_record_skipped(s3_new_object_lambda_event, client):
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    report = video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert report == [{'key': '01-20180730195708.mkv', 'status': 'SKIPPED'}]
+    assert client.create_job.call_count == 1
+
+
+def test_failed_record_not_recorded(s3_new_object_lambda_event, client):
+    client.create_job.side_effect = [ValueError('boom'), {}]
+    with pytest.raises(RuntimeError):
+        video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    report = video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert report[0]['status'] == 'SUCCEEDED'
+    assert client.create_job.call_count == 2
+
+
+def test_coalesce_clips(client, monkeypatch):
+    monkeypatch.setenv('COALESCE_WINDOW', '60')
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-20180730195708.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195710.mkv'}}},
+            {'s3': {'object': {'key': '01-20180730195750.mkv'}}}
+        ]
+    }
+    client.create_job.return_value = {'Job': {'Id': 'job-id'}}
+    report = video_handler.new_motion_video_handler(event, "")
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 3
+    assert client.create_job.call_count == 2
+    client.create_job.assert_any_call(
+        PipelineId='1534090839028-jh9ib4',
+        Inputs=[{'Key': '01-20180730195708.mkv'},
+                {'Key': '01-20180730195750.mkv'}],
+        Output={
+            'PresetId': '1351620000001-100200',
+            'Key': '01-20180730195708.gif'
+        }
+    )
+
+
+def test_preset_selected_by_size(s3_new_object_lambda_event, client,
+                                 monkeypatch):
+    monkeypatch.setattr('cynnig.video_handler.preset_tiers', [
+        PresetTier('1351620000001-100200', 480, 270, 10),
+        PresetTier('1534090839028-small', 160, 90, 5)
+    ])
+    client.head_object.return_value = {
+        'ContentLength': 75000000,
+        'Metadata': {}
+    }
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    client.head_object.assert_called_once_with(
+        Bucket='motion-events-velimir', Key='01-20180730195708.mkv')
+    assert client.create_job.call_args[1]['Output']['PresetId'] == \
+        '1534090839028-small'
+
+
+def test_preset_head_failed(s3_new_object_lambda_event, client, monkeypatch):
+    monkeypatch.setattr('cynnig.video_handler.preset_tiers', [
+        PresetTier('1351620000001-100200', 480, 270, 10),
+        PresetTier('1534090839028-small', 160, 90, 5)
+    ])
+    client.head_object.side_effect = ClientError(
+        {'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    report = video_handler.new_motion_video_handler(
+        s3_new_object_lambda_event, "")
+    assert report[0]['status'] == 'SUCCEEDED'
+    assert client.create_job.call_args[1]['Output']['PresetId'] == \
+        '1351620000001-100200'
+
+
+def test_thumbnail_pattern(s3_new_object_lambda_event, client, monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_FORMAT', 'png')
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.create_job.call_args[1]['Output'] == {
+        'PresetId': '1351620000001-100200',
+        'Key': '01-20180730195708.gif',
+        'ThumbnailPattern': '01-20180730195708-{count}'
+    }
+
+
+@pytest.fixture()
+def shards(client):
+    client.list_pipelines.return_value = {
+        'Pipelines': [
+            {'Name': 'cynnig motion pipeline', 'Id': 'shard-0'},
+            {'Name': 'cynnig motion pipeline 1', 'Id': 'shard-1'},
+            {'Name': 'cynnig motion pipeline 2', 'Id': 'shard-2'},
+            {'Name': 'cynnig priority pipeline', 'Id': 'priority-0'}
+        ]
+    }
+    return ['shard-0', 'shard-1', 'shard-2']
+
+
+def test_shard_by_camera(client, shards):
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-20180730195708.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195709.mkv'}}},
+            {'s3': {'object': {'key': '01-20180730195850.mkv'}}}
+        ]
+    }
+    video_handler.new_motion_video_handler(event, "")
+    pipeline_ids = {c[1]['Input']['Key']: c[1]['PipelineId']
+                    for c in client.create_job.call_args_list}
+    assert set(pipeline_ids.values()) <= set(shards)
+    assert pipeline_ids['01-20180730195708.mkv'] == \
+        pipeline_ids['01-20180730195850.mkv']
+
+
+def test_shard_least_loaded(client, shards, monkeypatch):
+    monkeypatch.setenv('SHARD_STRATEGY', 'least-loaded')
+    monkeypatch.setattr('cynnig.video_handler.shard_load', ShardLoad())
+    monkeypatch.setenv('JOB_CONCURRENCY', '1')
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-2018073019570{}.mkv'.format(i)}}}
+            for i in range(6)
+        ]
+    }
+    video_handler.new_motion_video_handler(event, "")
+    assert [c[1]['PipelineId'] for c in client.create_job.call_args_list] \
+        == shards * 2
+
+
+def test_shard_ids_from_env(s3_new_object_lambda_event, client, monkeypatch):
+    monkeypatch.setenv('PIPELINE_ID', 'shard-0,shard-1')
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    client.list_pipelines.assert_not_called()
+    assert client.create_job.call_args[1]['PipelineId'] in \
+        ('shard-0', 'shard-1')
+
+
+@pytest.fixture()
+def queue(monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        sqs = boto3.client('sqs')
+        # received messages become visible again straight away
+        url = sqs.create_queue(QueueName='motion-events',
+                               Attributes={'VisibilityTimeout': '0'})
+        yield sqs, url['QueueUrl']
+
+
+def s3_notification(*object_keys):
+    return json.dumps({'Records': [
+        {'s3': {'bucket': {'name': 'motion-events-velimir'},
+                'object': {'key': key, 'eTag': 'etag'}}}
+        for key in object_keys
+    ]})
+
+
+def poll(sqs, url):
+    """Invokes the handler with a batch from the queue and deletes the
+    messages which didn't fail, like the Lambda SQS poller does
+
+    """
+    messages = sqs.receive_message(QueueUrl=url,
+                                   MaxNumberOfMessages=10)['Messages']
+    event = {'Records': [{'messageId': message['MessageId'],
+                          'receiptHandle': message['ReceiptHandle'],
+                          'body': message['Body'],
+                          'eventSource': 'aws:sqs'}
+                         for message in messages]}
+    response = video_handler.new_motion_video_handler(event, "")
+    failed = {failure['itemIdentifier']
+              for failure in response['batchItemFailures']}
+    for message in messages:
+        if message['MessageId'] not in failed:
+            sqs.delete_message(QueueUrl=url,
+                               ReceiptHandle=message['ReceiptHandle'])
+    return failed
+
+
+def test_sqs_batch(client, queue):
+    sqs, url = queue
+    sent = [
+        sqs.send_message(QueueUrl=url, MessageBody=body)['MessageId']
+        for body in (s3_notification('01-20180730195708.mkv',
+                                     '02-20180730195709.mkv'),
+                     s3_notification('03-20180730195710.mkv'),
+                     json.dumps({'Event': 's3:TestEvent'}),
+                     'not json')
+    ]
+
+    def create_job(PipelineId, Input, Output):
+        if Input['Key'].startswith('02-'):
+            raise ValueError('boom')
+        return {'Job': {'Id': 'job-id'}}
+
+    client.create_job.side_effect = create_job
+    assert poll(sqs, url) == {sent[0], sent[3]}
+    assert client.create_job.call_count == 3
+
+    # the first record of the failed message is skipped on redelivery,
+    # the malformed one is left for the dead letter queue
+    client.create_job.side_effect = None
+    assert poll(sqs, url) == {sent[3]}
+    assert client.create_job.call_count == 4
+    assert client.create_job.call_args[1]['Input'] == {
+        'Key': '02-20180730195709.mkv'}
+
+
+def event_source(function, name):
+    """Environment and event source properties of a function in the
+    SAM template
+
+    """
+    yaml = pytest.importorskip('yaml')
+
+    class Loader(yaml.SafeLoader):
+        pass
+
+    # intrinsic functions (!Ref, !Sub...) aren't resolved
+    Loader.add_multi_constructor('!', lambda loader, tag, node: None)
+    path = os.path.join(os.path.dirname(__file__), '..', 'template.yaml')
+    with open(path) as f:
+        template = yaml.load(f, Loader=Loader)
+    properties = template['Resources'][function]['Properties']
+    return (properties['Environment']['Variables'],
+            properties['Events'][name]['Properties'])
+
+
+def test_motion_events_batch_coalesced(client, queue, monkeypatch):
+    sqs, url = queue
+    variables, source = event_source('MakeGIFFunction', 'MotionEvents')
+    window = variables['COALESCE_WINDOW']
+    monkeypatch.setenv('COALESCE_WINDOW', str(window))
+    # back-to-back clips of a camera, each notified as it starts
+    start = datetime(2018, 7, 30, 19, 57, 8)
+    offsets = range(0, window + 1, window // 3)
+    keys = [(start + timedelta(seconds=offset)).strftime('01-%Y%m%d%H%M%S.mkv')
+            for offset in offsets]
+    # the notifications the poller collects into the first batch
+    batch = [key for offset, key in zip(offsets, keys)
+             if offset <= source['MaximumBatchingWindowInSeconds']]
+    assert len(batch) == len(keys) <= source['BatchSize']
+    for key in batch:
+        sqs.send_message(QueueUrl=url, MessageBody=s3_notification(key))
+
+    client.create_job.return_value = {'Job': {'Id': 'job-id'}}
+    assert poll(sqs, url) == set()
+    client.create_job.assert_called_once()
+    assert client.create_job.call_args[1]['Inputs'] == [
+        {'Key': key} for key in keys]
+
+
+def test_ffmpeg_backend(s3_new_object_lambda_event, client, monkeypatch):
+    monkeypatch.setenv('TRANSCODER_BACKEND', 'ffmpeg')
+    monkeypatch.setenv('PIPELINE_BUCKET', 'motion-gifs')
+    monkeypatch.setenv('NOTIFICATION_FUNCTION', 'notifications')
+    monkeypatch.setenv('FFMPEG_MAX_BYTES', '1000')
+
+    def encode(self, inputs, tier, output, workdir, cut=None):
+        with open(output, 'wb') as f:
+            f.write(b'GIF89a')
+
+    monkeypatch.setattr('transcoders.FFmpegBackend.encode', encode)
+    client.head_object.return_value = {'ContentLength': 1000}
+    client.get_object.return_value = {'Body': io.BytesIO(b'mkv')}
+    report = video_handler.new_motion_video_handler(
+        s3_new_object_lambda_event, "")
+
+    assert report[0]['jobId'].startswith('ffmpeg-')
+    client.create_job.assert_not_called()
+    invoke = client.invoke.call_args[1]
+    assert invoke['FunctionName'] == 'notifications'
+    assert invoke['InvocationType'] == 'Event'
+    message = json.loads(json.loads(invoke['Payload'])['Records'][0]['Sns']
+                         ['Message'])
+    assert message['outputs'][0]['key'] == '01-20180730195708.gif'
+
+    # larger recordings go to elastic transcoder
+    client.head_object.reset_mock()
+    client.head_object.return_value = {'ContentLength': 1001}
+    s3_new_object_lambda_event['Records'][0]['s3']['object']['key'] = \
+        '01-20180730195715.mkv'
+    video_handler.new_motion_video_handler(s3_new_object_lambda_event, "")
+    assert client.create_job.call_args[1]['Input'] == {
+        'Key': '01-20180730195715.mkv'}
+    client.head_object.assert_called_once()
+
+
+def test_priority_camera(client, monkeypatch):
+    monkeypatch.setenv('COALESCE_WINDOW', '60')
+    monkeypatch.setenv('JOB_CONCURRENCY', '1')
+    monkeypatch.setenv('PIPELINE_ID', 'shard-0')
+    monkeypatch.setenv('PRIORITY_PIPELINE_ID', 'priority-0')
+    monkeypatch.setattr('cynnig.video_handler.camera_priorities',
+                        {'02': 'high'})
+    event = {
+        'Records': [
+            {'s3': {'object': {'key': '01-20180730195708.mkv'}}},
+            {'s3': {'object': {'key': '01-20180730195750.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195710.mkv'}}},
+            {'s3': {'object': {'key': '02-20180730195750.mkv'}}}
+        ]
+    }
+    client.create_job.return_value = {'Job': {'Id': 'job-id'}}
+    report = video_handler.new_motion_video_handler(event, "")
+    assert [r['status'] for r in report] == ['SUCCEEDED'] * 4
+    assert [(c[1]['PipelineId'], len(c[1].get('Inputs', [None])))
+            for c in client.create_job.call_args_list] == [
+        ('priority-0', 1), ('priority-0', 1), ('shard-0', 2)]
@@ -0,0 +1,59 @@
+# coding: utf-8
+
+from unittest.mock import Mock
+from cynnig.lib.pipelines import PipelineResolver, ShardLoad, rendezvous, \
+    shard_name
+
+
+def test_shard_name():
+    assert shard_name('cynnig motion pipeline', 0) == 'cynnig motion pipeline'
+    assert shard_name('cynnig motion pipeline', 2) == \
+        'cynnig motion pipeline 2'
+    assert shard_name('cynnig motion pipeline', 0, '41f948') == \
+        'cynnig motion pipeline 41f948'
+    assert shard_name('cynnig motion pipeline', 2, '41f948') == \
+        'cynnig motion pipeline 41f948 2'
+
+
+def test_resolve_all():
+    client = Mock()
+    client.list_pipelines.return_value = {'Pipelines': [
+        {'Name': 'cynnig motion pipeline 1', 'Id': 'shard-1'},
+        {'Name': 'other pipeline', 'Id': 'other'},
+        {'Name': 'cynnig motion pipeline', 'Id': 'shard-0'}
+    ]}
+    resolver = PipelineResolver()
+    assert resolver.resolve_all(client, 'cynnig') == ['shard-0', 'shard-1']
+
+
+def test_resolve_all_excluded():
+    client = Mock()
+    client.list_pipelines.return_value = {'Pipelines': [
+        {'Name': 'cynnig motion pipeline', 'Id': 'shard-0'},
+        {'Name': 'cynnig priority pipeline', 'Id': 'priority-0'}
+    ]}
+    resolver = PipelineResolver()
+    assert resolver.resolve_all(client, 'cynnig',
+                                exclude='cynnig priority pipeline') == \
+        ['shard-0']
+
+
+def test_rendezvous_moves_few_keys():
+    keys = ['{:02d}'.format(camera) for camera in range(100)]
+    before = {key: rendezvous(key, ['a', 'b', 'c']) for key in keys}
+    after = {key: rendezvous(key, ['a', 'b', 'c', 'd']) for key in keys}
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == 'd' for key in moved)
+    assert set(before.values()) == {'a', 'b', 'c'}
+
+
+def test_shard_load_window(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr('cynnig.lib.pipelines.time.monotonic', lambda: now[0])
+    load = ShardLoad(window=10)
+    assert [load.pick(['a', 'b']) for _ in range(3)] == ['a', 'b', 'a']
+    now[0] = 5.0
+    assert load.pick(['a', 'b']) == 'b'
+    now[0] = 10.0
+    # the first three submissions are out of the window
+    assert load.pick(['a', 'b']) == 'a'
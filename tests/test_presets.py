@@ -0,0 +1,39 @@
+# coding: utf-8
+
+import json
+
+from cynnig.lib.presets import PresetTier, DEFAULT_TIERS, load_tiers, \
+    select_preset, clip_duration
+
+TIERS = [
+    PresetTier('1351620000001-100200', 480, 270, 10),
+    PresetTier('1534090839028-small', 320, 180, 8),
+    PresetTier('1534090839028-tiny', 160, 90, 5)
+]
+
+
+def test_load_tiers():
+    assert load_tiers('') == DEFAULT_TIERS
+    spec = json.dumps([
+        {'id': tier.id, 'width': tier.width, 'height': tier.height,
+         'fps': tier.fps}
+        for tier in TIERS
+    ])
+    assert load_tiers(spec) == TIERS
+
+
+def test_select_preset():
+    budget = 5 * 1024 * 1024
+    assert select_preset(TIERS, 10, budget) == TIERS[0]
+    assert select_preset(TIERS, 50, budget) == TIERS[1]
+    assert select_preset(TIERS, 300, budget) == TIERS[2]
+    assert select_preset(TIERS, 3600, budget) == TIERS[2]
+
+
+def test_clip_duration():
+    assert clip_duration({'ContentLength': 1000000,
+                          'Metadata': {'duration': '12.5'}}, 250000) == 12.5
+    assert clip_duration({'ContentLength': 1000000, 'Metadata': {}},
+                         250000) == 4
+    assert clip_duration({'ContentLength': 1000000,
+                          'Metadata': {'duration': 'n/a'}}, 250000) == 4
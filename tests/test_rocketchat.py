@@ -1,12 +1,22 @@
 # coding: utf-8
 
+import asyncio
+import io
 import json
 import pytest
 import re
+import requests
+import socket
+import time
 
-from cynnig.lib.rocketchat import RocketChat
+from contextlib import contextmanager
+from unittest.mock import Mock
+from cynnig.lib import rocketchat
+from cynnig.lib.rocketchat import RocketChat, AsyncRocketChat, \
+    MultipartStream, RetryPolicy
 
 import httpretty
+from fake_rocketchat import FakeRocketChat
 from httpretty import HTTPretty
 
 httpretty.HTTPretty.allow_net_connect = False
@@ -51,8 +61,383 @@ def test_login(chat):
     assert_request_auth(info_req)
 
 
+def register_login(user_id=USER_ID, auth_token=AUTH_TOKEN):
+    logins = []
+
+    def login(request, uri, headers):
+        logins.append(json.loads(request.body.decode('utf-8')))
+        body = json.dumps({
+            'data': {
+                'userId': user_id,
+                'authToken': auth_token
+            }
+        })
+        return 200, headers, body
+
+    httpretty.register_uri(httpretty.POST, re.compile(r'.*/api/v1/login', re.M),
+                           body=login)
+    return logins
+
+
+def test_get_client_reuses_session():
+    rocketchat._clients.clear()
+    first = rocketchat.get_client(ROCKET_SERVER, ROCKET_USERNAME,
+                                  ROCKET_PASSWORD)
+    second = rocketchat.get_client(ROCKET_SERVER, ROCKET_USERNAME,
+                                   ROCKET_PASSWORD)
+    other = rocketchat.get_client(ROCKET_SERVER, 'other-username',
+                                  ROCKET_PASSWORD)
+    assert first is second
+    assert first is not other
+    rocketchat._clients.clear()
+
+
+def test_relogin_on_unauthorized(chat):
+    logins = register_login()
+    responses = [
+        httpretty.Response(body='{"status": "error"}', status=401),
+        httpretty.Response(body='{"success": true}')
+    ]
+    httpretty.register_uri(httpretty.GET, re.compile(r'.*/api/v1/info', re.M),
+                           responses=responses)
+    assert chat.request('get', '/api/v1/info') == {'success': True}
+    assert len(logins) == 2
+    assert_request_auth(httpretty.last_request())
+
+
+def test_token_cache(tmpdir):
+    with httpretty.enabled():
+        logins = register_login()
+        httpretty.register_uri(httpretty.GET,
+                               re.compile(r'.*/api/v1/info', re.M),
+                               body='{"success": true}')
+        chat = RocketChat(ROCKET_SERVER, ROCKET_USERNAME, ROCKET_PASSWORD,
+                          token_cache=str(tmpdir))
+        chat.request('get', '/api/v1/info')
+        assert len(tmpdir.listdir()) == 1
+
+        # a new container picks the token up from the cache
+        chat = RocketChat(ROCKET_SERVER, ROCKET_USERNAME, ROCKET_PASSWORD,
+                          token_cache=str(tmpdir))
+        chat.request('get', '/api/v1/info')
+        assert len(logins) == 1
+        assert_request_auth(httpretty.last_request())
+
+
 def assert_request_auth(request):
     assert 'X-User-Id' in request.headers
     assert request.headers['X-User-Id'] == USER_ID
     assert 'X-Auth-Token' in request.headers
     assert request.headers['X-Auth-Token'] == AUTH_TOKEN
+
+
+class ChunkedFile(io.BytesIO):
+    """Stream which can't be rewound, like S3 StreamingBody"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+    def seekable(self):
+        return False
+
+
+def test_upload_streams_file():
+    data = b'GIF89a' + bytes(range(256)) * 1024
+    file = ChunkedFile(data)
+    with FakeRocketChat() as server:
+        chat = RocketChat(server.url, ROCKET_USERNAME, ROCKET_PASSWORD)
+        chat.upload('room-id', '01-20180730195708.gif', file, size=len(data))
+
+    request = server.requests[-1]
+    assert request['path'] == '/api/v1/rooms.upload/room-id'
+    assert int(request['headers']['Content-Length']) == len(request['body'])
+    assert 'Transfer-Encoding' not in request['headers']
+    assert request['headers']['Content-Type'].startswith('multipart/form-data')
+    assert b'filename="01-20180730195708.gif"' in request['body']
+    assert b'Content-Type: image/gif' in request['body']
+    assert data in request['body']
+    assert -1 not in file.reads
+    assert max(file.reads) <= MultipartStream.chunk_size
+
+
+def test_upload_to_thread():
+    data = b'GIF89a' * 100
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        chat.upload('room-id', '01-20180730195708.gif', io.BytesIO(data),
+                    size=len(data), text='2 motion clips',
+                    thread_id='message-id')
+
+    request = server.requests[-1]
+    assert int(request['headers']['Content-Length']) == len(request['body'])
+    assert b'name="msg"\r\n\r\n2 motion clips\r\n' in request['body']
+    assert b'name="tmid"\r\n\r\nmessage-id\r\n' in request['body']
+    assert data in request['body']
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_gather_uploads():
+    async def upload_all(server):
+        async with AsyncRocketChat(server.url, ROCKET_USERNAME,
+                                   ROCKET_PASSWORD,
+                                   max_connections=4) as chat:
+            return await asyncio.gather(*[
+                chat.upload('room-id', '{:02}-20180730195708.gif'.format(i),
+                            io.BytesIO(b'GIF89a' * 100), size=600)
+                for i in range(30)
+            ])
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        responses = run(upload_all(server))
+
+    assert responses == [{'success': True}] * 30
+    logins = [r for r in server.requests if r['path'] == '/api/v1/login']
+    assert len(logins) == 1
+    assert json.loads(logins[0]['body'].decode('utf-8')) == {
+        'username': ROCKET_USERNAME,
+        'password': ROCKET_PASSWORD
+    }
+    uploads = [r for r in server.requests if r['path'] != '/api/v1/login']
+    assert len(uploads) == 30
+    for upload in uploads:
+        assert upload['headers']['X-User-Id'] == USER_ID
+        assert upload['headers']['X-Auth-Token'] == AUTH_TOKEN
+        assert upload['body'].count(b'GIF89a') == 100
+    assert len(server.connections) <= 4
+
+
+def test_async_relogin_on_unauthorized():
+    async def info(server):
+        async with AsyncRocketChat(server.url, ROCKET_USERNAME,
+                                   ROCKET_PASSWORD) as chat:
+            return await chat.request('get', '/api/v1/info')
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        responses = [(401, {}, {'status': 'error'}),
+                     (200, {}, {'success': True})]
+        server.route('/api/v1/info')(lambda request: responses.pop(0))
+        assert run(info(server)) == {'success': True}
+
+    paths = [r['path'] for r in server.requests]
+    assert paths == ['/api/v1/login', '/api/v1/info',
+                     '/api/v1/login', '/api/v1/info']
+
+
+def test_async_token_auth():
+    async def info(server):
+        async with AsyncRocketChat(server.url, user_id=USER_ID,
+                                   auth_token=AUTH_TOKEN) as chat:
+            return await chat.request('get', '/api/v1/info')
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        assert run(info(server)) == {'success': True}
+
+    assert [r['path'] for r in server.requests] == ['/api/v1/info']
+
+
+def test_async_retries_closed_connection(monkeypatch):
+    # the client only learns that the server closed an idle connection
+    # when it reuses it
+    monkeypatch.setattr(asyncio.StreamReader, 'at_eof', lambda self: False)
+
+    async def info_twice(server):
+        async with AsyncRocketChat(server.url, user_id=USER_ID,
+                                   auth_token=AUTH_TOKEN) as chat:
+            await chat.request('get', '/api/v1/info')
+            await asyncio.sleep(0.1)
+            return await chat.request('get', '/api/v1/info')
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        server.keep_alive = False
+        assert run(info_twice(server)) == {'success': True}
+
+    assert [r['path'] for r in server.requests] == ['/api/v1/info'] * 2
+    assert len(server.connections) == 2
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rocketchat.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_retry_rate_limited(sleeps):
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        reset = int((time.time() + 2) * 1000)
+        responses = [(429, {'X-RateLimit-Reset': str(reset)}, {}),
+                     (429, {'Retry-After': '1'}, {}),
+                     (200, {}, {'success': True})]
+        server.route('/api/v1/info')(lambda request: responses.pop(0))
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        assert chat.request('get', '/api/v1/info') == {'success': True}
+
+    assert len(sleeps) == 2
+    assert 1 < sleeps[0] <= 2
+    assert sleeps[1] == 1
+
+
+def test_retry_upload_reopens_stream(sleeps):
+    data = b'GIF89a' * 1000
+    opened = []
+
+    def reopen():
+        opened.append(1)
+        return ChunkedFile(data)
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        responses = [(503, {}, {}), (200, {}, {'success': True})]
+        server.route('/api/v1/rooms.upload/.*')(
+            lambda request: responses.pop(0))
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        chat.upload('room-id', '01-20180730195708.gif', ChunkedFile(data),
+                    size=len(data), reopen=reopen)
+
+    assert len(opened) == 1
+    uploads = [r for r in server.requests if 'rooms.upload' in r['path']]
+    assert len(uploads) == 2
+    assert all(data in upload['body'] for upload in uploads)
+
+
+def test_retry_respects_deadline(sleeps):
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        server.route('/api/v1/info')(
+            lambda request: (429, {'Retry-After': '10'}, {}))
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        with pytest.raises(requests.HTTPError):
+            chat.request('get', '/api/v1/info',
+                         deadline=time.monotonic() + 1)
+
+    assert sleeps == []
+    assert len(server.requests) == 1
+
+
+def test_retry_gives_up(sleeps):
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        server.route('/api/v1/info')(lambda request: (502, {}, {}))
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN,
+                          retry=RetryPolicy(attempts=3, cap=0.5))
+        with pytest.raises(requests.HTTPError):
+            chat.request('get', '/api/v1/info')
+
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= 0.5 for delay in sleeps)
+    assert len(server.requests) == 3
+
+
+def test_retry_delay_capped():
+    policy = RetryPolicy(max_delay=30)
+    assert policy.delay(0, {'Retry-After': '3600'}) == 30
+    reset = int((time.time() + 3600) * 1000)
+    assert policy.delay(0, {'X-RateLimit-Reset': str(reset)}) == 30
+
+
+def test_retry_malformed_headers():
+    policy = RetryPolicy(cap=0.5)
+    for headers in ({'Retry-After': 'soon'},
+                    {'X-RateLimit-Reset': 'tomorrow'}):
+        assert 0 <= policy.delay(0, headers) <= 0.5
+
+
+def test_retry_closes_reopened_stream(sleeps):
+    data = b'GIF89a' * 1000
+    first = ChunkedFile(data)
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        responses = [(503, {}, {}), (200, {}, {'success': True})]
+        server.route('/api/v1/rooms.upload/.*')(
+            lambda request: responses.pop(0))
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        chat.upload('room-id', '01-20180730195708.gif', first,
+                    size=len(data), reopen=lambda: ChunkedFile(data))
+
+    assert first.closed
+
+
+def test_sent_post_not_retried(sleeps):
+    chat = RocketChat(ROCKET_SERVER, user_id=USER_ID, auth_token=AUTH_TOKEN)
+    chat._session.request = Mock(side_effect=requests.ConnectionError(
+        'Connection aborted.'))
+    with pytest.raises(requests.ConnectionError):
+        chat.post_message('room-id', 'motion')
+    assert chat._session.request.call_count == 1
+
+    response = Mock(status_code=200)
+    response.json.return_value = {'success': True}
+    chat._session.request = Mock(side_effect=[
+        requests.ConnectTimeout('connect timeout'), response])
+    assert chat.post_message('room-id', 'motion') == {'success': True}
+    assert chat._session.request.call_count == 2
+
+
+def test_stalled_request_bounded_by_deadline():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    url = 'http://127.0.0.1:%d' % listener.getsockname()[1]
+    try:
+        chat = RocketChat(url, user_id=USER_ID, auth_token=AUTH_TOKEN,
+                          retry=RetryPolicy(attempts=1))
+        start = time.monotonic()
+        with pytest.raises(requests.Timeout):
+            chat.post_message('room-id', 'motion', deadline=start + 0.5)
+        assert time.monotonic() - start < 2
+    finally:
+        listener.close()
+
+
+def test_post_message():
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        chat.post_message('room-id', 'motion', attachments=[
+            {'image_url': 'https://s3/01-20180730195708.gif'}
+        ])
+
+    request = server.requests[-1]
+    assert request['path'] == '/api/v1/chat.postMessage'
+    assert json.loads(request['body'].decode('utf-8')) == {
+        'roomId': 'room-id',
+        'text': 'motion',
+        'attachments': [{'image_url': 'https://s3/01-20180730195708.gif'}]
+    }
+
+
+def test_requests_timed():
+    phases = []
+
+    @contextmanager
+    def timer(phase):
+        phases.append(phase)
+        yield
+
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        chat = RocketChat(server.url, username=ROCKET_USERNAME,
+                          password=ROCKET_PASSWORD, timer=timer)
+        chat.post_message('room-id', 'motion')
+
+    assert phases == ['rocketchat.chat.postMessage', 'rocketchat.login']
+
+
+def test_post_reply():
+    with FakeRocketChat(USER_ID, AUTH_TOKEN) as server:
+        chat = RocketChat(server.url, user_id=USER_ID, auth_token=AUTH_TOKEN)
+        chat.post_message('room-id', 'motion', thread_id='message-id')
+
+    request = server.requests[-1]
+    assert request['path'] == '/api/v1/chat.postMessage'
+    assert json.loads(request['body'].decode('utf-8')) == {
+        'roomId': 'room-id',
+        'text': 'motion',
+        'tmid': 'message-id'
+    }
@@ -0,0 +1,137 @@
+# coding: utf-8
+
+import pytest
+
+from base64 import b64encode
+from unittest.mock import Mock
+from cynnig.lib.secretstore import SecretStore
+
+
+@pytest.fixture()
+def clients():
+    clients = {'kms': Mock(), 'ssm': Mock(), 'secretsmanager': Mock()}
+    clients['kms'].decrypt.side_effect = lambda CiphertextBlob: {
+        'Plaintext': CiphertextBlob + b'-decrypted'
+    }
+    clients['ssm'].get_parameters.side_effect = \
+        lambda Names, WithDecryption: {
+            'Parameters': [{'Name': name, 'Value': name + '-value'}
+                           for name in Names],
+            'InvalidParameters': []
+        }
+    clients['secretsmanager'].batch_get_secret_value.side_effect = \
+        lambda SecretIdList: {
+            'SecretValues': [{'Name': secret_id,
+                              'ARN': 'arn:' + secret_id,
+                              'SecretString': secret_id + '-secret'}
+                             for secret_id in SecretIdList],
+            'Errors': []
+        }
+    return clients
+
+
+@pytest.fixture()
+def store(clients):
+    return SecretStore(clients.__getitem__)
+
+
+def test_resolve(store, clients):
+    ciphertext = b64encode(b'password').decode('ascii')
+    resolved = store.resolve({
+        'ROCKET_SERVER': 'https://rocket.test.srv',
+        'ROCKET_PASSWORD': ciphertext,
+        'ROCKET_USERNAME': 'ssm:/cynnig/username',
+        'ROCKET_ROOM_ID': 'ssm:/cynnig/room-id',
+        'ROCKET_TOKEN': 'secretsmanager:cynnig/token'
+    }, encrypted=['ROCKET_PASSWORD'])
+    assert resolved == {
+        'ROCKET_SERVER': 'https://rocket.test.srv',
+        'ROCKET_PASSWORD': 'password-decrypted',
+        'ROCKET_USERNAME': '/cynnig/username-value',
+        'ROCKET_ROOM_ID': '/cynnig/room-id-value',
+        'ROCKET_TOKEN': 'cynnig/token-secret'
+    }
+    clients['ssm'].get_parameters.assert_called_once_with(
+        Names=['/cynnig/username', '/cynnig/room-id'], WithDecryption=True)
+    clients['secretsmanager'].batch_get_secret_value.assert_called_once_with(
+        SecretIdList=['cynnig/token'])
+
+
+def test_parameters_batched(store, clients):
+    names = ['/cynnig/{}'.format(i) for i in range(25)]
+    values = store.parameters(names)
+    assert len(values) == 25
+    assert clients['ssm'].get_parameters.call_count == 3
+
+
+def test_cached(store, clients):
+    ciphertext = 'kms:' + b64encode(b'password').decode('ascii')
+    store.resolve({'ROCKET_PASSWORD': ciphertext})
+    store.resolve({'ROCKET_PASSWORD': ciphertext})
+    assert clients['kms'].decrypt.call_count == 1
+
+
+def test_expired(clients):
+    store = SecretStore(clients.__getitem__, ttl=0)
+    store.parameters(['/cynnig/username'])
+    store.parameters(['/cynnig/username'])
+    assert clients['ssm'].get_parameters.call_count == 2
+
+
+def test_unknown_parameter(store, clients):
+    clients['ssm'].get_parameters.side_effect = None
+    clients['ssm'].get_parameters.return_value = {
+        'Parameters': [],
+        'InvalidParameters': ['/cynnig/missing']
+    }
+    with pytest.raises(KeyError):
+        store.parameters(['/cynnig/missing'])
+
+
+def test_parameter_arn_and_version(store, clients):
+    arn = 'arn:aws:ssm:eu-west-1:123456789012:parameter/cynnig/username'
+    clients['ssm'].get_parameters.side_effect = None
+    clients['ssm'].get_parameters.return_value = {
+        'Parameters': [
+            {'Name': '/cynnig/username', 'ARN': arn, 'Value': 'bot'},
+            {'Name': '/cynnig/room-id', 'Selector': ':3',
+             'ARN': arn.replace('username', 'room-id'), 'Value': 'room'}
+        ],
+        'InvalidParameters': []
+    }
+    assert store.parameters([arn, '/cynnig/room-id:3']) == \
+        {arn: 'bot', '/cynnig/room-id:3': 'room'}
+
+
+def test_secret_partial_arn(store, clients):
+    partial = 'arn:aws:secretsmanager:eu-west-1:123456789012:secret:token'
+    clients['secretsmanager'].batch_get_secret_value.side_effect = None
+    clients['secretsmanager'].batch_get_secret_value.return_value = {
+        'SecretValues': [{'Name': 'token', 'ARN': partial + '-AbCdEf',
+                          'SecretString': 'secret'}],
+        'Errors': []
+    }
+    assert store.secrets([partial]) == {partial: 'secret'}
+
+
+def test_secret_missing_from_batch(store, clients):
+    clients['secretsmanager'].batch_get_secret_value.side_effect = None
+    clients['secretsmanager'].batch_get_secret_value.return_value = {
+        'SecretValues': [], 'Errors': []
+    }
+    with pytest.raises(KeyError):
+        store.secrets(['cynnig/token'])
+
+
+def test_secrets_without_batch_api(clients):
+    secretsmanager = Mock(spec=['get_secret_value', 'exceptions'])
+    secretsmanager.get_secret_value.side_effect = lambda SecretId: {
+        'Name': SecretId, 'SecretString': SecretId + '-secret'
+    }
+    clients['secretsmanager'] = secretsmanager
+    store = SecretStore(clients.__getitem__)
+    assert store.secrets(['cynnig/token', 'cynnig/key']) == {
+        'cynnig/token': 'cynnig/token-secret',
+        'cynnig/key': 'cynnig/key-secret'
+    }
+    assert secretsmanager.get_secret_value.call_count == 2
@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import pytest
+
+from cynnig.lib.throttling import TokenBucket, retry_throttled
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def throttling_error(code='ThrottlingException'):
+    error = Exception(code)
+    error.response = {'Error': {'Code': code}}
+    return error
+
+
+def test_token_bucket_burst():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_retry_throttled():
+    clock = Clock()
+    responses = [throttling_error(), throttling_error(), 'job']
+
+    def create_job():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert retry_throttled(create_job, sleep=clock.sleep, cap=1.0) == 'job'
+    assert len(clock.sleeps) == 2
+    assert all(0 <= delay <= 1.0 for delay in clock.sleeps)
+
+
+def test_retry_gives_up():
+    clock = Clock()
+
+    def create_job():
+        raise throttling_error()
+
+    with pytest.raises(Exception):
+        retry_throttled(create_job, attempts=3, sleep=clock.sleep)
+    assert len(clock.sleeps) == 2
+
+
+def test_other_errors_not_retried():
+    calls = []
+
+    def create_job():
+        calls.append(1)
+        raise throttling_error('ValidationException')
+
+    with pytest.raises(Exception):
+        retry_throttled(create_job)
+    assert len(calls) == 1
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+import io
+import subprocess
+import pytest
+
+from unittest.mock import Mock
+from cynnig.lib.presets import PresetTier
+from cynnig.lib.transcoders import ElasticTranscoderBackend, FFmpegBackend
+
+
+@pytest.fixture()
+def s3():
+    s3 = Mock()
+    s3.head_object.return_value = {'ContentLength': 1024}
+    s3.get_object.side_effect = lambda Bucket, Key: {
+        'Body': io.BytesIO(Key.encode() * 10)}
+    return s3
+
+
+def ffmpeg_backend(s3, tmpdir, run, **kwargs):
+    return FFmpegBackend(lambda name: s3, 'motion-gifs', kwargs.pop('notify'),
+                         tiers=[PresetTier('preset-id', 320, 180, 5)],
+                         tmp_dir=str(tmpdir), run=run, **kwargs)
+
+
+def test_elastictranscoder_backend():
+    submit = Mock(return_value={'Job': {'Id': 'job-id'}})
+    backend = ElasticTranscoderBackend(submit)
+    assert backend.accepts('motion-events', ['01-20180730195708.mkv'])
+    assert backend.transcode('motion-events', ['01-20180730195708.mkv'],
+                             'preset-id') == {'Job': {'Id': 'job-id'}}
+    submit.assert_called_once_with(['01-20180730195708.mkv'], 'preset-id')
+
+
+def test_ffmpeg_accepts_small_clips(s3, tmpdir):
+    backend = ffmpeg_backend(s3, tmpdir, Mock(), notify=Mock(),
+                             max_bytes=2048)
+    assert backend.accepts('motion-events', ['01-20180730195708.mkv'])
+    assert not backend.accepts('motion-events', ['01-20180730195708.mkv',
+                                                 '01-20180730195750.mkv',
+                                                 '01-20180730195810.mkv'])
+
+
+    # sizes the caller already has aren't fetched again
+    s3.head_object.reset_mock()
+    heads = {'01-20180730195708.mkv': {'ContentLength': 4096}}
+    assert not backend.accepts('motion-events', list(heads), heads)
+    s3.head_object.assert_not_called()
+
+
+def test_ffmpeg_transcode(s3, tmpdir):
+    commands = []
+
+    def run(command, **kwargs):
+        commands.append(command)
+        with open(command[-1], 'wb') as f:
+            f.write(b'GIF89a')
+
+    notify = Mock()
+    backend = ffmpeg_backend(s3, tmpdir, run, notify=notify)
+    result = backend.transcode('motion-events', ['01-20180730195708.mkv',
+                                                 '01-20180730195750.mkv'],
+                               'preset-id')
+
+    assert result['Job']['Id'].startswith('ffmpeg-')
+    command = commands[0]
+    assert command[command.index('-f') + 1] == 'concat'
+    assert 'fps=5,scale=320:180' in command[command.index('-vf') + 1]
+    assert s3.put_object.call_args[1]['Key'] == '01-20180730195708.gif'
+    assert s3.put_object.call_args[1]['ContentType'] == 'image/gif'
+    notify.assert_called_once_with({
+        'state': 'COMPLETED',
+        'outputs': [{'key': '01-20180730195708.gif', 'presetId': 'preset-id',
+                     'status': 'Complete'}]
+    })
+    # the scratch directory is removed
+    assert tmpdir.listdir() == []
+
+
+def test_ffmpeg_failed(s3, tmpdir):
+    def run(command, **kwargs):
+        raise subprocess.CalledProcessError(
+            1, command, stderr=b'frame=0\nInvalid data found')
+
+    notify = Mock()
+    backend = ffmpeg_backend(s3, tmpdir, run, notify=notify)
+    with pytest.raises(RuntimeError, match='Invalid data found'):
+        backend.transcode('motion-events', ['01-20180730195708.mkv'],
+                          'preset-id')
+    notify.assert_not_called()
+    s3.put_object.assert_not_called()
+    assert tmpdir.listdir() == []
+
+
+def test_ffmpeg_motion_stage(s3, tmpdir):
+    np = pytest.importorskip('numpy')
+    frames = np.zeros((10, 90, 160), dtype=np.uint8)
+    for i in range(5):
+        frames[i, 10:20, 10 + i * 4:20 + i * 4] = 255
+    commands = []
+
+    def run(command, stdout, **kwargs):
+        commands.append(command)
+        if stdout == subprocess.PIPE:
+            return subprocess.CompletedProcess(command, 0, frames.tobytes())
+        with open(command[-1], 'wb') as f:
+            f.write(b'GIF89a')
+
+    backend = FFmpegBackend(lambda name: s3, 'motion-gifs', Mock(),
+                            tiers=[PresetTier('preset-id', 480, 270, 10)],
+                            tmp_dir=str(tmpdir), motion_stage=True, run=run)
+    result = backend.transcode('motion-events', ['01-20180730195708.mkv'],
+                               'preset-id')
+
+    analysis, encoding = commands
+    assert 'scale=160:90,format=gray' in analysis[analysis.index('-vf') + 1]
+    filters = encoding[encoding.index('-vf') + 1]
+    assert filters.startswith('fps=10,crop=iw*')
+    assert "select='eq(n\\,0)+" in filters
+    assert result['Motion']['totalFrames'] == 10
+    assert result['Motion']['frames'] < 10
+    assert result['Motion']['bytes'] == 6